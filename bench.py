@@ -0,0 +1,602 @@
+import argparse
+import asyncio
+import filecmp
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from progress import format_size
+
+FILL_BLOCK = 16 * 1024 * 1024  # 生成测试文件时重复写入的随机数据块，16MB
+SPARSE_STRIDE = 64 * 1024 * 1024  # 稀疏文件每64MB有一段数据，其余为空洞
+SPARSE_EXTENT = 1024 * 1024  # 稀疏文件每段数据1MB
+SEGMENT_SIZE = 1448  # 回环链路上模拟的TCP报文段大小，用于把丢包率换算到每次转发的数据
+RUN_TIMEOUT = 3600  # 单次运行的超时时间，秒
+SHIM_QUEUE = 64  # 链路模拟每个方向最多排队的数据段数，相当于路由器的缓冲区，满了之后发送方被反压
+
+# 传输模式: 模式名 -> (发送引擎的设置, 接收引擎的设置)
+MODES = {
+    'tcp': ({}, {}),
+    'no-zero-copy': ({'zero_copy': False}, {}),
+    'no-pipeline': ({'zero_copy': False, 'read_ahead': 0}, {'write_behind': 0}),
+    'mmap': ({'use_mmap': True}, {'use_mmap': True}),
+    'preallocate': ({}, {'preallocate_enabled': True}),
+    'zlib': ({'compression': 'zlib'}, {}),
+    'udp': ({}, {'use_udp': True}),
+}
+
+
+def parse_size(text):
+    """
+    解析带单位的大小，例如"1K"、"64M"、"20G"
+
+    Args:
+        text (str): 大小
+
+    Raises:
+        argparse.ArgumentTypeError: 格式错误
+
+    Returns:
+        int: 字节数
+    """
+    units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in units else ''
+    try:
+        return int(float(text[:len(text) - len(unit)]) * units[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无法解析大小: {text}")
+
+
+def parse_list(convert):
+    """
+    生成解析逗号分隔列表的函数，用作argparse的type
+
+    Args:
+        convert (callable): 每一项的转换函数
+
+    Returns:
+        callable: 解析函数
+    """
+    return lambda text: [convert(item) for item in text.split(',') if item]
+
+
+def free_port():
+    """
+    取一个当前空闲的本地端口
+
+    Returns:
+        int: 端口
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_file(path, size, layout):
+    """
+    生成测试文件，已存在且大小一致时直接使用
+
+    稠密文件重复写入同一块随机数据，不能压缩；稀疏文件每SPARSE_STRIDE字节只有SPARSE_EXTENT字节数据。
+
+    Args:
+        path (str): 文件路径
+        size (int): 文件大小
+        layout (str): 'dense'或'sparse'
+    """
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return
+    block = memoryview(os.urandom(min(FILL_BLOCK, size)))
+    with open(path, 'wb') as f:
+        if layout == 'sparse':
+            f.truncate(size)
+            for offset in range(0, size, SPARSE_STRIDE):
+                f.seek(offset)
+                f.write(block[:min(SPARSE_EXTENT, size - offset)])
+        else:
+            for offset in range(0, size, len(block)):
+                f.write(block[:size - offset])
+
+
+def peak_rss():
+    """
+    当前进程的峰值内存
+
+    Linux上读取/proc/self/status中的VmHWM，它在exec时重新计算；getrusage的ru_maxrss会继承
+    父进程在fork时的值，测到的可能是基准测试进程自己的内存。
+
+    Returns:
+        int: 峰值内存字节数
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def wait_child(proc, timeout):
+    """
+    等待子进程结束并取得其CPU时间
+
+    Args:
+        proc (subprocess.Popen): 子进程
+        timeout (float): 超时时间，超时后强制结束
+
+    Returns:
+        tuple: (标准输出最后一行解析出的结果, CPU时间秒)
+    """
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+    try:
+        output = proc.stdout.read()
+        _, status, usage = os.wait4(proc.pid, 0)
+    finally:
+        timer.cancel()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    proc.stdout.close()
+    lines = output.decode(errors='replace').strip().splitlines()
+    try:
+        result = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        result = {'error': f"进程异常退出，退出码{proc.returncode}"}
+    return result, usage.ru_utime + usage.ru_stime
+
+
+class LinkShim:
+    """
+    用户态的链路模拟，在回环地址上模拟广域网的时延、丢包和带宽
+
+    作为TCP代理运行在独立线程的事件循环中，两个方向各附加delay秒的单向时延。
+    字节流上无法真正丢弃数据，丢包按快速重传的代价处理：丢失的数据及其后的数据
+    多等待一个往返时延，与真实链路上丢包造成的队头阻塞相同。UDP传输的丢包和时延
+    由发送引擎的注入器模拟，不经过这里。
+    """
+
+    def __init__(self, target_port, delay=0.0, loss=0.0, bandwidth=0):
+        """
+        Args:
+            target_port (int): 服务器端口
+            delay (float): 单向附加时延，秒
+            loss (float): 丢包率，0到1
+            bandwidth (int): 每个方向的带宽，字节/秒，0表示不限
+        """
+        self.target_port = target_port
+        self.delay = delay
+        self.loss = loss
+        self.bandwidth = bandwidth
+        self.port = free_port()
+        self.random = random.Random(0)
+        self.free_at = [0.0, 0.0]  # 两个方向的链路空闲时刻，所有连接共享带宽，数据依次排队
+        self.loop = None
+        self.server = None
+        self.started = threading.Event()
+
+    def start(self):
+        """在后台线程中开始监听"""
+        threading.Thread(target=lambda: asyncio.run(self.serve()), daemon=True).start()
+        self.started.wait()
+
+    def stop(self):
+        """停止监听"""
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def serve(self):
+        """监听代理端口，直到调用stop"""
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', self.port)
+        self.started.set()
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    async def handle(self, reader, writer):
+        """
+        转发一个连接
+
+        Args:
+            reader (asyncio.StreamReader): 客户端的读取流
+            writer (asyncio.StreamWriter): 客户端的写入流
+        """
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection('127.0.0.1', self.target_port)
+        except OSError:
+            writer.close()
+            return
+        await asyncio.gather(self.pipe(reader, upstream_writer, 0), self.pipe(upstream_reader, writer, 1),
+                             return_exceptions=True)
+
+    async def pipe(self, reader, writer, direction):
+        """
+        按模拟的链路条件转发一个方向的数据
+
+        Args:
+            reader (asyncio.StreamReader): 读取流
+            writer (asyncio.StreamWriter): 写入流
+            direction (int): 0为客户端到服务器，1为服务器到客户端
+        """
+        queue = asyncio.Queue(SHIM_QUEUE)
+
+        async def deliver():
+            while True:
+                due, data = await queue.get()
+                if data is None:
+                    break
+                wait = due - self.loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                writer.write(data)
+                await writer.drain()
+            writer.close()
+
+        sender = asyncio.create_task(deliver())
+        try:
+            while True:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    break
+                now = self.loop.time()
+                if self.bandwidth:
+                    now = self.free_at[direction] = max(self.free_at[direction], now) + len(data) / self.bandwidth
+                due = now + self.delay
+                if self.loss and self.random.random() < 1 - (1 - self.loss) ** (len(data) / SEGMENT_SIZE):
+                    due += 2 * self.delay
+                await queue.put((due, data))
+        finally:
+            await queue.put((0, None))
+            await sender
+
+
+def serve_worker(config):
+    """
+    子进程：运行发送引擎，一个会话结束后退出，最后一行输出JSON结果
+
+    Args:
+        config (dict): 运行配置
+    """
+    from engine import ServerEngine
+
+    engine = ServerEngine(host='127.0.0.1', port=config['port'],
+                          on_log=log_stderr if config['verbose'] else None,
+                          on_started=lambda: print('READY', flush=True))
+    engine.file_path = config['file']
+    for name, value in config['server'].items():
+        setattr(engine, name, value)
+    ended = []
+
+    def on_session_end(session):
+        ended.append(session)
+        engine.stop()
+
+    engine.on_session_end = on_session_end
+    engine.run()
+    error = ended[0].error if ended else Exception("没有客户端连接")
+    print(json.dumps({'error': str(error) if error else None, 'rss': peak_rss()}), flush=True)
+
+
+def receive_worker(config):
+    """
+    子进程：运行接收引擎，最后一行输出JSON结果，包括耗时和首字节时间
+
+    Args:
+        config (dict): 运行配置
+    """
+    from receiver import ClientEngine
+
+    engine = ClientEngine(port=config['port'], on_log=log_stderr if config['verbose'] else None,
+                          choose_path=lambda info: config['output'])
+    engine.resume = False
+    engine.delta = False
+    for name, value in config['client'].items():
+        setattr(engine, name, value)
+    first_byte = []
+    report_received = engine.report_received
+
+    def report(size, stats=None):
+        if not first_byte:
+            first_byte.append(time.perf_counter())
+        report_received(size, stats)
+
+    engine.report_received = report
+    start = time.perf_counter()
+    try:
+        engine.connect('127.0.0.1')
+        error = None
+    except Exception as e:
+        error = str(e)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        'elapsed': elapsed,
+        'ttfb': first_byte[0] - start if first_byte else None,
+        'error': error,
+        'rss': peak_rss(),
+    }), flush=True)
+
+
+def log_stderr(message):
+    """
+    子进程的日志输出到标准错误，标准输出留给结果
+
+    Args:
+        message (str): 日志消息
+    """
+    print(f"[{time.strftime('%H:%M:%S')}] {message}", file=sys.stderr, flush=True)
+
+
+def spawn(mode, config):
+    """
+    启动工作子进程
+
+    Args:
+        mode (str): 'serve'或'receive'
+        config (dict): 运行配置
+
+    Returns:
+        subprocess.Popen: 子进程
+    """
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), f'_{mode}', json.dumps(config)],
+                            stdout=subprocess.PIPE)
+
+
+def run_case(case, args):
+    """
+    运行一个测试用例：发送方和接收方各一个子进程，经过回环地址传输一个文件
+
+    Args:
+        case (dict): 用例参数，文件大小、布局、模式、连接数和缓冲区大小
+        args (argparse.Namespace): 命令行参数
+
+    Returns:
+        dict: 用例参数和测得的结果
+    """
+    server_settings, client_settings = MODES[case['mode']]
+    server_settings = dict(server_settings, thread_count=case['streams'], socket_buffer_size=case['buffer'])
+    client_settings = dict(client_settings)
+    if case['mode'] == 'udp':
+        server_settings.update(udp_loss=args.loss, udp_delay=args.delay)
+    source = os.path.join(args.workdir, f"{case['layout']}_{case['size']}.bin")
+    output = os.path.join(args.workdir, 'received.bin')
+    if os.path.exists(output):
+        os.remove(output)
+
+    port = free_port()
+    server = spawn('serve', {'port': port, 'file': source, 'server': server_settings, 'verbose': args.verbose})
+    ready = server.stdout.readline()
+    shim = None
+    if ready.strip() != b'READY':
+        server.kill()
+        result, _ = wait_child(server, 10)
+        return dict(case, ok=False, error=result.get('error') or "发送方启动失败")
+    if case['mode'] != 'udp' and (args.delay or args.loss or args.bandwidth):
+        shim = LinkShim(port, args.delay, args.loss, args.bandwidth)
+        shim.start()
+        port = shim.port
+
+    client = spawn('receive', {'port': port, 'output': output, 'client': client_settings, 'verbose': args.verbose})
+    received, client_cpu = wait_child(client, RUN_TIMEOUT)
+    if received.get('error'):
+        server.kill()  # 接收方出错时发送方可能仍在等待连接
+    sent, server_cpu = wait_child(server, 30)
+    if shim:
+        shim.stop()
+
+    error = received.get('error') or sent.get('error')
+    ok = error is None and os.path.exists(output) and os.path.getsize(output) == case['size']
+    if ok and args.check:
+        ok = filecmp.cmp(source, output, shallow=False)
+        error = None if ok else "接收的文件与源文件不一致"
+    if os.path.exists(output):
+        os.remove(output)
+    elapsed = received.get('elapsed') or 0
+    return dict(
+        case,
+        ok=ok,
+        error=error,
+        elapsed=elapsed,
+        throughput=case['size'] / elapsed if ok and elapsed else 0,
+        ttfb=received.get('ttfb'),
+        client_cpu=client_cpu,
+        server_cpu=server_cpu,
+        client_rss=received.get('rss', 0),
+        server_rss=sent.get('rss', 0),
+    )
+
+
+def case_key(result):
+    """
+    用例的唯一标识，比较两次结果时按此对应
+
+    Args:
+        result (dict): 用例结果
+
+    Returns:
+        tuple: (模式, 布局, 文件大小, 连接数, 缓冲区大小)
+    """
+    return result['mode'], result['layout'], result['size'], result['streams'], result['buffer']
+
+
+def describe(result):
+    """
+    用例的简短描述
+
+    Args:
+        result (dict): 用例结果
+
+    Returns:
+        str: 描述文字
+    """
+    buffer = format_size(result['buffer']) if result['buffer'] else '默认'
+    streams = result['streams'] or '自动'
+    return (f"{result['mode']:<12} {result['layout']:<6} {format_size(result['size']):>11} "
+            f"连接数{streams!s:<3} 缓冲区{buffer:<10}")
+
+
+def environment():
+    """
+    记录运行环境，比较不同版本的结果时用于确认条件一致
+
+    Returns:
+        dict: 环境信息
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def run(args):
+    """
+    运行测试矩阵，把结果保存为JSON
+
+    Args:
+        args (argparse.Namespace): 命令行参数
+
+    Returns:
+        int: 退出码，有用例失败时为1
+    """
+    os.makedirs(args.workdir, exist_ok=True)
+    link = {'delay': args.delay, 'loss': args.loss, 'bandwidth': args.bandwidth}
+    results = []
+    for size, layout in itertools.product(args.sizes, args.layouts):
+        make_file(os.path.join(args.workdir, f"{layout}_{size}.bin"), size, layout)
+        for mode, streams, buffer in itertools.product(args.modes, args.streams, args.buffers):
+            for _ in range(args.repeat):
+                case = {'mode': mode, 'layout': layout, 'size': size, 'streams': streams, 'buffer': buffer}
+                result = run_case(case, args)
+                results.append(result)
+                if result['ok']:
+                    ttfb = f"{result['ttfb'] * 1000:.1f}ms" if result['ttfb'] is not None else '-'
+                    print(f"{describe(result)} {format_size(result['throughput'])}/s, 首字节{ttfb}, "
+                          f"CPU 发送{result['server_cpu']:.2f}s/接收{result['client_cpu']:.2f}s, "
+                          f"峰值内存 发送{format_size(result['server_rss'])}/接收{format_size(result['client_rss'])}",
+                          flush=True)
+                else:
+                    print(f"{describe(result)} 失败: {result['error']}", flush=True)
+    if not args.keep:
+        for size, layout in itertools.product(args.sizes, args.layouts):
+            os.remove(os.path.join(args.workdir, f"{layout}_{size}.bin"))
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'environment': environment(), 'link': link, 'results': results}, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存至: {args.output}")
+    return 0 if all(result['ok'] for result in results) else 1
+
+
+def compare(args):
+    """
+    比较两次运行的结果，吞吐量下降超过阈值的用例视为退化
+
+    同一用例运行多次时取最好的一次，减少偶然波动的影响。
+
+    Args:
+        args (argparse.Namespace): 命令行参数
+
+    Returns:
+        int: 退出码，有退化时为1
+    """
+    def best(path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        results = {}
+        for result in data['results']:
+            key = case_key(result)
+            if result['ok'] and result['throughput'] > results.get(key, {}).get('throughput', 0):
+                results[key] = result
+        return results
+
+    old, new = best(args.old), best(args.new)
+    regressions = 0
+    for key in sorted(old.keys() & new.keys()):
+        before, after = old[key]['throughput'], new[key]['throughput']
+        change = (after - before) / before * 100
+        flag = ''
+        if change < -args.threshold:
+            flag = '  <- 退化'
+            regressions += 1
+        print(f"{describe(new[key])} {format_size(before)}/s -> {format_size(after)}/s ({change:+.1f}%){flag}")
+    for key in sorted(old.keys() ^ new.keys()):
+        print(f"{describe((old.get(key) or new[key]))} 只在{'旧' if key in old else '新'}结果中出现")
+    print(f"共{len(old.keys() & new.keys())}个用例，{regressions}个退化超过{args.threshold:.0f}%")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    """
+    基准测试入口，发送方和接收方在回环地址上传输，不加载界面
+
+        python bench.py run --sizes 1K,1M,256M,4G --streams 1,4 --output new.json
+        python bench.py run --delay 25 --loss 0.5 --modes tcp,udp
+        python bench.py compare old.json new.json
+
+    Args:
+        argv (list): 命令行参数，默认为sys.argv[1:]
+
+    Returns:
+        int: 退出码
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['_serve']:
+        serve_worker(json.loads(argv[1]))
+        return 0
+    if argv[:1] == ['_receive']:
+        receive_worker(json.loads(argv[1]))
+        return 0
+
+    parser = argparse.ArgumentParser(description="回环基准测试")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="运行测试矩阵")
+    run_parser.add_argument('--sizes', type=parse_list(parse_size), default=[1024, 1024 ** 2, 64 * 1024 ** 2, 512 * 1024 ** 2],
+                            help="文件大小，逗号分隔，例如1K,1M,64M,20G")
+    run_parser.add_argument('--layouts', type=parse_list(str), default=['dense'], help="dense和/或sparse")
+    run_parser.add_argument('--modes', type=parse_list(str), default=['tcp'], help=f"传输模式: {','.join(MODES)}")
+    run_parser.add_argument('--streams', type=parse_list(int), default=[1, 4], help="数据连接数，0表示自动")
+    run_parser.add_argument('--buffers', type=parse_list(parse_size), default=[0], help="套接字缓冲区大小，0表示系统默认")
+    run_parser.add_argument('--repeat', type=int, default=1, help="每个用例运行的次数")
+    run_parser.add_argument('--delay', type=float, default=0, help="模拟的单向时延，毫秒")
+    run_parser.add_argument('--loss', type=float, default=0, help="模拟的丢包率，百分比")
+    run_parser.add_argument('--bandwidth', type=float, default=0, help="模拟的链路带宽，MB/s")
+    run_parser.add_argument('--check', action='store_true', help="逐字节比较接收的文件")
+    run_parser.add_argument('--workdir', default=os.path.join(os.path.expanduser('~'), '.filetransfer', 'bench'),
+                            help="存放测试文件的目录")
+    run_parser.add_argument('--keep', action='store_true', help="保留生成的测试文件，下次直接使用")
+    run_parser.add_argument('--output', default='bench.json', help="结果文件")
+    run_parser.add_argument('--verbose', action='store_true', help="输出发送方和接收方的日志")
+    compare_parser = commands.add_parser('compare', help="比较两次运行的结果")
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=10, help="视为退化的吞吐量下降百分比")
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        return compare(args)
+    unknown = [mode for mode in args.modes if mode not in MODES]
+    if unknown:
+        parser.error(f"未知的传输模式: {','.join(unknown)}")
+    args.delay /= 1000
+    args.loss /= 100
+    args.bandwidth = int(args.bandwidth * 1024 * 1024)
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
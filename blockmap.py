@@ -0,0 +1,154 @@
+import os
+import threading
+
+MAP_HEADER_SIZE = 64  # 位图文件头部长度
+MAP_SUFFIX = '.part'  # 位图文件后缀，与目标文件放在同一目录
+
+
+def bitmap_blocks(bitmap, block_count):
+    """
+    遍历位图中置位的块号
+
+    Args:
+        bitmap (bytes): 位图，第i位对应第i个块
+        block_count (int): 块数
+
+    Yields:
+        int: 置位的块号
+    """
+    for index in range(block_count):
+        if bitmap[index >> 3] & (1 << (index & 7)):
+            yield index
+
+
+class BlockMap:
+    """
+    记录已完成块的磁盘位图
+
+    位图保存在目标文件旁边的.part文件中，每个块占1位。块的数据写入目标文件之后
+    才会在位图中置位，因此连接中断后位图中置位的块一定是有效的，重新连接时只需
+    请求未置位的块。传输完成后删除位图文件。
+    """
+
+    def __init__(self, path, file_size, block_size, version, bitmap):
+        self.path = path
+        self.file_size = file_size
+        self.block_size = block_size
+        self.version = version
+        self.block_count = (file_size + block_size - 1) // block_size
+        self.bitmap = bitmap
+        self.lock = threading.Lock()  # 同一字节中的位可能被不同连接同时修改
+        self.file = open(path, 'r+b')
+
+    @classmethod
+    def open(cls, save_path, file_size, block_size, version):
+        """
+        打开目标文件对应的位图，不存在或与当前文件不匹配时新建
+
+        Args:
+            save_path (str): 目标文件或目录路径
+            file_size (int): 文件大小
+            block_size (int): 块大小
+            version (str): 服务器文件版本，文件被修改后旧的位图作废
+
+        Returns:
+            tuple: (BlockMap, bool) 位图和是否从已有位图恢复
+        """
+        path = save_path + MAP_SUFFIX
+        header = f"FTBM|{file_size}|{block_size}|{version}".encode().ljust(MAP_HEADER_SIZE, b' ')
+        bitmap_size = ((file_size + block_size - 1) // block_size + 7) // 8
+
+        # 目标文件（或目录）和位图都在、且头部一致时才能续传
+        if os.path.exists(path) and (os.path.isdir(save_path) or (
+                os.path.isfile(save_path) and os.path.getsize(save_path) == file_size)):
+            with open(path, 'rb') as f:
+                data = f.read()
+            if data[:MAP_HEADER_SIZE] == header and len(data) == MAP_HEADER_SIZE + bitmap_size:
+                return cls(path, file_size, block_size, version, bytearray(data[MAP_HEADER_SIZE:])), True
+
+        with open(path, 'wb') as f:
+            f.write(header)
+            f.write(bytes(bitmap_size))
+        return cls(path, file_size, block_size, version, bytearray(bitmap_size)), False
+
+    def block_length(self, index):
+        """
+        块的实际长度，最后一个块可能不足block_size
+
+        Args:
+            index (int): 块号
+
+        Returns:
+            int: 块长度
+        """
+        return min(self.block_size, self.file_size - index * self.block_size)
+
+    def completed_bytes(self):
+        """
+        已完成的字节数
+
+        Returns:
+            int: 已完成块的总长度
+        """
+        return sum(self.block_length(i) for i in bitmap_blocks(self.bitmap, self.block_count))
+
+    def missing_bitmap(self):
+        """
+        未完成块的位图，发送给服务器用于请求缺失的块
+
+        Returns:
+            bytes: 第i位置位表示第i个块还需要接收
+        """
+        missing = bytearray(~b & 0xFF for b in self.bitmap)
+        extra = len(missing) * 8 - self.block_count
+        if extra:
+            missing[-1] &= 0xFF >> extra  # 清除最后一个字节中不存在的块
+        return bytes(missing)
+
+    def mark(self, offset):
+        """
+        把偏移量所在的块标记为已完成，并立即写入位图文件
+
+        Args:
+            offset (int): 块在文件中的偏移量
+        """
+        index = offset // self.block_size
+        with self.lock:
+            self.bitmap[index >> 3] |= 1 << (index & 7)
+            self.file.seek(MAP_HEADER_SIZE + (index >> 3))
+            self.file.write(self.bitmap[index >> 3:(index >> 3) + 1])
+            self.file.flush()
+
+    def mark_blocks(self, indexes):
+        """
+        一次标记多个块为已完成，整个位图只写入一次，用于跳过稀疏文件的空洞
+
+        Args:
+            indexes (list): 块号
+        """
+        with self.lock:
+            for index in indexes:
+                self.bitmap[index >> 3] |= 1 << (index & 7)
+            self.file.seek(MAP_HEADER_SIZE)
+            self.file.write(self.bitmap)
+            self.file.flush()
+
+    def is_complete(self):
+        """
+        是否所有块都已完成
+
+        Returns:
+            bool: 所有块都已完成
+        """
+        return not any(self.missing_bitmap())
+
+    def close(self, remove=False):
+        """
+        关闭位图文件
+
+        Args:
+            remove (bool): 是否同时删除位图文件，传输完成后使用
+        """
+        self.file.close()
+        if remove:
+            os.remove(self.path)
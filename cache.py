@@ -0,0 +1,212 @@
+import asyncio
+import collections
+import os
+import time
+
+from progress import format_size
+
+STAT_TTL = 1.0  # 文件元数据的缓存时间，秒，超过后重新stat；修改时间比这更近的文件不缓存块
+SEEN_LIMIT = 4096  # 只被请求过一次的块最多记录的个数
+
+
+def file_identity(stat):
+    """
+    文件内容版本的标识，任一项变化都说明读到的可能是另一个版本的数据
+
+    Args:
+        stat (os.stat_result): 文件的元数据
+
+    Returns:
+        tuple: (设备, inode, 修改时间, 大小)
+    """
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def read_block(path, offset, length):
+    """
+    在线程池中打开文件读取一个块，读完后取打开的文件的元数据，用来确认读到的是哪个版本
+
+    Args:
+        path (str): 文件路径
+        offset (int): 块在文件中的位置
+        length (int): 块长度
+
+    Raises:
+        Exception: 文件读取不完整
+
+    Returns:
+        tuple: (块数据, 读完之后文件的元数据)
+    """
+    with open(path, 'rb') as f:
+        if hasattr(os, 'pread'):
+            data = os.pread(f.fileno(), length, offset)
+        else:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) < length:
+            raise Exception("文件读取不完整")
+        return data, os.fstat(f.fileno())
+
+
+class BlockCache:
+    """
+    服务器进程内所有会话共享的块缓存
+
+    同一个文件被多个客户端先后下载时，热门的块直接从内存发送，不再读盘；按路径缓存的元数据
+    让发送路径省去存在性、权限和大小的检查，命中时不需要任何系统调用。
+    块按(设备, inode, 修改时间, 大小, 块位置)索引，命中按缓存的元数据判断，文件被替换或修改后
+    最多STAT_TTL秒就使用新的键，旧的块随LRU淘汰。只有第二次被请求的块才读入缓存，只请求一次的块
+    和超过内存上限的块由调用方用零拷贝发送。读入时在线程池中打开文件并核对fstat，
+    与缓存的元数据不一致（文件已被替换）、或最近STAT_TTL秒内修改过（修改时间的精度可能不足以
+    区分之后的改写）的块不放入缓存。只由事件循环线程访问，不需要加锁。
+    """
+
+    def __init__(self, capacity=0):
+        """
+        Args:
+            capacity (int): 缓存块数据的内存上限，字节，0表示不缓存块，只缓存元数据
+        """
+        self.capacity = capacity
+        self.blocks = collections.OrderedDict()  # 键 -> 块数据，最近使用的在末尾
+        self.size = 0  # 已缓存的字节数
+        self.loading = {}  # 键 -> 读盘任务，多个连接同时需要同一块时只读一次
+        self.seen = collections.OrderedDict()  # 只被请求过一次、尚未缓存的块的键
+        self.stats = {}  # 文件路径 -> (os.stat_result, 检查时间)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stat(self, path):
+        """
+        文件的元数据，STAT_TTL内重复请求不再调用stat和access
+
+        Args:
+            path (str): 文件路径
+
+        Raises:
+            FileNotFoundError: 文件不存在或已被移动
+            PermissionError: 没有文件读取权限
+
+        Returns:
+            os.stat_result: 文件的元数据
+        """
+        now = time.monotonic()
+        cached = self.stats.get(path)
+        if cached is not None and now - cached[1] < STAT_TTL:
+            return cached[0]
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.stats.pop(path, None)
+            raise FileNotFoundError("文件不存在或已被移动")
+        if not os.access(path, os.R_OK):
+            self.stats.pop(path, None)
+            raise PermissionError("没有文件读取权限")
+        if len(self.stats) > 1024:
+            self.stats.clear()  # 目录中有大量小文件时防止无限增长
+        self.stats[path] = (stat, now)
+        return stat
+
+    def resize(self, capacity):
+        """
+        修改内存上限，超出的块立即淘汰
+
+        Args:
+            capacity (int): 内存上限，字节，0表示不缓存块
+        """
+        self.capacity = capacity
+        self.trim()
+
+    def trim(self):
+        """按LRU淘汰块，直到不超过内存上限"""
+        while self.blocks and self.size > self.capacity:
+            _, data = self.blocks.popitem(last=False)
+            self.size -= len(data)
+            self.evictions += 1
+
+    async def get(self, path, stat, offset, length):
+        """
+        取一个块，每次调用只计一次命中或未命中。第二次未命中的块在线程池中读盘并放入缓存，
+        第一次未命中或超过内存上限的块返回None，由调用方从文件发送
+
+        Args:
+            path (str): 文件路径
+            stat (os.stat_result): stat(path)返回的元数据
+            offset (int): 块在文件中的位置
+            length (int): 块长度
+
+        Raises:
+            Exception: 文件读取不完整
+
+        Returns:
+            bytes: 块数据，不缓存这个块时为None
+        """
+        key = file_identity(stat) + (offset,)
+        data = self.blocks.get(key)
+        if data is not None and len(data) == length:
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return data
+        future = self.loading.get(key)
+        if future is not None:
+            # 其他连接正在读这个块，等它读完，同样不需要读盘
+            data, _ = await asyncio.shield(future)
+            if len(data) == length:
+                self.hits += 1
+                return data
+        self.misses += 1
+        if length > self.capacity:
+            return None
+        if self.seen.pop(key, None) is None:
+            self.seen[key] = True
+            if len(self.seen) > SEEN_LIMIT:
+                self.seen.popitem(last=False)
+            return None
+        future = asyncio.get_running_loop().run_in_executor(None, read_block, path, offset, length)
+        self.loading[key] = future
+        try:
+            data, fresh = await asyncio.shield(future)
+        finally:
+            if self.loading.get(key) is future:
+                del self.loading[key]
+        if file_identity(fresh) != file_identity(stat):
+            self.stats.pop(path, None)  # 文件已被替换或改写，下一个块重新stat
+            return data
+        if time.time_ns() - fresh.st_mtime_ns < STAT_TTL * 1e9:
+            return data  # 文件可能还在写入，修改时间的精度不足以区分之后的改写，暂不缓存
+        old = self.blocks.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.blocks[key] = data
+        self.size += length
+        self.trim()
+        return data
+
+    def snapshot(self):
+        """
+        当前统计的快照
+
+        Returns:
+            dict: 统计值
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'bytes': self.size,
+            'capacity': self.capacity,
+            'blocks': len(self.blocks),
+        }
+
+    def summary(self):
+        """
+        用于日志的一行摘要
+
+        Returns:
+            str: 摘要
+        """
+        data = self.snapshot()
+        return (f"命中{data['hits']}次, 未命中{data['misses']}次, 命中率{data['hit_ratio'] * 100:.1f}%, "
+                f"淘汰{data['evictions']}块, 已用{format_size(data['bytes'])}")
@@ -0,0 +1,322 @@
+import argparse
+import os
+import signal
+import sys
+import threading
+import time
+
+from pipeline import RING_SLOTS
+from progress import format_size
+from tuning import AUTO_STREAMS
+
+WATCH_INTERVAL = 2.0  # 扫描投递目录的间隔，秒
+PROGRESS_INTERVAL = 1.0  # 命令行进度的刷新间隔，秒
+
+
+def log(message):
+    """
+    输出带时间的日志
+
+    Args:
+        message (str): 日志消息
+    """
+    print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+
+def megabytes(value):
+    """
+    把命令行中的MB/s换算为字节/秒
+
+    Args:
+        value (float): 速率，MB/s
+
+    Returns:
+        int: 速率，字节/秒
+    """
+    return int(value * 1024 * 1024)
+
+
+def create_server(args):
+    """
+    按命令行参数创建发送引擎
+
+    Args:
+        args (argparse.Namespace): 命令行参数
+
+    Raises:
+        Exception: 文件不存在或为空
+
+    Returns:
+        ServerEngine: 发送引擎
+    """
+    from engine import ServerEngine
+
+    for path in args.paths:
+        if not os.path.exists(path):
+            raise Exception(f"{path}不存在")
+        if os.path.isfile(path) and os.path.getsize(path) == 0:
+            raise Exception(f"不能传输空文件: {path}")
+    engine = ServerEngine(host=args.host, port=args.port, on_log=log)
+    engine.file_path = args.paths[0]
+    for path in args.paths[1:]:
+        engine.add_job(path)
+    engine.thread_count = args.threads
+    engine.compression = args.compress
+    engine.verify = not args.no_verify
+    engine.use_mmap = args.mmap
+    engine.zero_copy = not args.no_zero_copy
+    engine.allow_udp = not args.no_udp
+    engine.rate_limit = megabytes(args.rate_limit)
+    engine.session_rate_limit = megabytes(args.session_rate_limit)
+    engine.metrics_path = args.metrics
+    engine.read_ahead = args.read_ahead
+    engine.cache_size = megabytes(args.cache_size)
+    return engine
+
+
+def send(args):
+    """
+    发送文件：等待一个客户端连接，会话结束后退出，多个路径在同一个持久会话中依次发送
+
+    Args:
+        args (argparse.Namespace): 命令行参数
+
+    Returns:
+        int: 退出码，传输出错时为1
+    """
+    engine = create_server(args)
+    engine.keep_alive = len(args.paths) > 1
+    engine.idle_timeout = 0
+    ended = []
+
+    def on_session_end(session):
+        ended.append(session)
+        engine.stop()
+
+    engine.on_session_end = on_session_end
+    engine.run()
+    return 1 if not ended or ended[0].error else 0
+
+
+def watch_spool(engine, spool_dir, stop):
+    """
+    扫描投递目录，把新出现且大小已稳定的文件加入发送队列
+
+    Args:
+        engine (ServerEngine): 发送引擎
+        spool_dir (str): 投递目录
+        stop (threading.Event): 停止扫描的事件
+    """
+    queued = set()
+    sizes = {}  # 文件名 -> 上次扫描时的大小，两次扫描大小相同才认为已写完
+    while not stop.is_set():
+        try:
+            names = sorted(os.listdir(spool_dir))
+        except OSError as e:
+            log(f"扫描投递目录失败: {str(e)}")
+            names = []
+        for name in names:
+            path = os.path.join(spool_dir, name)
+            if name.startswith('.') or path in queued:
+                continue
+            try:
+                size = os.path.getsize(path) if os.path.isfile(path) else -1
+            except OSError:
+                continue
+            if size == 0 or sizes.get(name) != size:
+                sizes[name] = size
+                continue
+            queued.add(path)
+            engine.add_job(path)
+            log(f"已加入队列: {name}")
+        stop.wait(WATCH_INTERVAL)
+
+
+def daemon(args):
+    """
+    常驻发送：持续监听，持久会话依次发送队列和投递目录中的文件，收到SIGTERM或SIGINT后退出
+
+    Args:
+        args (argparse.Namespace): 命令行参数
+
+    Returns:
+        int: 退出码
+    """
+    engine = create_server(args)
+    engine.keep_alive = True
+    engine.idle_timeout = args.idle_timeout
+    engine.swarm = args.swarm
+    stop = threading.Event()
+
+    def on_signal(signum, frame):
+        log("收到停止信号")
+        stop.set()
+        engine.stop()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    if args.watch:
+        threading.Thread(target=watch_spool, args=(engine, args.watch, stop), daemon=True).start()
+    try:
+        engine.run()
+    finally:
+        stop.set()
+    return 0
+
+
+def create_receiver(args):
+    """
+    按命令行参数创建接收引擎
+
+    Args:
+        args (argparse.Namespace): 命令行参数
+
+    Returns:
+        ClientEngine: 接收引擎
+    """
+    from receiver import ClientEngine
+
+    def choose_path(info):
+        if os.path.isdir(args.output):
+            return os.path.join(args.output, info.file_name)
+        return args.output
+
+    engine = ClientEngine(port=args.port, on_log=log, on_finish=log, choose_path=choose_path)
+    engine.resume = not args.no_resume
+    engine.delta = not args.no_delta
+    engine.use_mmap = args.mmap
+    engine.preallocate_enabled = args.preallocate
+    engine.dedup = args.dedup
+    engine.use_udp = args.udp
+    engine.write_behind = args.write_behind
+    engine.listen_port = args.listen_port
+    engine.upload_limit = megabytes(args.upload_limit)
+    return engine
+
+
+def show_progress(engine, stop):
+    """
+    定期在标准错误输出接收进度
+
+    Args:
+        engine (ClientEngine): 接收引擎
+        stop (threading.Event): 停止输出的事件
+    """
+    while not stop.wait(PROGRESS_INTERVAL):
+        if engine.receiving and engine.file_size:
+            received = engine.channel.total()
+            print(f"接收进度: {received / engine.file_size * 100:.2f}% "
+                  f"({format_size(received)}/{format_size(engine.file_size)})", file=sys.stderr, flush=True)
+
+
+def receive(args):
+    """
+    接收文件：连接服务器并保存到OUTPUT，OUTPUT是已有的目录时按文件名保存在其中
+
+    Args:
+        args (argparse.Namespace): 命令行参数
+
+    Returns:
+        int: 退出码，接收出错时为1
+    """
+    engine = create_receiver(args)
+    stop = threading.Event()
+    if not args.quiet:
+        threading.Thread(target=show_progress, args=(engine, stop), daemon=True).start()
+    try:
+        if args.swarm:
+            saved = [engine.join_swarm(args.server, args.output)]
+        else:
+            saved = engine.connect(args.server)
+    except Exception as e:
+        log(f"错误: {str(e)}")
+        return 1
+    finally:
+        stop.set()
+        if args.metrics:
+            engine.metrics.export(args.metrics)
+    return 0 if saved else 1
+
+
+def add_send_options(parser):
+    """
+    添加发送端的公共参数
+
+    Args:
+        parser (argparse.ArgumentParser): 子命令的解析器
+    """
+    parser.add_argument('paths', nargs='+', metavar='PATH', help="要发送的文件或目录，多个时依次发送")
+    parser.add_argument('--host', default='0.0.0.0', help="监听地址")
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--threads', type=int, default=AUTO_STREAMS, help="每个会话的数据连接数，0表示自动")
+    parser.add_argument('--compress', choices=['zlib', 'lzma'], help="压缩算法")
+    parser.add_argument('--no-verify', action='store_true', help="不附加块摘要")
+    parser.add_argument('--mmap', action='store_true', help="映射源文件发送")
+    parser.add_argument('--no-zero-copy', action='store_true', help="不使用sendfile零拷贝")
+    parser.add_argument('--no-udp', action='store_true', help="拒绝客户端的UDP传输请求")
+    parser.add_argument('--rate-limit', type=float, default=0, help="总速率上限，MB/s")
+    parser.add_argument('--session-rate-limit', type=float, default=0, help="每个会话的速率上限，MB/s")
+    parser.add_argument('--metrics', help="定期导出统计的文件，.prom为Prometheus格式")
+    parser.add_argument('--read-ahead', type=int, default=RING_SLOTS, help="不使用零拷贝时每个连接预读的缓冲区个数，0表示不预读")
+    # 从缓存发送的块经过用户态写入，不再零拷贝；只被请求一次的块不放入缓存，仍用sendfile发送
+    parser.add_argument('--cache-size', type=float, default=0,
+                        help="所有会话共享的块缓存上限，MB，0表示不缓存块。第二次被请求的块才放入缓存，"
+                             "从缓存发送时不使用零拷贝，多个客户端先后下载同一文件时才值得开启")
+
+
+def main(argv=None):
+    """
+    命令行入口，不加载界面，可以在没有图形环境的服务器上运行
+
+        python cli.py send 文件 [文件...]
+        python cli.py receive 服务器IP 保存位置
+        python cli.py daemon 文件 [--watch 投递目录] [--swarm]
+
+    Args:
+        argv (list): 命令行参数，默认为sys.argv[1:]
+
+    Returns:
+        int: 退出码
+    """
+    parser = argparse.ArgumentParser(description="文件传输命令行")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    send_parser = commands.add_parser('send', help="发送文件，一个会话结束后退出")
+    add_send_options(send_parser)
+    send_parser.set_defaults(func=send)
+
+    daemon_parser = commands.add_parser('daemon', help="常驻发送，持久会话依次发送队列中的文件")
+    add_send_options(daemon_parser)
+    daemon_parser.add_argument('--watch', metavar='DIR', help="投递目录，新放入的文件自动加入发送队列")
+    daemon_parser.add_argument('--idle-timeout', type=float, default=30.0, help="队列已空时持久会话等待的秒数")
+    daemon_parser.add_argument('--swarm', action='store_true', help="开启P2P分发，作为种子和tracker")
+    daemon_parser.set_defaults(func=daemon)
+
+    receive_parser = commands.add_parser('receive', help="连接服务器接收文件")
+    receive_parser.add_argument('server')
+    receive_parser.add_argument('output', help="保存路径，已有的目录时按文件名保存在其中")
+    receive_parser.add_argument('--port', type=int, default=9999)
+    receive_parser.add_argument('--no-resume', action='store_true', help="不记录已完成的块")
+    receive_parser.add_argument('--no-delta', action='store_true', help="不使用增量传输")
+    receive_parser.add_argument('--mmap', action='store_true', help="内存映射写入")
+    receive_parser.add_argument('--preallocate', action='store_true', help="预分配磁盘空间")
+    receive_parser.add_argument('--dedup', action='store_true', help="使用本地去重缓存")
+    receive_parser.add_argument('--udp', action='store_true', help="使用可靠UDP代替TCP数据连接")
+    receive_parser.add_argument('--write-behind', type=int, default=RING_SLOTS, help="每个连接写回的缓冲区个数，0表示不写回")
+    receive_parser.add_argument('--swarm', action='store_true', help="作为P2P分发的节点下载，output为保存目录")
+    receive_parser.add_argument('--listen-port', type=int, default=0, help="P2P分发时为其他节点上传的端口")
+    receive_parser.add_argument('--upload-limit', type=float, default=0, help="P2P分发时的上传速率上限，MB/s")
+    receive_parser.add_argument('--metrics', help="结束后导出统计的文件，.prom为Prometheus格式")
+    receive_parser.add_argument('--quiet', action='store_true', help="不输出进度")
+    receive_parser.set_defaults(func=receive)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except Exception as e:
+        log(f"错误: {str(e)}")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
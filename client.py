@@ -1,16 +1,20 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-import socket
 import os
 import threading
-from datetime import datetime
-import time
+
+from progress import POLL_INTERVAL, ProgressChannel, format_size
+from protocol import CAP_SWARM
+from receiver import ClientEngine
+
 
 class FileClient:
+    """接收端界面，接收逻辑由ClientEngine在后台线程中完成"""
+
     def __init__(self):
         self.window = tk.Tk()
         self.window.title("文件传输客户端")
-        self.window.geometry("600x500")
+        self.window.geometry("680x560")
         self.window.configure(bg='#f0f0f0')
         
         # 创建主框架
@@ -30,9 +34,44 @@ class FileClient:
         self.connect_button = ttk.Button(connect_frame, text="连接服务器", command=self.connect_server)
         self.connect_button.pack(side=tk.LEFT, padx=5)
         
+        self.export_button = ttk.Button(connect_frame, text="导出统计", command=self.export_metrics)
+        self.export_button.pack(side=tk.LEFT, padx=5)
+        
         self.status_label = ttk.Label(connect_frame, text="未连接", foreground="red")
         self.status_label.pack(side=tk.RIGHT, padx=5)
         
+        # 接收选项框架
+        option_frame = ttk.LabelFrame(main_frame, text="接收选项", padding="5")
+        option_frame.pack(fill=tk.X, pady=5)
+        
+        # 断点续传：在目标文件旁记录已完成的块，中断后重新连接只接收缺失的部分
+        self.resume_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(option_frame, text="断点续传", variable=self.resume_var).pack(side=tk.LEFT, padx=5)
+        
+        # 增量传输：保存位置已有旧版本文件时，只接收变化的部分
+        self.delta_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(option_frame, text="增量传输", variable=self.delta_var).pack(side=tk.LEFT, padx=5)
+        
+        # 内存映射写入：映射预分配的文件，数据直接接收到映射中对应的位置
+        self.mmap_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(option_frame, text="内存映射(mmap)", variable=self.mmap_var).pack(side=tk.LEFT, padx=5)
+        
+        # 预分配空间：为有数据的区间预先分配磁盘空间，减少多个连接并发写入造成的碎片，空洞仍不占空间
+        self.preallocate_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(option_frame, text="预分配空间", variable=self.preallocate_var).pack(side=tk.LEFT, padx=5)
+        
+        # 去重缓存：接收过的内容按块保存在本地仓库，其他文件中相同的块直接从仓库取出
+        self.dedup_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(option_frame, text="去重缓存", variable=self.dedup_var).pack(side=tk.LEFT, padx=5)
+        
+        # 可靠UDP：长时延、有丢包的链路上代替TCP数据连接，丢失的数据报按选择确认单独重传
+        self.udp_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(option_frame, text="UDP传输", variable=self.udp_var).pack(side=tk.LEFT, padx=5)
+        
+        # P2P分发：服务器开启P2P分发时，接收方之间互相交换已有的块，同时为其他接收方上传
+        self.swarm_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(option_frame, text="P2P分发", variable=self.swarm_var).pack(side=tk.LEFT, padx=5)
+        
         # 文件信息框架
         file_frame = ttk.LabelFrame(main_frame, text="文件信息", padding="5")
         file_frame.pack(fill=tk.X, pady=5)
@@ -65,219 +104,169 @@ class FileClient:
         style = ttk.Style()
         style.configure('TButton', padding=5)
         style.configure('TLabelframe', background='#f0f0f0')
-        
-        self.received_chunks = {}
-        self.lock = threading.Lock()
-        self.total_received = 0
+
+        self.channel = ProgressChannel()  # 接收线程只累加计数器，界面线程定时刷新进度
+        self.engine = ClientEngine(
+            on_log=self.log_message,
+            on_connected=lambda: self.channel.call(self.status_label.config, text="已连接", foreground="green"),
+            on_file=lambda info: self.channel.call(self.show_file_info, info),
+            on_finish=lambda text: self.channel.call(self.show_result, text),
+            choose_path=self.choose_path,
+            channel=self.channel,
+        )
+        self.window.after(POLL_INTERVAL, self.poll_channel)
     
     def log_message(self, message):
         """
-        记录日志
+        记录日志，可以在任意线程中调用，由界面线程统一显示
 
         Args:
             message (str): 日志消息
         """
-        current_time = datetime.now().strftime("%H:%M:%S")
-        self.log_text.insert(tk.END, f"[{current_time}] {message}\n")
-        self.log_text.see(tk.END)
+        self.channel.log(message)
+    
+
+    def poll_channel(self):
+        """界面线程定时执行：显示期间累积的日志和事件，并刷新一次进度"""
+        text = self.channel.poll()
+        if text:
+            self.log_text.insert(tk.END, text)
+            self.log_text.see(tk.END)
+        if self.engine.receiving:
+            self.update_progress()
+        self.window.after(POLL_INTERVAL, self.poll_channel)
     
 
-    def format_size(self, size):
+    def update_progress(self):
+        """按计数器总和刷新进度条和进度标签，只在界面线程中调用"""
+        total_received = self.channel.total()
+        file_size = self.engine.file_size
+        progress = (total_received / (file_size or 1)) * 100
+        self.progress_bar.config(maximum=file_size or 1, value=total_received)
+        self.progress_label.config(
+            text=f"接收进度: {progress:.2f}% ({format_size(total_received)}/{format_size(file_size)})"
+        )
+    
+
+    def show_file_info(self, info):
         """
-        格式化文件大小
+        显示正在接收的文件，只在界面线程中调用
 
         Args:
-            size (int): 文件大小
+            info (FileInfo): 文件信息
+        """
+        mode = "P2P分发" if info.caps & CAP_SWARM else f"线程数: {info.thread_count}"
+        self.file_info_label.config(
+            text=f"{'文件夹' if info.is_dir else '文件名'}: {info.file_name} "
+                 f"(大小: {format_size(info.file_size)}, {mode})"
+        )
+    
 
-        Returns:
-            str: 格式化后的文件大小
+    def show_result(self, text):
+        """
+        刷新最终进度并显示结果，只在界面线程中调用
+
+        Args:
+            text (str): 进度标签上显示的文字
         """
-        for unit in ['B', 'KB', 'MB', 'GB']:
-            if size < 1024:
-                return f"{size:.2f} {unit}"
-            size /= 1024
-        return f"{size:.2f} TB"
+        self.update_progress()
+        self.progress_label.config(text=text)
     
-    def receive_chunk(self, client_socket, thread_id, save_file):
+
+    def choose_path(self, info):
         """
-        接收文件数据块
+        询问保存位置，在接收线程中调用，对话框由界面线程弹出
 
         Args:
-            client_socket (socket.socket): 客户端套接字
-            thread_id (int): 线程ID
-            save_file (file): 保存文件
+            info (FileInfo): 文件信息
+
+        Returns:
+            str: 保存路径，用户取消时为空字符串
         """
+        answer = []
+        done = threading.Event()
+
+        def ask():
+            if info.is_dir:
+                parent = filedialog.askdirectory(title="选择保存位置")
+                answer.append(os.path.join(parent, info.file_name) if parent else "")
+            else:
+                answer.append(filedialog.asksaveasfilename(
+                    defaultextension=os.path.splitext(info.file_name)[1],
+                    initialfile=info.file_name,
+                    title="选择保存位置"
+                ))
+            done.set()
+
+        self.channel.call(ask)
+        done.wait()
+        return answer[0]
+    
+
+    def export_metrics(self):
+        """把各连接的传输统计导出到文件"""
+        path = filedialog.asksaveasfilename(
+            defaultextension='.jsonl',
+            filetypes=[("JSON行", "*.jsonl"), ("Prometheus文本", "*.prom")],
+            title="导出统计"
+        )
+        if not path:
+            return
         try:
-            client_socket.settimeout(10)  # 10秒超时
-            
-            # 接收固定长度的头部信息
-            header = b""
-            try:
-                while len(header) < 20:
-                    chunk = client_socket.recv(20 - len(header))
-                    if not chunk:
-                        raise Exception("连接中断")
-                    header += chunk
-            except socket.timeout:
-                raise Exception("接收头部信息超时")
-            
-            try:
-                header = header.decode().strip()
-                thread_id, chunk_size = map(int, header.split('|'))
-            except (UnicodeDecodeError, ValueError):
-                raise Exception("头部信息格式错误")
-            
-            if chunk_size <= 0:
-                raise ValueError("无效的数据块大小")
-            
-            client_socket.send(b'1')  # 发送确认
-            
-            # 接收数据块
-            received_data = bytearray()  # 可变字节序列，存储二进制数据
-            remaining = chunk_size
-            last_progress_time = time.time()
-            
-            while remaining > 0:
-                try:
-                    buffer_size = min(remaining, 8192)
-                    data = client_socket.recv(buffer_size)
-                    if not data:
-                        raise Exception("连接中断")
-                    received_data.extend(data)
-                    remaining -= len(data)
-                    
-                    # 检查传输是否停滞
-                    current_time = time.time()
-                    if current_time - last_progress_time > 30:  # 30秒无进展
-                        raise Exception("传输停滞")
-                    if data:
-                        last_progress_time = current_time
-                        
-                except socket.timeout:
-                    raise Exception("接收数据超时")
-            
-            if len(received_data) != chunk_size:
-                raise Exception(f"数据不完整: 预期{chunk_size}字节，实际接收{len(received_data)}字节")
-            
-            try:
-                # 线程锁，保护共享资源
-                with self.lock:
-                    save_file.seek(thread_id * self.chunk_size)
-                    save_file.write(received_data)
-                    self.total_received += len(received_data)
-                    progress = (self.total_received / self.file_size) * 100
-                    self.progress_bar['value'] = self.total_received
-                    self.progress_label.config(
-                        text=f"接收进度: {progress:.2f}% ({self.format_size(self.total_received)}/{self.format_size(self.file_size)})"
-                    )
-            except IOError as e:
-                raise Exception(f"写入文件错误: {str(e)}")
-            
-            self.log_message(f"线程{thread_id}接收完成: {self.format_size(len(received_data))}")
-        
-        except Exception as e:
-            self.log_message(f"线程{thread_id}接收错误: {str(e)}")
-            raise
-        finally:
-            client_socket.settimeout(None)
+            self.engine.metrics.export(path)
+        except OSError as e:
+            self.log_message(f"导出统计失败: {str(e)}")
+            return
+        self.log_message(f"统计已导出至: {path}")
     
 
-    def connect_server(self):
-        """连接服务器"""
-        def connect_thread():
-            """连接服务器线程"""
+    def update_engine_options(self):
+        """把界面上的接收选项同步给引擎，只影响之后接收的文件"""
+        self.engine.resume = self.resume_var.get()
+        self.engine.delta = self.delta_var.get()
+        self.engine.use_mmap = self.mmap_var.get()
+        self.engine.preallocate_enabled = self.preallocate_var.get()
+        self.engine.dedup = self.dedup_var.get()
+        self.engine.use_udp = self.udp_var.get()
+    
+
+    def run_engine(self, target, *args):
+        """
+        在后台线程中运行接收引擎，出错时在界面上提示
+
+        Args:
+            target (callable): 引擎的入口方法
+            *args: 位置参数
+        """
+        def engine_thread():
+            """接收线程"""
             try:
-                # 主连接用于交换控制信息
-                main_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                server_ip = self.ip_entry.get()
-                self.log_message(f"正在连接服务器 {server_ip}...")
-                main_socket.connect((server_ip, 9999))
-                self.status_label.config(text="已连接", foreground="green")
-                self.log_message("已连接到服务器")
-                
-                # 接收文件信息
-                file_info = main_socket.recv(1024).decode()
-                file_name, file_size, thread_count = file_info.split('|')
-                self.file_size = int(file_size)
-                thread_count = int(thread_count)
-                
-                self.file_info_label.config(
-                    text=f"文件名: {file_name} (大小: {self.format_size(self.file_size)}, 线程数: {thread_count})"
-                )
-                self.log_message(f"准备接收文件: {file_name}")
-                
-                # 选择保存位置
-                save_path = filedialog.asksaveasfilename(
-                    defaultextension=os.path.splitext(file_name)[1],
-                    initialfile=file_name,
-                    title="选择保存位置"
-                )
-                
-                if not save_path:
-                    self.log_message("用户取消接收")
-                    main_socket.close()
-                    return
-                
-                # 创建空文件
-                with open(save_path, 'wb') as f:
-                    f.seek(self.file_size - 1)
-                    f.write(b'\0')  # 写入空字节，确保文件大小正确
-                
-                main_socket.send(b"ready")  # 通知服务器准备就绪
-                
-                self.total_received = 0
-                self.progress_bar['maximum'] = self.file_size
-                self.chunk_size = self.file_size // thread_count
-                
-                # 开始接收文件
-                with open(save_path, 'r+b') as save_file:
-                    if thread_count == 1:
-                        # 单线程接收
-                        self.receive_chunk(main_socket, 0, save_file)
-                        main_socket.close()
-                    else:
-                        # 多线程接收：为每个线程创建独立的socket连接
-                        threads = []
-                        sockets = []
-                        
-                        # 创建数据连接
-                        for i in range(thread_count):
-                            # 创建数据连接，使用IPv4协议，TCP协议
-                            data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                            data_socket.connect((server_ip, 9999))
-                            sockets.append(data_socket)
-                            self.log_message(f"数据连接 {i} 已建立")
-                        
-                        for i in range(thread_count):
-                            thread = threading.Thread(
-                                target=self.receive_chunk,
-                                args=(sockets[i], i, save_file)
-                            )
-                            threads.append(thread)
-                            thread.start()
-                        
-                        # 等待所有线程完成
-                        for thread in threads:
-                            thread.join()
-                        
-                        # 关闭所有数据连接
-                        for sock in sockets:
-                            sock.close()
-                        main_socket.close()
-                
-                self.progress_label.config(text="接收完成！")
-                self.log_message(f"文件保存至: {save_path}")
-                
+                target(*args)
             except Exception as e:
-                messagebox.showerror("错误", f"接收出错：{str(e)}")
-                self.status_label.config(text="出错", foreground="red")
+                self.channel.call(messagebox.showerror, "错误", f"接收出错：{str(e)}")
+                self.channel.call(self.status_label.config, text="出错", foreground="red")
                 self.log_message(f"错误: {str(e)}")
-        
-        threading.Thread(target=connect_thread).start()
+
+        threading.Thread(target=engine_thread).start()
+    
+    def join_swarm(self):
+        """作为P2P分发的节点下载：选择保存目录后在后台线程中运行，下载完成后继续为其他节点上传"""
+        save_dir = filedialog.askdirectory(title="选择保存位置")
+        if not save_dir:
+            return
+        self.run_engine(self.engine.join_swarm, self.ip_entry.get(), save_dir)
+    
+    def connect_server(self):
+        """连接服务器"""
+        self.update_engine_options()
+        if self.swarm_var.get():
+            self.join_swarm()
+            return
+        self.run_engine(self.engine.connect, self.ip_entry.get())
     
     def run(self):
         self.window.mainloop()
 
 if __name__ == "__main__":
     client = FileClient()
-    client.run() 
\ No newline at end of file
+    client.run()
@@ -0,0 +1,78 @@
+import lzma
+import os
+import zlib
+
+from tree import read_segments
+
+# 块头部中的压缩算法编号
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODECS = {'zlib': CODEC_ZLIB, 'lzma': CODEC_LZMA}
+
+SAMPLE_SIZE = 64 * 1024  # 先压缩块开头64KB试探是否值得压缩
+SAMPLE_RATIO = 0.9  # 样本压缩后仍大于原来的90%，视为不可压缩
+BLOCK_RATIO = 0.95  # 整块压缩后仍大于原来的95%，按原始数据发送
+
+
+def compress_block(segments, codec):
+    """
+    压缩一个块，在进程池中调用
+
+    数据由工作进程自己从文件读取，不需要在进程间传递原始数据。
+    先用zlib最快档压缩一小段样本，已经压缩过的数据（图片、视频、压缩包）
+    直接判定为不可压缩，不浪费时间压缩整块。
+
+    Args:
+        segments (list): 块对应的文件段，[(文件路径, 段在文件中的偏移量, 段长度)]
+        codec (int): 压缩算法编号
+
+    Returns:
+        tuple: (实际使用的算法编号, 压缩后的数据)，按原始数据发送时数据为None，
+               由调用方按未压缩的块发送
+    """
+    data = read_segments(segments)
+    length = len(data)
+
+    sample = data[:SAMPLE_SIZE]
+    if len(zlib.compress(sample, 1)) > len(sample) * SAMPLE_RATIO:
+        return CODEC_RAW, None
+
+    if codec == CODEC_LZMA:
+        compressed = lzma.compress(data, preset=1)
+    else:
+        compressed = zlib.compress(data, 6)
+    if len(compressed) > length * BLOCK_RATIO:
+        return CODEC_RAW, None
+    return codec, compressed
+
+
+def decompress_block(codec, data):
+    """
+    解压一个块，zlib和lzma在解压时释放GIL，多个接收线程可以并行解压
+
+    Args:
+        codec (int): 压缩算法编号
+        data (bytes): 压缩后的数据
+
+    Raises:
+        ValueError: 未知的压缩算法
+
+    Returns:
+        bytes: 原始数据
+    """
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_LZMA:
+        return lzma.decompress(data)
+    raise ValueError(f"未知的压缩算法: {codec}")
+
+
+def default_workers():
+    """
+    压缩进程数
+
+    Returns:
+        int: CPU核数
+    """
+    return os.cpu_count() or 4
@@ -0,0 +1,227 @@
+import collections
+import mmap
+import os
+import random
+import re
+import struct
+import threading
+
+from integrity import DIGEST_SIZE, block_hasher
+
+MIN_CHUNK = 16 * 1024  # 内容定义分块的最小块，16KB
+MAX_CHUNK = 256 * 1024  # 最大块，256KB
+CHUNK = struct.Struct('!I')  # 块清单中每一项: 块长度，后面是块摘要
+CHUNK_ENTRY_SIZE = CHUNK.size + DIGEST_SIZE
+STORE_SIZE = 1024 * 1024 * 1024  # 块仓库默认上限，1GB
+
+
+def boundary_pattern():
+    """
+    生成块边界的匹配模式：连续4个字节分别落在4个固定的16字节集合中
+
+    对随机数据每个位置命中的概率是(16/256)^4 = 1/65536，平均每64KB一个边界。
+    边界只由附近4个字节的内容决定，文件中插入或删除数据后，其后的边界会重新对齐，
+    相同的内容因此切出相同的块，不同文件之间也能去重。用正则表达式在C层面扫描，
+    比逐字节计算滚动哈希快得多。集合由固定的种子生成，保证每次分块的结果相同。
+
+    Returns:
+        re.Pattern: 匹配模式
+    """
+    rnd = random.Random(0x46545258)
+    classes = []
+    for _ in range(4):
+        members = b''.join(re.escape(bytes([b])) for b in sorted(rnd.sample(range(256), 16)))
+        classes.append(b'[' + members + b']')
+    return re.compile(b''.join(classes))
+
+
+BOUNDARY = boundary_pattern()
+
+
+def chunk_file(path):
+    """
+    按内容定义分块并计算每块的摘要，由发送方在进程池中调用
+
+    Args:
+        path (str): 文件路径
+
+    Returns:
+        bytes: 块清单，依次排列的(块长度, 块摘要)
+    """
+    entries = bytearray()
+    size = os.path.getsize(path)
+    if not size:
+        return bytes(entries)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        start = 0
+        while start < size:
+            end = min(start + MAX_CHUNK, size)
+            match = BOUNDARY.search(m, start + MIN_CHUNK, end) if start + MIN_CHUNK < end else None
+            if match:
+                end = match.end()
+            hasher = block_hasher()
+            hasher.update(m[start:end])
+            entries += CHUNK.pack(end - start) + hasher.digest()
+            start = end
+    return bytes(entries)
+
+
+def parse_chunks(body):
+    """
+    解析块清单
+
+    Args:
+        body (bytes): 块清单
+
+    Raises:
+        Exception: 块清单格式错误
+
+    Returns:
+        list: [(偏移量, 长度, 摘要)]
+    """
+    if len(body) % CHUNK_ENTRY_SIZE:
+        raise Exception("块清单格式错误")
+    chunks = []
+    offset = 0
+    for i in range(0, len(body), CHUNK_ENTRY_SIZE):
+        (length,) = CHUNK.unpack_from(body, i)
+        chunks.append((offset, length, bytes(body[i + CHUNK.size:i + CHUNK_ENTRY_SIZE])))
+        offset += length
+    return chunks
+
+
+class ChunkStore:
+    """
+    接收方本地的内容寻址块仓库
+
+    每个块按摘要保存为一个文件，与来自哪个文件无关，因此不同文件中相同的内容只需下载一次。
+    文件的修改时间记录最近使用的时间，仓库超过上限时先删除最久未使用的块。
+    """
+
+    def __init__(self, root, max_size=STORE_SIZE):
+        """
+        Args:
+            root (str): 仓库目录
+            max_size (int): 仓库占用空间的上限，字节
+        """
+        self.root = root
+        self.max_size = max_size
+        self.entries = None  # 摘要 -> 块大小，按最近使用的顺序排列，第一次使用时才扫描目录
+        self.total_size = 0
+        self.lock = threading.Lock()
+
+    def path(self, digest):
+        """
+        块文件的路径，按摘要的前两个字符分目录，避免单个目录中文件过多
+
+        Args:
+            digest (bytes): 块摘要
+
+        Returns:
+            str: 路径
+        """
+        name = digest.hex()
+        return os.path.join(self.root, name[:2], name)
+
+    def load(self):
+        """扫描仓库目录，按修改时间恢复最近使用的顺序，调用方持有锁"""
+        if self.entries is not None:
+            return
+        found = []
+        if os.path.isdir(self.root):
+            for current, _, names in os.walk(self.root):
+                for name in names:
+                    try:
+                        digest = bytes.fromhex(name)
+                        stat = os.stat(os.path.join(current, name))
+                    except (ValueError, OSError):
+                        continue  # 临时文件或无关文件
+                    if len(digest) == DIGEST_SIZE:
+                        found.append((stat.st_mtime, digest, stat.st_size))
+        found.sort()
+        self.entries = collections.OrderedDict((digest, size) for _, digest, size in found)
+        self.total_size = sum(self.entries.values())
+
+    def __contains__(self, digest):
+        with self.lock:
+            self.load()
+            return digest in self.entries
+
+    def get(self, digest):
+        """
+        读取一个块并记为最近使用
+
+        Args:
+            digest (bytes): 块摘要
+
+        Returns:
+            bytes: 块数据，不存在或已损坏时为None
+        """
+        with self.lock:
+            self.load()
+            if digest not in self.entries:
+                return None
+            self.entries.move_to_end(digest)
+        path = self.path(digest)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            data = None
+        if data is not None:
+            hasher = block_hasher()
+            hasher.update(data)
+            if hasher.digest() == digest:
+                return data
+        self.discard(digest)  # 文件被删除或内容损坏
+        return None
+
+    def put(self, digest, data):
+        """
+        保存一个块，超过上限时淘汰最久未使用的块
+
+        Args:
+            digest (bytes): 块摘要，由调用方保证与数据一致
+            data (bytes): 块数据
+        """
+        with self.lock:
+            self.load()
+            if digest in self.entries:
+                self.entries.move_to_end(digest)
+                return
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)  # 其他进程不会读到写了一半的块
+        with self.lock:
+            self.entries[digest] = len(data)
+            self.total_size += len(data)
+            stale = []
+            while self.total_size > self.max_size and len(self.entries) > 1:
+                old, size = self.entries.popitem(last=False)
+                self.total_size -= size
+                stale.append(old)
+        for old in stale:
+            try:
+                os.remove(self.path(old))
+            except OSError:
+                pass
+
+    def discard(self, digest):
+        """
+        从仓库中删除一个块
+
+        Args:
+            digest (bytes): 块摘要
+        """
+        with self.lock:
+            size = self.entries.pop(digest, None)
+            if size is not None:
+                self.total_size -= size
+        try:
+            os.remove(self.path(digest))
+        except OSError:
+            pass
@@ -0,0 +1,189 @@
+import array
+import itertools
+import mmap
+import operator
+import os
+
+from integrity import block_hasher, DIGEST_SIZE
+
+MOD = 1 << 16  # 弱校验和的模，与rsync相同
+SIG_ENTRY_SIZE = 4 + DIGEST_SIZE  # 每个块的签名：4字节弱校验和 + 强摘要
+SCAN_SPAN = 4 << 20  # 每次批量计算弱校验和的窗口位置数的上限，没有命中时从一个块逐次翻倍
+MAX_BLOCK_SIZE = 4 * 1024 * 1024  # 签名块大小的上限，前缀和数组每项8字节，长度为批量加上块大小，更大的块不做匹配
+EXACT_LIMIT = 1 << 20  # 把弱校验和的a展开成所有可能的原值时集合大小的上限，省去每个位置的取模
+PROBE_SIZE = 32 * 1024 * 1024  # 至少扫描这么多数据之后才判断是否放弃匹配
+MAX_LITERAL_RATIO = 0.8  # 已扫描部分的字面数据超过这个比例时放弃匹配，剩余部分整体作为字面数据发送
+
+
+def weak_checksum(data):
+    """
+    计算rsync风格的弱校验和
+
+    a为所有字节之和，b为各字节按其到块尾的距离加权之和，
+    等于前缀和之和，因此可以用accumulate在C层面完成
+
+    Args:
+        data (bytes): 数据块
+
+    Returns:
+        tuple: (a, b)
+    """
+    return sum(data) % MOD, sum(itertools.accumulate(data)) % MOD
+
+
+def file_signature(path, block_size):
+    """
+    计算已有文件每个完整块的签名，由接收方调用
+
+    Args:
+        path (str): 已有文件路径
+        block_size (int): 块大小
+
+    Returns:
+        bytes: 依次排列的块签名
+    """
+    signature = bytearray()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if len(data) < block_size:
+                break  # 不足一个块的尾部不参与匹配
+            a, b = weak_checksum(data)
+            hasher = block_hasher()
+            hasher.update(data)
+            signature += (a | (b << 16)).to_bytes(4, 'big') + hasher.digest()
+    return bytes(signature)
+
+
+def parse_signature(signature):
+    """
+    把签名解析成按弱校验和查找的索引
+
+    Args:
+        signature (bytes): 接收方发来的块签名
+
+    Raises:
+        Exception: 签名长度不正确
+
+    Returns:
+        dict: 弱校验和 -> [(强摘要, 块号)]
+    """
+    if len(signature) % SIG_ENTRY_SIZE:
+        raise Exception("增量签名格式错误")
+    index = {}
+    for i in range(len(signature) // SIG_ENTRY_SIZE):
+        entry = signature[i * SIG_ENTRY_SIZE:(i + 1) * SIG_ENTRY_SIZE]
+        index.setdefault(int.from_bytes(entry[:4], 'big'), []).append((entry[4:], i))
+    return index
+
+
+def delta_ops(path, index, block_size):
+    """
+    用弱校验和在源文件中查找接收方已有的块，生成重建指令，由发送方调用
+
+    窗口逐字节滑动，但不在Python循环中逐字节更新：每批取若干个窗口位置，用accumulate在C层面
+    求出前缀和S，位置p的a等于S[p+块大小]-S[p]，先按a筛掉绝大多数位置，只对剩下的候选从上一个
+    候选滚动求出b（区间求和也在C层面完成）、查索引并用强摘要确认。命中时窗口跳过整个块，下一个位置先单独检查，
+    连续相同的块不必批量计算；没有命中时批量逐次翻倍。扫描过PROBE_SIZE后字面数据仍超过
+    MAX_LITERAL_RATIO时放弃匹配，剩余部分直接作为字面数据，几乎没有相同块的文件不会比完整发送更慢。
+    字面数据只记录在源文件中的位置，发送时再读取。
+
+    Args:
+        path (str): 源文件路径
+        index (dict): parse_signature返回的索引
+        block_size (int): 块大小
+
+    Returns:
+        list: 指令列表，('C', 起始块号, 块数)表示复制接收方已有的连续块，
+              ('L', 偏移量, 长度)表示发送源文件中的一段字面数据
+    """
+    ops = []
+    copied = 0
+
+    def add_literal(start, end):
+        if end > start:
+            ops.append(('L', start, end - start))
+
+    def add_copy(block):
+        nonlocal copied
+        copied += block_size
+        # 相邻的复制指令合并为一条
+        if ops and ops[-1][0] == 'C' and ops[-1][1] + ops[-1][2] == block:
+            ops[-1] = ('C', ops[-1][1], ops[-1][2] + 1)
+        else:
+            ops.append(('C', block, 1))
+
+    def find_block(m, offset, a, b):
+        # 弱校验和命中后用强摘要确认，返回接收方的块号
+        candidates = index.get((a % MOD) | ((b % MOD) << 16))
+        if not candidates:
+            return None
+        hasher = block_hasher()
+        hasher.update(m[offset:offset + block_size])
+        strong = hasher.digest()
+        return next((i for digest, i in candidates if digest == strong), None)
+
+    size = os.path.getsize(path)
+    if not index or size < block_size or block_size > MAX_BLOCK_SIZE:
+        add_literal(0, size)
+        return ops
+
+    a_values = {key & (MOD - 1) for key in index}
+    reps = 255 * block_size // MOD + 1  # 每个a的低16位对应的原值个数
+    if len(a_values) * reps <= EXACT_LIMIT:
+        exact = {a + k * MOD for a in a_values for k in range(reps)}
+        wanted = lambda diffs: map(exact.__contains__, diffs)  # noqa: E731
+    else:
+        wanted = lambda diffs: map(a_values.__contains__,  # noqa: E731
+                                   map(operator.and_, diffs, itertools.repeat(MOD - 1)))
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        pos = 0  # 下一个要检查的窗口位置
+        literal_start = 0
+        span = block_size
+        while pos + block_size <= size:
+            if pos == literal_start:
+                # 文件开头或刚命中一个块：先检查这一个位置，连续相同的块不需要批量计算
+                block = find_block(m, pos, *weak_checksum(m[pos:pos + block_size]))
+                if block is not None:
+                    add_copy(block)
+                    pos = literal_start = pos + block_size
+                    span = block_size
+                    continue
+                pos += 1
+                if pos + block_size > size:
+                    break
+
+            count = min(span, size - block_size + 1 - pos)  # 本批检查的窗口位置数
+            data = m[pos:pos + count + block_size - 1]
+            sums = array.array('q', itertools.accumulate(data, initial=0))
+            view = memoryview(sums)  # 切片不复制
+            previous = None  # 上一个候选的(位置, b)，下一个候选的b从它滚动得到
+            found = None
+            for r in itertools.compress(range(count), wanted(map(operator.sub, view[block_size:], view[:count]))):
+                a = sums[r + block_size] - sums[r]
+                if previous is None:
+                    # b等于窗口内各位置的前缀和之和: Σ(S[r+1..r+块大小]) - 块大小 * S[r]
+                    b = sum(view[r + 1:r + block_size + 1]) - block_size * sums[r]
+                else:
+                    # 从上一个候选p逐字节滚动到r: b(r) = b(p) - 块大小 * (S[r]-S[p]) + Σa(p+1..r)
+                    p, b = previous
+                    b += (sum(view[p + block_size + 1:r + block_size + 1]) - sum(view[p + 1:r + 1])
+                          - block_size * (sums[r] - sums[p]))
+                previous = (r, b)
+                found = find_block(m, pos + r, a, b)
+                if found is not None:
+                    add_literal(literal_start, pos + r)
+                    add_copy(found)
+                    pos = literal_start = pos + r + block_size
+                    span = block_size
+                    break
+            if found is not None:
+                continue
+            pos += count
+            span = min(span * 2, SCAN_SPAN)
+            if pos >= PROBE_SIZE and pos - copied > MAX_LITERAL_RATIO * pos:
+                break  # 相同的块太少，放弃匹配
+
+        add_literal(literal_start, size)
+    return ops
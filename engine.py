@@ -0,0 +1,1621 @@
+import asyncio
+import collections
+import contextlib
+import errno
+import os
+import itertools
+import mmap
+import multiprocessing
+import secrets
+import socket
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from blockmap import bitmap_blocks
+from cache import BlockCache
+from compression import CODEC_LZMA, CODEC_RAW, CODEC_ZLIB, CODECS, compress_block, default_workers
+from dedup import chunk_file
+from delta import delta_ops, parse_signature
+from integrity import hash_file_range, hash_segments
+from metrics import Metrics
+from pipeline import RING_SLOTS, ReadAhead
+from progress import format_size
+from protocol import (BLOCK, CAP_DEDUP, CAP_DELTA, CAP_FAILOVER, CAP_LZMA, CAP_PERSIST, CAP_SPARSE, CAP_SWARM, CAP_TREE,
+                      CAP_TUNE, CAP_UDP, CAP_VERIFY, CAP_ZLIB, COPY, DELTA, DIGEST, MSG_ANNOUNCE, MSG_BLOCK, MSG_BYE,
+                      MSG_CHUNKS, MSG_CHUNKS_REQUEST, MSG_COMMIT, MSG_COPY, MSG_CTRL, MSG_DATA, MSG_DELTA, MSG_DIGEST,
+                      MSG_END, MSG_ERROR, MSG_EXTENTS, MSG_FILE_DIGEST, MSG_HAVE, MSG_LITERAL, MSG_MANIFEST,
+                      MSG_MANIFEST_REQUEST, MSG_PEER, MSG_PIECES, MSG_READY, MSG_SWARM, MSG_TUNE, MSG_UDP, MSG_VERDICT,
+                      PORT, READY, TUNE, VERDICT, FileInfo, frame_header, pack_frame, pack_info, pack_peers,
+                      parse_hello, read_frame)
+from ratelimit import BandwidthScheduler, Share
+from sparse import ExtentMap, data_extents
+from swarm import BlockSource, Member, Tracker, serve_blocks
+from tree import Tree, read_segments
+from tuning import (AUTO_STREAMS, START_STREAMS, TUNE_INTERVAL, StreamTuner, apply_buffer, buffer_for,
+                    current_buffer)
+from udp import Injector, UdpSender
+
+CODEC_CAPS = {CODEC_ZLIB: CAP_ZLIB, CODEC_LZMA: CAP_LZMA}  # 压缩算法需要客户端具备的能力
+REPLACE_TIMEOUT = 30.0  # 数据连接中断后等待客户端建立替代连接的秒数
+
+
+def connection_lost(error):
+    """
+    判断异常是否由连接中断或网络超时引起，发送路径会把这些异常转换成带中文消息的Exception，
+    原来的异常保存在__context__中
+
+    Args:
+        error (BaseException): 异常
+
+    Returns:
+        bool: 由连接中断或网络超时引起
+    """
+    while error is not None:
+        if isinstance(error, (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError)):
+            return True
+        error = error.__context__
+    return False
+
+
+class Session:
+    """
+    一个客户端的传输会话，保存该客户端控制连接和所有数据连接共享的状态
+
+    持久会话依次传输多个文件，连接和调优的结果在文件之间保留，与单个文件有关的状态由open_file重置
+    """
+
+    def __init__(self, session_id, file_path, thread_count, chunk_size, zero_copy, verify, codec,
+                 socket_buffer, send_buffer_size, use_mmap):
+        self.session_id = session_id
+        self.chunk_size = chunk_size
+        self.auto_tune = thread_count == AUTO_STREAMS  # 自动调优：先用少量连接，按实测吞吐量增减
+        self.thread_count = START_STREAMS if self.auto_tune else thread_count  # 预期的数据连接总数
+        self.stream_limit = self.thread_count  # 同时发送的连接数上限，自动调优减少连接时降低
+        self.streams = 0  # 正在发送块的连接数
+        self.socket_buffer = socket_buffer  # 数据连接的套接字缓冲区，0表示系统默认值
+        self.pinned_buffer = socket_buffer > 0  # 手动指定了缓冲区时，自动调优不再修改
+        self.send_buffer_size = send_buffer_size  # 回退路径每次读取的大小
+        self.rtt = 0.0  # 客户端测得的往返时延，秒
+        self.rate = 0.0  # 自动调优测得的最高吞吐量，字节/秒
+        self.writers = []  # 数据连接的写入流，调整缓冲区时使用
+        self.client_caps = 0  # 客户端声明支持的能力位
+        self.caps = 0  # 与客户端协商后使用的能力位，每个文件重新协商
+        self.share = None  # 在带宽调度器中的份额，由引擎按当前的限速设置创建
+        self.zero_copy = zero_copy
+        self.mmap_enabled = use_mmap
+        self.verify = verify  # 是否为每个块附加摘要，由客户端校验
+        self.codec = codec  # 压缩算法编号，CODEC_RAW表示不压缩
+        self.persistent = False  # 持久会话：传输完一个文件后保持所有连接，继续发送队列中的文件
+        self.job_index = 0  # 持久会话下一个要发送的任务在引擎发送队列中的位置
+        self.generation = 0  # 已开始传输的文件数，数据连接据此等待下一个文件
+        self.file_started = asyncio.Condition()  # 开始传输新文件或会话结束时通知数据连接
+        self.closed = False
+        self.joined = 0  # 已加入的数据连接数，数据连接中断后减一，空出的位置留给替代连接
+        self.all_joined = asyncio.Event()
+        self.next_conn_id = 0  # 下一个数据连接的ID，替代连接使用新的ID
+        self.vacancy = asyncio.Condition()  # 数据连接中断、空出位置时通知等待加入的替代连接
+        self.error = None
+        self.open_file(file_path)
+
+    def open_file(self, file_path):
+        """
+        切换到要发送的文件或目录，重置与单个文件有关的状态
+
+        Args:
+            file_path (str): 文件或目录路径
+        """
+        self.file_path = file_path
+        self.file_name = os.path.basename(os.path.normpath(file_path))
+        self.extents = None  # 稀疏文件的数据区间，文件没有空洞或客户端不支持时为None
+        if os.path.isdir(file_path):
+            # 目录按虚拟文件传输，块在虚拟文件中的偏移量通过tree映射到各个文件
+            self.tree = Tree.scan(file_path)
+            self.file_size = self.tree.total_size
+            self.version = self.tree.version()
+        else:
+            self.tree = None
+            stat = os.stat(file_path)
+            self.file_size = stat.st_size
+            self.version = str(stat.st_mtime_ns)  # 文件版本，客户端据此判断断点续传的位图是否仍然有效
+            if getattr(stat, 'st_blocks', 0) * 512 < stat.st_size:
+                # 占用的磁盘空间小于文件大小，可能有空洞，再逐个查找数据区间
+                extents = ExtentMap(data_extents(file_path, self.file_size))
+                if extents.data_size < self.file_size:
+                    self.extents = extents
+        self.udp_port = None  # 客户端选择可靠UDP传输时接收数据报的端口
+        self.use_mmap = self.mmap_enabled and not self.tree and self.file_size > 0  # 目录和空文件不使用内存映射
+        self.mapping = None  # 源文件的只读映射
+        self.view = None  # 映射的memoryview，发送时直接切片
+        self.retries = {}  # 校验失败后重传的块，偏移量 -> 重传次数
+        self.failovers = 0  # 当前文件中断过的数据连接数
+        self.compressed = {}  # 提前提交的压缩任务，偏移量 -> Future
+        self.wire_bytes = 0  # 块数据实际占用的网络字节数
+        self.total_sent = 0
+        # 会话内所有数据连接共享的块队列，元素为(偏移量, 长度)
+        # 只在事件循环线程中访问，不需要加锁
+        self.blocks = collections.deque()
+        self.finished = 0  # 已完成当前文件的数据连接数
+        self.done = asyncio.Event()
+
+    def segments(self, offset, length):
+        """
+        块对应的文件段
+
+        Args:
+            offset (int): 块的开始位置
+            length (int): 块大小
+
+        Returns:
+            list: [(文件路径, 段在文件中的偏移量, 段长度)]，单个文件时只有一段
+        """
+        if self.tree:
+            return self.tree.segments(offset, length)
+        return [(self.file_path, offset, length)]
+
+    def open_mapping(self):
+        """
+        只读映射源文件，并提示内核按顺序预读
+
+        Raises:
+            OSError: 文件无法映射
+            ValueError: 文件无法映射（例如大小超出地址空间）
+        """
+        with open(self.file_path, 'rb') as f:
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.mapping.madvise(mmap.MADV_SEQUENTIAL)
+        self.view = memoryview(self.mapping)
+
+    def will_need(self, offset, length):
+        """
+        提示内核提前读入即将发送的区间，多个连接同时发送不同区间时也能预读
+
+        Args:
+            offset (int): 区间起始位置
+            length (int): 区间长度
+        """
+        if self.mapping is not None and hasattr(mmap, 'MADV_WILLNEED'):
+            start = offset - offset % mmap.PAGESIZE  # madvise要求起始位置按页对齐
+            self.mapping.madvise(mmap.MADV_WILLNEED, start, offset + length - start)
+
+    def close_mapping(self):
+        """释放源文件的映射"""
+        if self.mapping is None:
+            return
+        self.view.release()
+        try:
+            self.mapping.close()
+        except BufferError:
+            pass  # 传输层仍引用着切片，映射在切片释放后由垃圾回收关闭
+        self.mapping = self.view = None
+
+    def plan_blocks(self, needed=None):
+        """
+        根据客户端需要的块生成块队列
+
+        Args:
+            needed (bytes): 客户端缺失块的位图，为空表示需要所有块
+
+        Raises:
+            Exception: 位图长度与文件不匹配
+        """
+        block_count = (self.file_size + self.chunk_size - 1) // self.chunk_size
+        if not needed:
+            indexes = range(block_count)
+        elif len(needed) != (block_count + 7) // 8:
+            raise Exception("续传位图与文件不匹配")
+        else:
+            indexes = list(bitmap_blocks(needed, block_count))
+
+        for index in indexes:
+            offset = index * self.chunk_size
+            length = min(self.chunk_size, self.file_size - offset)
+            if self.extents:
+                # 稀疏文件：只发送块中的数据部分，整块都是空洞时客户端保留空洞即可
+                span = self.extents.span(offset, length)
+                if span is None:
+                    continue
+                offset, length = span
+            self.blocks.append((offset, length))
+        # 客户端已有的数据直接计入进度
+        self.total_sent = self.file_size - sum(length for _, length in self.blocks)
+
+
+class ServerEngine:
+    """
+    基于asyncio的发送引擎
+
+    一个事件循环持续监听端口，同时为多个客户端服务。每个控制连接创建一个会话，
+    数据连接通过问候消息中的会话ID加入对应的会话，不同客户端的连接不会混在一起。
+    """
+
+    def __init__(self, host='0.0.0.0', port=9999, on_log=None, on_progress=None,
+                 on_session_end=None, on_started=None):
+        """
+        Args:
+            host (str): 监听地址
+            port (int): 监听端口
+            on_log (callable): 日志回调，参数为日志消息
+            on_progress (callable): 进度回调，参数为会话
+            on_session_end (callable): 会话结束回调，参数为会话
+            on_started (callable): 开始监听后的回调
+        """
+        self.host = host
+        self.port = port
+        self.on_log = on_log
+        self.on_progress = on_progress
+        self.on_session_end = on_session_end
+        self.on_started = on_started
+
+        # 新会话使用的设置，运行期间可以修改，只影响之后建立的会话
+        self.file_path = None
+        self.thread_count = 1
+        self.zero_copy = True
+        self.verify = True
+        self.compression = None  # 压缩算法名称，'zlib'或'lzma'，None表示不压缩
+        self.compress_workers = default_workers()
+        self.max_retries = 3  # 每个块校验失败后最多重传的次数
+        self.max_failovers = 3  # 每个文件最多允许中断的数据连接数，未确认的块交给其他连接或替代连接
+        self.chunk_size = 1024 * 1024  # 每个块1MB，各数据连接按块动态领取
+        self.send_buffer_size = 64 * 1024  # 回退路径的发送缓冲区大小，64KB
+        self.read_ahead = RING_SLOTS  # 回退路径每个连接预读的缓冲区个数，0表示读一块发一块
+        self.use_mmap = False  # 是否映射源文件，直接发送映射的切片
+        self.cache_size = 0  # 块缓存的内存上限，字节，0表示不缓存块，运行期间通过set_cache_size修改
+        self.socket_buffer_size = 0  # 数据连接的套接字缓冲区，0表示系统默认值，自动调优时按带宽时延积计算
+        self.progress_step = 1024 * 1024  # 每发送1MB更新一次进度
+        # 限速设置，字节/秒，0表示不限速，运行期间通过set_rate_limits修改，正在进行的传输立即生效
+        self.rate_limit = 0  # 所有会话合计的上限
+        self.session_rate_limit = 0  # 每个会话的上限
+        self.session_weight = 1  # 新会话的权重，带宽不足时各会话按权重比例分配
+        self.scheduler = BandwidthScheduler()  # 所有数据连接共享的带宽调度器
+        # 可靠UDP传输，由客户端选择；丢包率和单向附加时延用于在回环地址上模拟有损的长距离链路
+        self.allow_udp = True
+        self.udp_loss = 0.0
+        self.udp_delay = 0.0
+        # 持久会话：客户端支持时，一个文件传输完成后保持所有连接，继续发送队列中的文件
+        self.keep_alive = False
+        self.jobs = []  # 发送队列，持久会话先发送file_path，再依次发送队列中的文件
+        self.idle_timeout = 30.0  # 队列已空时持久会话等待新任务的秒数
+        self.jobs_added = asyncio.Event()
+        # P2P分发：接收方之间互相交换块，服务器作为种子和tracker，上行带宽不随接收方数量线性增长
+        self.swarm = False
+        self.trackers = {}  # (文件路径, 文件版本) -> 创建Tracker的任务，同一版本的文件只计算一次块摘要
+
+        self.metrics = Metrics()  # 每个连接的传输统计
+        self.metrics_path = None  # 定期导出统计的文件，.prom为Prometheus格式，其他为JSON行
+        self.metrics_interval = 5.0  # 导出间隔，秒
+
+        self.sessions = {}
+        self.loop = None
+        self.server = None
+        # 计算块摘要的线程池，hashlib释放GIL，摘要与发送并行进行
+        self.hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix='hash')
+        # 压缩和分块是CPU密集型任务，使用进程池才能利用多个核，第一次需要时才创建
+        self.cpu_pool = None
+        # 最近计算过的块清单，(文件路径, 文件版本) -> 块清单，多个客户端下载同一文件时不必重新分块
+        self.chunk_lists = collections.OrderedDict()
+        self.max_chunk_lists = 16
+        # 所有会话共享的块缓存和文件元数据缓存，热门文件的块直接从内存发送
+        self.block_cache = BlockCache(self.cache_size)
+        self.metrics.cache = self.block_cache
+
+    def log(self, message):
+        """
+        记录日志
+
+        Args:
+            message (str): 日志消息
+        """
+        if self.on_log:
+            self.on_log(message)
+
+    def report_sent(self, session, size, stats=None):
+        """
+        累加会话已发送字节数并通知进度
+
+        Args:
+            session (Session): 会话
+            size (int): 本次新发送的字节数
+            stats (ConnectionStats): 发送该数据的连接的统计
+        """
+        session.total_sent += size
+        if stats is not None:
+            stats.add(size)
+        if self.on_progress:
+            self.on_progress(session)
+
+    def run(self):
+        """在当前线程中运行事件循环，直到调用stop"""
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.hash_pool.shutdown(wait=False)
+            if self.cpu_pool:
+                self.cpu_pool.shutdown(wait=False, cancel_futures=True)
+
+    def stop(self):
+        """停止监听，可以从其他线程调用"""
+        if self.loop and self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def serve(self):
+        """
+        监听端口并持续接受连接
+
+        Raises:
+            Exception: 端口已被占用
+        """
+        self.loop = asyncio.get_running_loop()
+        self.scheduler.set_rate(self.rate_limit)
+        self.block_cache.resize(self.cache_size)
+        try:
+            self.server = await asyncio.start_server(
+                self.handle_connection, self.host, self.port, reuse_address=True
+            )
+        except OSError as e:
+            if e.errno == errno.EADDRINUSE:  # 地址已被使用
+                raise Exception(f"端口{self.port}已被占用，请关闭其他服务器实例")
+            raise
+
+        self.log("服务器已启动，等待客户端连接...")
+        if self.on_started:
+            self.on_started()
+        exporter = asyncio.create_task(self.export_metrics()) if self.metrics_path else None
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if exporter:
+                exporter.cancel()
+                self.write_metrics()  # 停止前导出最终的统计
+        self.log("服务器已停止")
+
+    def set_rate_limits(self, rate_limit, session_rate_limit):
+        """
+        修改全局和每个会话的速率上限，正在进行的会话也立即生效，可以从其他线程调用
+
+        Args:
+            rate_limit (int): 所有会话合计的上限，字节/秒，0表示不限速
+            session_rate_limit (int): 每个会话的上限，字节/秒，0表示不限速
+        """
+        self.rate_limit = rate_limit
+        self.session_rate_limit = session_rate_limit
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.apply_rate_limits)
+        else:
+            self.apply_rate_limits()
+
+    def set_cache_size(self, cache_size):
+        """
+        修改块缓存的内存上限，超出的块立即淘汰，可以从其他线程调用
+
+        Args:
+            cache_size (int): 内存上限，字节，0表示不缓存块
+        """
+        self.cache_size = cache_size
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.block_cache.resize, cache_size)
+        else:
+            self.block_cache.resize(cache_size)
+
+    def set_session_share(self, session_id, rate_limit=None, weight=None):
+        """
+        单独调整一个会话的速率上限和权重，可以从其他线程调用
+
+        Args:
+            session_id (str): 会话ID
+            rate_limit (int): 该会话的上限，字节/秒，0表示不限速，None表示不修改
+            weight (int): 该会话的权重，None表示不修改
+        """
+        def apply():
+            session = self.sessions.get(session_id)
+            if session is None:
+                return
+            if rate_limit is not None:
+                session.share.bucket.set_rate(rate_limit)
+            if weight is not None:
+                session.share.weight = max(weight, 1)
+
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(apply)
+        else:
+            apply()
+
+    def apply_rate_limits(self):
+        """在事件循环线程中把限速设置应用到调度器和所有会话"""
+        self.scheduler.set_rate(self.rate_limit)
+        for session in self.sessions.values():
+            session.share.bucket.set_rate(self.session_rate_limit)
+        self.log(f"限速: 总计{format_size(self.rate_limit) + '/s' if self.rate_limit else '不限'}, "
+                 f"每个会话{format_size(self.session_rate_limit) + '/s' if self.session_rate_limit else '不限'}")
+
+    async def export_metrics(self):
+        """按metrics_interval定期把统计导出到metrics_path，写文件在线程池中进行"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            await loop.run_in_executor(None, self.write_metrics)
+
+    def write_metrics(self):
+        """把统计导出到metrics_path，失败时只记录日志"""
+        try:
+            self.metrics.export(self.metrics_path)
+        except OSError as e:
+            self.log(f"导出统计失败: {str(e)}")
+
+    async def handle_connection(self, reader, writer):
+        """
+        处理新连接：根据问候消息区分控制连接和数据连接
+
+        Args:
+            reader (asyncio.StreamReader): 读取流
+            writer (asyncio.StreamWriter): 写入流
+        """
+        try:
+            try:
+                msg_type, _, body = await asyncio.wait_for(read_frame(reader), 60)
+                caps, session_id = parse_hello(body)
+            except ValueError as e:
+                writer.write(pack_frame(MSG_ERROR, str(e).encode()))  # 告诉对方原因，例如协议版本不一致
+                raise Exception(f"拒绝连接: {str(e)}")
+            if msg_type == MSG_CTRL:
+                await self.handle_control(reader, writer, caps)
+            elif msg_type == MSG_DATA:
+                await self.handle_data(reader, writer, session_id)
+            elif msg_type == MSG_SWARM:
+                await self.handle_swarm(reader, writer)
+            elif msg_type == MSG_PEER:
+                await self.handle_peer(reader, writer, session_id)
+            else:
+                self.log("收到未知类型的连接，已关闭")
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            self.log("连接未发送有效的问候消息，已关闭")
+        except asyncio.CancelledError:
+            pass  # 服务器停止时仍未结束的连接被取消，正常关闭即可，常驻进程收到信号退出时不输出异常
+        except Exception as e:
+            self.log(f"错误: {str(e)}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def handle_control(self, reader, writer, caps):
+        """
+        处理控制连接：创建会话，逐个发送文件
+
+        客户端支持且服务器开启了持久会话时，传输完一个文件后保持控制连接和数据连接，
+        接着发送队列中的下一个文件，已经增长的拥塞窗口和调优结果留给之后的文件使用，
+        队列已空并等待idle_timeout秒仍没有新任务时结束会话
+
+        Args:
+            reader (asyncio.StreamReader): 读取流
+            writer (asyncio.StreamWriter): 写入流
+            caps (int): 客户端声明支持的能力位
+
+        Raises:
+            Exception: 没有可发送的文件
+        """
+        if not self.file_path or not os.path.exists(self.file_path):
+            raise Exception("没有可发送的文件或目录")
+
+        # 能力协商：只使用客户端也支持的功能
+        codec = CODECS.get(self.compression, CODEC_RAW)
+        if not caps & CODEC_CAPS.get(codec, 0):
+            codec = CODEC_RAW
+        thread_count = self.thread_count
+        if thread_count == AUTO_STREAMS and not caps & CAP_TUNE:
+            thread_count = START_STREAMS
+        session = Session(secrets.token_hex(4), self.file_path, thread_count,
+                          self.chunk_size, self.zero_copy, self.verify and bool(caps & CAP_VERIFY),
+                          codec, self.socket_buffer_size, self.send_buffer_size, self.use_mmap)
+        session.share = Share(self.session_rate_limit, self.session_weight)
+        session.client_caps = caps
+        session.persistent = self.keep_alive and bool(caps & CAP_PERSIST)
+        if session.codec != CODEC_RAW:
+            self.ensure_cpu_pool()
+        self.sessions[session.session_id] = session
+        self.log(f"会话{session.session_id}: 客户端已连接{'，持久会话' if session.persistent else ''}")
+        try:
+            while await self.send_file(session, reader, writer) and session.persistent:
+                file_path = await self.next_job(session)
+                if file_path is None:
+                    writer.write(pack_frame(MSG_BYE))
+                    await writer.drain()
+                    self.log(f"会话{session.session_id}: 发送队列已空，会话结束")
+                    break
+                for future in session.compressed.values():
+                    future.cancel()
+                session.close_mapping()
+                session.open_file(file_path)
+        except Exception as e:
+            session.error = e
+            self.log(f"会话{session.session_id}: 传输出错：{str(e)}")
+        finally:
+            for future in session.compressed.values():
+                future.cancel()
+            session.close_mapping()
+            # 通知等待下一个文件的数据连接退出
+            session.closed = True
+            async with session.file_started:
+                session.file_started.notify_all()
+            del self.sessions[session.session_id]
+            if self.on_session_end:
+                self.on_session_end(session)
+
+    async def send_file(self, session, reader, writer):
+        """
+        在会话中发送当前文件：发送文件信息，完成握手，再按协商的方式发送数据
+
+        Args:
+            session (Session): 会话
+            reader (asyncio.StreamReader): 控制连接的读取流
+            writer (asyncio.StreamWriter): 控制连接的写入流
+
+        Raises:
+            Exception: 客户端不支持目录传输
+            Exception: 确认消息格式错误
+            Exception: 等待数据连接超时
+
+        Returns:
+            bool: 文件发送完成，客户端取消接收时为False
+        """
+        caps = session.client_caps
+        session.caps = caps & ((CAP_VERIFY if session.verify else 0) | CODEC_CAPS.get(session.codec, 0) | CAP_DELTA
+                               | (CAP_TREE if session.tree else 0) | (CAP_TUNE if session.auto_tune else 0)
+                               | (CAP_SPARSE if session.extents else 0)
+                               | (CAP_DEDUP if not session.tree and not session.extents else 0)
+                               | (CAP_UDP if self.allow_udp else 0) | (CAP_PERSIST if session.persistent else 0)
+                               | (CAP_FAILOVER if session.thread_count > 1 else 0))
+        if not session.caps & CAP_SPARSE:
+            session.extents = None  # 客户端不支持时照常发送空洞中的零
+        if session.tree and not caps & CAP_TREE:
+            writer.write(pack_frame(MSG_ERROR, "客户端不支持目录传输".encode()))
+            raise Exception("客户端不支持目录传输")
+        if session.use_mmap:
+            try:
+                session.open_mapping()
+            except (OSError, ValueError) as e:
+                self.log(f"会话{session.session_id}: 无法映射文件，改为普通读取: {str(e)}")
+
+        # 发送文件信息，能力位是协商后双方都支持的功能
+        writer.write(pack_info(FileInfo(
+            session.file_size, session.chunk_size, session.socket_buffer, session.caps, session.thread_count,
+            session.tree is not None, session.session_id, session.file_name, session.version
+        )))
+        if session.extents:
+            writer.write(pack_frame(MSG_EXTENTS, session.extents.pack()))
+            self.log(f"会话{session.session_id}: 稀疏文件，数据{format_size(session.extents.data_size)}，"
+                     f"空洞{format_size(session.file_size - session.extents.data_size)}不发送")
+        await writer.drain()
+        if session.persistent:
+            self.log(f"会话{session.session_id}: 开始发送{session.file_name}")
+
+        # 等待客户端确认：READY附带客户端缺失块的位图，
+        # DELTA表示客户端已有旧版本文件，附带旧文件的块签名，
+        # 传输目录时客户端先请求目录清单
+        try:
+            while True:
+                msg_type, _, body = await read_frame(reader)
+                if msg_type == MSG_MANIFEST_REQUEST and session.tree:
+                    writer.write(pack_frame(MSG_MANIFEST, session.tree.manifest()))
+                    await writer.drain()
+                    continue
+                if msg_type == MSG_CHUNKS_REQUEST and session.caps & CAP_DEDUP:
+                    writer.write(pack_frame(MSG_CHUNKS, await self.chunk_list(session)))
+                    await writer.drain()
+                    continue
+                if msg_type == MSG_HAVE and session.caps & CAP_DEDUP:
+                    # 客户端已从本地块仓库组装出这些区间，只发送其余部分
+                    have = ExtentMap.parse(body)
+                    session.extents = ExtentMap([(0, session.file_size)]).without(have.extents)
+                    self.log(f"会话{session.session_id}: 客户端本地已有"
+                             f"{format_size(session.file_size - session.extents.data_size)}，不再发送")
+                    continue
+                if msg_type == MSG_UDP and session.caps & CAP_UDP:
+                    (session.udp_port,) = PORT.unpack(body)
+                    continue
+                if msg_type == MSG_READY:
+                    (rtt,) = READY.unpack_from(body)
+                    session.rtt = rtt / 1000000  # 客户端测得的往返时延，微秒
+                    needed = body[READY.size:]
+                elif msg_type == MSG_DELTA and session.caps & CAP_DELTA and not session.tree:
+                    (delta_block_size,) = DELTA.unpack_from(body)
+                    signature = body[DELTA.size:]
+                else:
+                    raise ValueError
+                break
+        except asyncio.IncompleteReadError:
+            self.log(f"会话{session.session_id}: 客户端取消接收")
+            return False
+        except (ValueError, struct.error):
+            raise Exception("确认消息格式错误")
+
+        if msg_type == MSG_DELTA:
+            # 增量传输只使用控制连接
+            await self.send_delta(session, writer, signature, delta_block_size)
+        else:
+            session.plan_blocks(needed)
+            if needed:
+                self.log(f"会话{session.session_id}: 断点续传，跳过已接收的{format_size(session.total_sent)}")
+
+            if session.udp_port:
+                # 可靠UDP传输，控制连接只传输块确认和校验结果，不建立数据连接
+                await self.send_udp(session, reader, writer)
+            elif session.thread_count == 1:
+                # 单连接传输，直接使用控制连接
+                await self.send_blocks(session, reader, writer, 0)
+            else:
+                # 通知数据连接开始发送，持久会话中已建立的数据连接正在等待下一个文件
+                async with session.file_started:
+                    session.generation += 1
+                    session.file_started.notify_all()
+                try:
+                    await asyncio.wait_for(session.all_joined.wait(), 60)
+                except asyncio.TimeoutError:
+                    raise Exception("等待数据连接超时")
+                tuner = asyncio.create_task(self.auto_tune(session, writer)) if session.auto_tune else None
+                try:
+                    await session.done.wait()
+                finally:
+                    if tuner:
+                        tuner.cancel()
+                if session.persistent and session.error is None:
+                    # 控制连接保持打开，用结束标记告诉客户端这个文件的所有数据连接都已完成
+                    writer.write(pack_frame(MSG_END))
+                    await writer.drain()
+
+        if session.error:
+            raise session.error
+        if session.codec != CODEC_RAW:
+            self.log(f"会话{session.session_id}: 压缩后实际发送{format_size(session.wire_bytes)}")
+        if session.auto_tune:
+            # 报告自动调优选定的设置，之后可以在界面上固定使用
+            self.log(f"会话{session.session_id}: 自动调优结果: {session.stream_limit}个连接, "
+                     f"套接字缓冲区{format_size(session.socket_buffer) if session.socket_buffer else '系统默认'}, "
+                     f"往返时延{session.rtt * 1000:.2f}ms, 吞吐量{format_size(session.rate)}/s")
+        if self.block_cache.capacity:
+            self.log(f"块缓存: {self.block_cache.summary()}")
+        self.log(f"会话{session.session_id}: {session.file_name if session.persistent else '文件'}传输完成")
+        return True
+
+    def take_job(self, session):
+        """
+        取出持久会话的下一个任务，跳过已不存在的文件
+
+        Args:
+            session (Session): 会话
+
+        Returns:
+            str: 文件或目录路径，队列中没有新任务时为None
+        """
+        while session.job_index < len(self.jobs):
+            file_path = self.jobs[session.job_index]
+            session.job_index += 1
+            if os.path.exists(file_path):
+                return file_path
+            self.log(f"会话{session.session_id}: 队列中的{file_path}不存在，跳过")
+        return None
+
+    async def next_job(self, session):
+        """
+        等待持久会话的下一个任务，队列已空时最多等待idle_timeout秒
+
+        Args:
+            session (Session): 会话
+
+        Returns:
+            str: 文件或目录路径，超时时为None
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.idle_timeout
+        while True:
+            file_path = self.take_job(session)
+            if file_path is not None:
+                return file_path
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(self.jobs_added.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+    def add_job(self, file_path):
+        """
+        把文件或目录加入发送队列，正在等待的持久会话随即发送，可以从其他线程调用
+
+        Args:
+            file_path (str): 文件或目录路径
+        """
+        def append():
+            self.jobs.append(file_path)
+            self.jobs_added.set()  # 唤醒所有正在等待的会话
+            self.jobs_added.clear()
+
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(append)
+        else:
+            append()
+
+    def ensure_cpu_pool(self):
+        """创建进程池，已创建时什么也不做"""
+        if self.cpu_pool is None:
+            # 使用spawn而不是fork：fork出的子进程会继承监听套接字和客户端连接，
+            # 导致连接关闭后对方收不到FIN、服务器退出后端口仍被占用
+            self.cpu_pool = ProcessPoolExecutor(
+                max_workers=self.compress_workers, mp_context=multiprocessing.get_context('spawn')
+            )
+
+    async def chunk_list(self, session):
+        """
+        取得会话文件的块清单，同一版本的文件只分块一次
+
+        Args:
+            session (Session): 会话
+
+        Returns:
+            bytes: 块清单
+        """
+        key = (session.file_path, session.version)
+        chunks = self.chunk_lists.get(key)
+        if chunks is None:
+            self.ensure_cpu_pool()
+            start = time.perf_counter()
+            chunks = await asyncio.get_running_loop().run_in_executor(self.cpu_pool, chunk_file, session.file_path)
+            self.log(f"会话{session.session_id}: 内容定义分块完成，耗时{time.perf_counter() - start:.2f}秒")
+            self.chunk_lists[key] = chunks
+            while len(self.chunk_lists) > self.max_chunk_lists:
+                self.chunk_lists.popitem(last=False)
+        self.chunk_lists.move_to_end(key)
+        return chunks
+
+    async def swarm_tracker(self, writer):
+        """
+        取得当前文件的P2P分发，第一次使用时计算所有块的摘要
+
+        Args:
+            writer (asyncio.StreamWriter): 写入流，拒绝时通过它告诉对方原因
+
+        Raises:
+            Exception: 服务器未开启P2P分发或当前选择的不是文件
+
+        Returns:
+            Tracker: 当前文件的P2P分发
+        """
+        if not self.swarm:
+            error = "服务器未开启P2P分发"
+        elif not self.file_path or not os.path.isfile(self.file_path):
+            error = "P2P分发只支持单个文件"
+        else:
+            error = None
+        if error:
+            writer.write(pack_frame(MSG_ERROR, error.encode()))
+            raise Exception(error)
+        key = (self.file_path, str(os.stat(self.file_path).st_mtime_ns))
+        task = self.trackers.get(key)
+        if task is None:
+            task = self.trackers[key] = asyncio.ensure_future(self.create_tracker(*key))
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            self.trackers.pop(key, None)
+            raise
+
+    async def create_tracker(self, file_path, version):
+        """
+        计算文件所有块的摘要，创建P2P分发
+
+        Args:
+            file_path (str): 文件路径
+            version (str): 文件版本
+
+        Returns:
+            Tracker: P2P分发
+        """
+        loop = asyncio.get_running_loop()
+        file_size = os.path.getsize(file_path)
+        start = time.perf_counter()
+        digests = await asyncio.gather(*(
+            loop.run_in_executor(self.hash_pool, hash_file_range, file_path, offset,
+                                 min(self.chunk_size, file_size - offset))
+            for offset in range(0, file_size, self.chunk_size)
+        ))
+        self.log(f"P2P分发: 已计算{len(digests)}个块的摘要，耗时{time.perf_counter() - start:.2f}秒")
+        source = BlockSource.complete(file_path, file_size, self.chunk_size)
+        return Tracker(source, os.path.basename(file_path), version, digests)
+
+    async def handle_swarm(self, reader, writer):
+        """
+        处理P2P分发节点的注册：发送文件信息、块摘要和节点列表，之后记录节点是否已完成，
+        所有节点都完成后通知它们结束
+
+        Args:
+            reader (asyncio.StreamReader): 读取流
+            writer (asyncio.StreamWriter): 写入流
+
+        Raises:
+            Exception: 注册消息格式错误
+        """
+        msg_type, _, body = await asyncio.wait_for(read_frame(reader), 60)
+        if msg_type != MSG_ANNOUNCE or len(body) != PORT.size:
+            raise Exception("注册消息格式错误")
+        (port,) = PORT.unpack(body)
+        tracker = await self.swarm_tracker(writer)
+        source = tracker.source
+        peer_id = secrets.token_hex(4)
+        host = writer.get_extra_info('peername')[0]
+        writer.write(pack_info(FileInfo(
+            source.file_size, source.block_size, 0, CAP_SWARM | CAP_VERIFY, 0, False,
+            peer_id, tracker.file_name, tracker.version
+        )))
+        writer.write(pack_frame(MSG_PIECES, b''.join(tracker.digests)))
+        member = tracker.members[peer_id] = Member(host, port, writer)
+        tracker.broadcast(pack_peers(tracker.peers()))
+        self.log(f"P2P分发: 节点{peer_id}({host}:{port})加入，共{len(tracker.members)}个节点")
+        try:
+            while True:
+                msg_type, _, _ = await read_frame(reader)
+                if msg_type == MSG_END and not member.done:
+                    member.done = True
+                    self.log(f"P2P分发: 节点{peer_id}已完成（{tracker.finished()}/{len(tracker.members)}）")
+                    if tracker.finished() == len(tracker.members):
+                        tracker.broadcast(pack_frame(MSG_BYE))
+                        self.log("P2P分发: 所有节点都已完成")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if not member.done:
+                self.log(f"P2P分发: 节点{peer_id}未完成就已离开")
+        finally:
+            del tracker.members[peer_id]
+            tracker.broadcast(pack_peers(tracker.peers()))
+
+    async def handle_peer(self, reader, writer, peer_id):
+        """
+        P2P分发节点从服务器下载块，与普通会话共用全局限速，每个节点的连接按会话限速和权重分配
+
+        Args:
+            reader (asyncio.StreamReader): 读取流
+            writer (asyncio.StreamWriter): 写入流
+            peer_id (str): 问候消息中的节点ID
+        """
+        tracker = await self.swarm_tracker(writer)
+        stats = self.metrics.connection(peer_id, 0, 'send')
+        share = Share(self.session_rate_limit, self.session_weight)
+        await serve_blocks(reader, writer, tracker.source, self.scheduler, share, stats)
+        self.log(f"P2P分发: 向节点{peer_id}上传{stats.blocks}块, {format_size(stats.bytes)}, {stats.summary()}")
+
+    async def handle_data(self, reader, writer, session_id):
+        """
+        处理数据连接：加入对应的会话，参与发送该会话的块，
+        持久会话中发送完一个文件后保持连接，等待控制连接开始下一个文件
+
+        Args:
+            reader (asyncio.StreamReader): 读取流
+            writer (asyncio.StreamWriter): 写入流
+            session_id (str): 问候消息中的会话ID
+
+        Raises:
+            Exception: 会话不存在或数据连接已满
+        """
+        session = self.sessions.get(session_id)
+        if session is not None and session.joined >= session.thread_count and session.caps & CAP_FAILOVER:
+            # 客户端先发现连接中断时，替代连接可能比服务器发现中断更早到达，等待空出位置
+            try:
+                async with session.vacancy:
+                    await asyncio.wait_for(
+                        session.vacancy.wait_for(lambda: session.joined < session.thread_count), 10
+                    )
+            except asyncio.TimeoutError:
+                pass
+        if session is None or session.joined >= session.thread_count:
+            raise Exception(f"无效的数据连接: 会话{session_id}")
+
+        conn_id = session.next_conn_id
+        session.next_conn_id += 1
+        session.joined += 1
+        if session.joined == session.thread_count:
+            session.all_joined.set()
+        self.log(f"会话{session_id}: 数据连接 {conn_id} 已建立")
+        if session.socket_buffer:
+            apply_buffer(writer.get_extra_info('socket'), socket.SO_SNDBUF, session.socket_buffer)
+        session.writers.append(writer)
+
+        served = 0  # 已发送的文件序号，持久会话中每个文件开始时控制连接把generation加一
+        try:
+            while True:
+                async with session.file_started:
+                    await session.file_started.wait_for(lambda: session.generation > served or session.closed)
+                if session.closed:
+                    break
+                served = session.generation
+                alive = True
+                try:
+                    alive = await self.send_blocks(session, reader, writer, conn_id)
+                finally:
+                    if alive:
+                        session.finished += 1  # 中断的连接由替代连接完成，不计入
+                    if session.finished >= session.thread_count or session.error:
+                        session.done.set()
+                if not alive or not session.persistent:
+                    break
+        except Exception as e:
+            if session.error is None:
+                session.error = e
+            session.done.set()
+        finally:
+            session.writers.remove(writer)
+
+    async def send_blocks(self, session, reader, writer, conn_id):
+        """
+        数据连接的发送循环：发送完一个块就从会话的块队列取下一个，
+        快的连接自然会多承担一些块，队列为空时发送结束标记
+
+        块之间不等待客户端确认。开启块校验时摘要紧跟在块数据后面发送，
+        客户端的校验结果由read_verdicts在后台接收，失败的块放回队列重传，
+        所有已发送的块都有了结果之后才发送结束标记。协商了CAP_FAILOVER时不校验的块也由客户端确认，
+        连接中断后由fail_over把尚未确认的块交给其他连接。
+
+        Args:
+            session (Session): 会话
+            reader (asyncio.StreamReader): 读取流
+            writer (asyncio.StreamWriter): 写入流
+            conn_id (int): 连接ID
+
+        Raises:
+            Exception: 任意一个块发送失败
+
+        Returns:
+            bool: 连接仍然可用，连接中断且未确认的块已交给其他连接时为False
+        """
+        loop = asyncio.get_running_loop()
+        blocks = 0
+        total_sent = 0
+        pending = {}  # 已领取、等待客户端确认的块，偏移量 -> 长度
+        sending = None  # 正在发送的块: (偏移量, 长度, 开始发送时连接已计入进度的字节数)
+        arrived = asyncio.Event()  # 收到校验结果时设置
+        verdicts = None
+        if session.verify or session.caps & CAP_FAILOVER:
+            verdicts = asyncio.create_task(self.read_verdicts(session, reader, pending, arrived))
+        stats = self.metrics.connection(session.session_id, conn_id, 'send')
+        session.streams += 1
+        retired = False
+        try:
+            try:
+                while session.error is None:
+                    if verdicts and verdicts.done():
+                        verdicts.result()  # 接收校验结果出错，抛出其异常
+                    if not retired and session.streams > session.stream_limit:
+                        # 自动调优减少了连接数，多出的连接不再领取新块，已发送的块有了结果后退出
+                        retired = True
+                        session.streams -= 1
+                    if session.blocks and not retired:
+                        start_pos, chunk_size = session.blocks.popleft()
+                        compressed = None
+                        if session.codec != CODEC_RAW:
+                            compressed = self.compress_ahead(session, start_pos, chunk_size)
+                        digest = None
+                        if session.verify:
+                            # 摘要在线程池中计算，与下面的发送同时进行
+                            digest = loop.run_in_executor(
+                                self.hash_pool, hash_segments, session.segments(start_pos, chunk_size)
+                            )
+                        if verdicts:
+                            pending[start_pos] = chunk_size  # 客户端确认之前连接中断时，这个块交给其他连接
+                        sending = (start_pos, chunk_size, stats.bytes)
+                        total_sent += await self.send_file_chunk(
+                            session, writer, stats, start_pos, chunk_size, compressed
+                        )
+                        sending = None
+                        blocks += 1
+                        stats.blocks += 1
+                        if digest is not None:
+                            with stats.measure('wait_time'):
+                                digest = await digest
+                            writer.write(pack_frame(MSG_DIGEST, DIGEST.pack(start_pos) + digest))
+                        continue
+                    if not pending:
+                        break
+                    # 队列已空，等待已发送的块的校验结果，失败的块会被放回队列
+                    arrived.clear()
+                    try:
+                        with stats.measure('wait_time'):
+                            await asyncio.wait_for(arrived.wait(), 30)
+                    except asyncio.TimeoutError:
+                        raise Exception("等待校验结果超时")
+            finally:
+                stats.finish()
+                if not retired:
+                    session.streams -= 1
+                if verdicts:
+                    # 等待接收任务真正退出，持久会话之后还要在同一个连接上读取
+                    verdicts.cancel()
+                    await asyncio.wait([verdicts])
+
+            # 没有更多的块
+            writer.write(pack_frame(MSG_END))
+            await writer.drain()
+            self.log(f"会话{session.session_id}: 连接{conn_id}完成传输: {blocks}块, {format_size(total_sent)}, "
+                     f"{stats.summary()}")
+            return True
+        except Exception as e:
+            if await self.fail_over(session, writer, conn_id, pending, sending, stats, e):
+                return False
+            self.log(f"会话{session.session_id}: 连接{conn_id}传输错误: {str(e)}")
+            raise
+
+    async def fail_over(self, session, writer, conn_id, pending, sending, stats, error):
+        """
+        数据连接中断时把它尚未得到客户端确认的块放回队列头部，由其他连接或客户端建立的替代连接发送，
+        已确认的块不再重发，一个连接中断只损失这几个块，不必重传整个文件
+
+        Args:
+            session (Session): 会话
+            writer (asyncio.StreamWriter): 中断的连接的写入流
+            conn_id (int): 连接ID
+            pending (dict): 该连接已领取、尚未确认的块，偏移量 -> 长度
+            sending (tuple): 中断时正在发送的块: (偏移量, 长度, 开始发送时已计入进度的字节数)，没有时为None
+            stats (ConnectionStats): 该连接的统计
+            error (Exception): 中断的原因
+
+        Returns:
+            bool: 已把块交给其他连接，为False时按会话出错处理
+        """
+        if (not session.caps & CAP_FAILOVER or session.error is not None or session.closed
+                or session.failovers >= self.max_failovers
+                or not (connection_lost(error) or writer.transport.is_closing())):
+            return False
+        session.failovers += 1
+        writer.transport.abort()  # 立即断开，客户端不会再从这个连接收到数据
+        if sending is not None:
+            offset, length, before = sending
+            reported = stats.bytes - before  # 正在发送的块已计入进度的部分
+            if offset not in pending:
+                # 等待drain时已收到这个块的校验结果，read_verdicts已把它移出pending：确认的块算作已送达，
+                # 校验失败的块已由retry_block放回队列并按整块扣除进度，两种情况都补上未计入进度的部分
+                self.report_sent(session, length - reported, stats)
+                stats.blocks += 1
+                sending = None
+        lost = sorted(pending.items())
+        session.blocks.extendleft(reversed(lost))
+        lost_size = sum(size for _, size in lost)
+        # 已计入进度的部分：未确认的完整块，加上正在发送的块已发出的部分
+        counted = lost_size
+        if sending is not None:
+            counted -= length - reported
+        session.total_sent -= counted
+        pending.clear()
+        async with session.vacancy:
+            session.joined -= 1  # 空出位置，等待客户端建立替代连接
+            session.vacancy.notify_all()
+        asyncio.get_running_loop().call_later(REPLACE_TIMEOUT, self.check_replacement, session, session.done)
+        self.log(f"会话{session.session_id}: 数据连接{conn_id}中断: {str(error)}，客户端已确认"
+                 f"{format_size(stats.bytes - counted)}，未确认的{len(lost)}块({format_size(lost_size)})交给其他连接")
+        return True
+
+    def check_replacement(self, session, done):
+        """
+        数据连接中断REPLACE_TIMEOUT秒后检查客户端是否已建立替代连接，
+        没有时不再等待，其他连接都已结束而仍有块未发送时会话出错
+
+        Args:
+            session (Session): 会话
+            done (asyncio.Event): 中断时正在传输的文件的完成事件
+        """
+        if done.is_set() or session.done is not done or session.joined >= session.thread_count:
+            return
+        self.log(f"会话{session.session_id}: 客户端没有建立替代的数据连接")
+        session.thread_count = session.joined
+        if session.finished >= session.thread_count:
+            if session.blocks and session.error is None:
+                session.error = Exception("数据连接中断，没有可用的连接发送剩余的块")
+            done.set()
+
+    async def send_udp(self, session, reader, writer):
+        """
+        可靠UDP发送：块数据切成数据报由UdpSender按速率发送，丢失的数据报按选择确认重传，
+        不受TCP在长时延、有丢包的链路上拥塞窗口反复减半的影响
+
+        一个块的所有数据报都被确认后，在控制连接上发送该块的MSG_COMMIT，开启块校验时附带摘要，
+        客户端的校验结果由read_verdicts在后台接收，失败的块放回队列重传，与TCP数据连接相同。
+
+        Args:
+            session (Session): 会话
+            reader (asyncio.StreamReader): 控制连接的读取流
+            writer (asyncio.StreamWriter): 控制连接的写入流
+
+        Raises:
+            Exception: 等待确认超时
+            Exception: 校验结果出错
+        """
+        loop = asyncio.get_running_loop()
+        host = writer.get_extra_info('peername')[0]
+        injector = Injector(self.udp_loss, self.udp_delay)
+        _, sender = await loop.create_datagram_endpoint(
+            lambda: UdpSender(session.rtt, injector), remote_addr=(host, session.udp_port)
+        )
+        if injector:
+            self.log(f"会话{session.session_id}: 模拟丢包率{injector.loss * 100:.1f}%, "
+                     f"附加往返时延{injector.delay * 2000:.0f}ms")
+        pending = {}  # 已发送MSG_COMMIT、等待校验结果的块，偏移量 -> 长度
+        verdicts = None
+        if session.verify:
+            # 收到校验结果时也唤醒发送循环
+            verdicts = asyncio.create_task(self.read_verdicts(session, reader, pending, sender.changed))
+        pump = asyncio.create_task(sender.run())
+        stats = self.metrics.connection(session.session_id, 0, 'send')
+        blocks = 0
+        acked = 0
+        try:
+            try:
+                while session.error is None:
+                    sender.changed.clear()
+                    if verdicts and verdicts.done():
+                        verdicts.result()  # 接收校验结果出错，抛出其异常
+                    if pump.done():
+                        pump.result()
+                    for start_pos, chunk_size in sender.take_completed():
+                        blocks += 1
+                        stats.blocks += 1
+                        digest = b''
+                        if session.verify:
+                            pending[start_pos] = chunk_size
+                            with stats.measure('wait_time'):
+                                digest = await loop.run_in_executor(
+                                    self.hash_pool, hash_segments, session.segments(start_pos, chunk_size)
+                                )
+                        writer.write(pack_frame(MSG_COMMIT, BLOCK.pack(start_pos, chunk_size) + digest))
+                    if sender.acked_bytes > acked:
+                        self.report_sent(session, sender.acked_bytes - acked, stats)
+                        acked = sender.acked_bytes
+                    await writer.drain()
+                    if session.blocks and sender.has_room():
+                        start_pos, chunk_size = session.blocks.popleft()
+                        wait = self.scheduler.reserve(session.share, chunk_size)
+                        if wait:
+                            with stats.measure('wait_time'):
+                                await wait  # 超过全局或会话的速率上限，等待令牌
+                        with stats.measure('disk_time'):
+                            if session.view is not None:
+                                data = session.view[start_pos:start_pos + chunk_size]
+                            else:
+                                data = await loop.run_in_executor(
+                                    None, read_segments, session.segments(start_pos, chunk_size)
+                                )
+                        sender.add_block(start_pos, data)
+                        continue
+                    if not session.blocks and sender.idle() and not pending:
+                        break
+                    # 等待确认或校验结果，确认丢失时发送方会超时重传，长时间没有进展说明客户端已断开
+                    try:
+                        with stats.measure('net_time'):
+                            await asyncio.wait_for(sender.changed.wait(), 30)
+                    except asyncio.TimeoutError:
+                        raise Exception("等待确认超时")
+            finally:
+                stats.finish()
+                pump.cancel()
+                sender.close()
+                if verdicts:
+                    verdicts.cancel()
+                    await asyncio.wait([verdicts])
+
+            writer.write(pack_frame(MSG_END))
+            await writer.drain()
+            self.log(f"会话{session.session_id}: UDP传输完成: {blocks}块, {format_size(acked)}, "
+                     f"往返时延{sender.srtt * 1000:.1f}ms, 发送速率{format_size(sender.rate)}/s, "
+                     f"重传{sender.retransmits}个数据报, {stats.summary()}")
+        except Exception as e:
+            self.log(f"会话{session.session_id}: UDP传输错误: {str(e)}")
+            raise
+
+    async def auto_tune(self, session, writer):
+        """
+        自动调优：定期测量会话的吞吐量，增减数据连接，并按带宽时延积调大缓冲区
+
+        增加连接时通过控制连接通知客户端新建连接，减少连接时多出的连接
+        发完当前块后发送结束标记退出，不需要客户端参与。
+
+        Args:
+            session (Session): 会话
+            writer (asyncio.StreamWriter): 控制连接的写入流
+        """
+        tuner = StreamTuner(session.thread_count)
+        last_sent = session.total_sent
+        last_time = requested_at = time.monotonic()
+        while not session.done.is_set():
+            await asyncio.sleep(TUNE_INTERVAL)
+            now = time.monotonic()
+            rate = (session.total_sent - last_sent) / (now - last_time)
+            last_sent, last_time = session.total_sent, now
+
+            if session.joined < session.thread_count:
+                # 等待客户端建立新连接，超时后不再等待，避免会话无法结束
+                if now - requested_at > 30:
+                    self.log(f"会话{session.session_id}: 客户端没有建立新的数据连接")
+                    session.thread_count = session.joined
+                    if session.finished >= session.thread_count:
+                        session.done.set()
+                continue
+
+            streams = tuner.update(rate)
+            session.rate = max(session.rate, rate)
+            buffer = session.socket_buffer
+            if not session.pinned_buffer and session.rtt and session.streams and session.writers:
+                # 只在带宽时延积超过内核现有缓冲区时才调大，低时延链路保持系统默认值
+                target = buffer_for(rate / session.streams, session.rtt)
+                if target > max(buffer, current_buffer(session.writers[0].get_extra_info('socket'), socket.SO_SNDBUF)):
+                    buffer = target
+
+            added = 0
+            if streams < session.stream_limit:
+                session.stream_limit = streams
+                self.log(f"会话{session.session_id}: 自动调优: 数据连接数减少为{streams}")
+            elif streams > session.stream_limit and len(session.blocks) >= streams * 2:
+                # 剩余的块足够多时才值得建立新连接
+                added = streams - session.streams
+                session.thread_count += added
+                session.stream_limit = streams
+                requested_at = now
+                self.log(f"会话{session.session_id}: 自动调优: 数据连接数增加为{streams}")
+
+            resized = buffer != session.socket_buffer
+            if resized:
+                session.socket_buffer = buffer
+                session.send_buffer_size = max(self.send_buffer_size, min(buffer, session.chunk_size))
+                for data_writer in session.writers:
+                    apply_buffer(data_writer.get_extra_info('socket'), socket.SO_SNDBUF, buffer)
+                self.log(f"会话{session.session_id}: 自动调优: 套接字缓冲区调整为{format_size(buffer)}")
+
+            if added or resized:
+                # 通知客户端新建连接并调整缓冲区
+                writer.write(pack_frame(MSG_TUNE, TUNE.pack(added, buffer)))
+                await writer.drain()
+
+    async def send_delta(self, session, writer, signature, block_size):
+        """
+        增量传输：在源文件中查找客户端旧文件已有的块，只发送复制指令和字面数据，
+        最后附上整个文件的摘要，客户端重建后据此校验
+
+        Args:
+            session (Session): 会话
+            writer (asyncio.StreamWriter): 写入流
+            signature (bytes): 客户端旧文件的块签名
+            block_size (int): 签名使用的块大小
+
+        Raises:
+            Exception: 网络超时
+            Exception: 连接被客户端重置
+        """
+        loop = asyncio.get_running_loop()
+        # 滚动校验和和整个文件的摘要都比较耗时，放到线程池中计算
+        file_digest = loop.run_in_executor(
+            self.hash_pool, hash_file_range, session.file_path, 0, session.file_size
+        )
+        index = parse_signature(signature)
+        ops = await loop.run_in_executor(self.hash_pool, delta_ops, session.file_path, index, block_size)
+
+        literal_size = 0
+        stats = self.metrics.connection(session.session_id, 0, 'send')
+        try:
+            with open(session.file_path, 'rb') as f:
+                for op, start, count in ops:
+                    if op == 'C':
+                        # 复制客户端已有的连续块
+                        writer.write(pack_frame(MSG_COPY, COPY.pack(start, count)))
+                        await asyncio.wait_for(writer.drain(), 10)
+                        self.report_sent(session, count * block_size)  # 复制的块不计入连接的统计
+                        continue
+
+                    # 字面数据，消息体直接从文件发送
+                    writer.write(frame_header(MSG_LITERAL, count))
+                    sent = 0
+                    if session.zero_copy:
+                        sent = await self.sendfile_range(session, writer, stats, f, start, count)
+                    if sent < count:
+                        await self.send_buffered_range(session, writer, stats, f, start + sent, count - sent)
+                    literal_size += count
+
+            writer.write(pack_frame(MSG_FILE_DIGEST, await file_digest))
+            await asyncio.wait_for(writer.drain(), 10)
+        except asyncio.TimeoutError:
+            raise Exception("网络超时")
+        except ConnectionResetError:
+            raise Exception("连接被客户端重置")
+        finally:
+            stats.finish()
+
+        saved = 1 - literal_size / session.file_size
+        self.log(f"会话{session.session_id}: 增量传输，实际发送{format_size(literal_size)}，节省{saved * 100:.1f}%")
+
+    async def read_verdicts(self, session, reader, pending, arrived):
+        """
+        在后台接收客户端的块校验结果：通过的块从pending中移除，失败的块放回队列重传
+
+        Args:
+            session (Session): 会话
+            reader (asyncio.StreamReader): 读取流
+            pending (dict): 等待校验结果的块，偏移量 -> 长度
+            arrived (asyncio.Event): 收到校验结果时设置，唤醒等待的发送循环
+
+        Raises:
+            Exception: 连接中断
+            Exception: 校验结果格式错误
+            Exception: 同一个块校验失败次数过多
+        """
+        try:
+            while True:
+                msg_type, flags, body = await read_frame(reader)
+                if msg_type != MSG_VERDICT:
+                    raise ValueError
+                (offset,) = VERDICT.unpack_from(body)
+                chunk_size = pending.pop(offset)
+                if not flags:
+                    self.retry_block(session, offset, chunk_size)
+                arrived.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            raise Exception("连接中断")
+        except (ValueError, KeyError, struct.error):
+            raise Exception("校验结果格式错误")
+        finally:
+            arrived.set()
+
+    def retry_block(self, session, start_pos, chunk_size):
+        """
+        把校验失败的块放回队列头部，由最先空闲的连接重传
+
+        Args:
+            session (Session): 会话
+            start_pos (int): 块的开始位置
+            chunk_size (int): 块大小
+
+        Raises:
+            Exception: 同一个块校验失败次数过多
+        """
+        retries = session.retries.get(start_pos, 0) + 1
+        if retries > self.max_retries:
+            raise Exception(f"偏移量{start_pos}处的块多次校验失败")
+        session.retries[start_pos] = retries
+        session.blocks.appendleft((start_pos, chunk_size))
+        session.total_sent -= chunk_size  # 重传的数据不重复计入进度
+        self.log(f"会话{session.session_id}: 偏移量{start_pos}处的块校验失败，第{retries}次重传")
+
+    def compress_ahead(self, session, start_pos, chunk_size):
+        """
+        取得当前块的压缩任务，并为队列中接下来的块提前提交压缩任务，
+        让进程池的所有进程同时工作，压缩速度不受连接数限制
+
+        Args:
+            session (Session): 会话
+            start_pos (int): 当前块的开始位置
+            chunk_size (int): 当前块大小
+
+        Returns:
+            asyncio.Future: 当前块的压缩结果
+        """
+        loop = asyncio.get_running_loop()
+
+        def submit(offset, length):
+            return loop.run_in_executor(
+                self.cpu_pool, compress_block, session.segments(offset, length), session.codec
+            )
+
+        future = session.compressed.pop(start_pos, None) or submit(start_pos, chunk_size)
+        for offset, length in itertools.islice(session.blocks, self.compress_workers):
+            if offset not in session.compressed:
+                session.compressed[offset] = submit(offset, length)
+        return future
+
+    async def send_file_chunk(self, session, writer, stats, start_pos, chunk_size, compressed=None):
+        """
+        发送文件块
+
+        Args:
+            session (Session): 会话
+            writer (asyncio.StreamWriter): 写入流
+            stats (ConnectionStats): 连接的统计
+            start_pos (int): 开始位置
+            chunk_size (int): 块大小
+            compressed (asyncio.Future): 该块的压缩任务，为None时发送原始数据
+
+        Raises:
+            FileNotFoundError: 文件不存在或已被移动
+            PermissionError: 没有文件读取权限
+            Exception: 文件读取不完整
+            Exception: 网络超时
+            Exception: 网络连接错误
+            Exception: 连接被客户端重置
+
+        Returns:
+            int: 发送的文件字节数（压缩前）
+        """
+        segments = session.segments(start_pos, chunk_size)
+        path, file_offset, _ = segments[0]
+        stat = self.block_cache.stat(path)  # 元数据缓存，同一文件的后续块不再stat和检查权限
+        available = max(stat.st_size - file_offset, 0)
+        if len(segments) == 1 and available < chunk_size:
+            raise Exception("文件读取不完整")
+
+        codec, data = CODEC_RAW, None
+        if compressed is not None:
+            with stats.measure('wait_time'):
+                codec, data = await compressed
+        if data is None and len(segments) > 1:
+            # 块跨越多个文件（通常是许多小文件）：把各段读到一起，作为一个批量帧发送
+            with stats.measure('disk_time'):
+                data = await asyncio.get_running_loop().run_in_executor(None, read_segments, segments)
+        if data is None and session.mapping is None and self.block_cache.capacity:
+            # 开启块缓存时从缓存发送，命中时不读盘；不缓存的块返回None，仍走下面的零拷贝路径
+            with stats.measure('disk_time'):
+                data = await self.block_cache.get(path, stat, file_offset, chunk_size)
+        wire_size = len(data) if data is not None else chunk_size
+        session.wire_bytes += wire_size
+
+        # 只有零拷贝和回退路径需要打开文件
+        with open(path, 'rb') if data is None and session.mapping is None else contextlib.nullcontext() as f:
+            try:
+                # 帧头部的标志是压缩算法编号，消息体是块位置和块数据，不等待客户端确认
+                writer.write(frame_header(MSG_BLOCK, BLOCK.size + wire_size, codec) + BLOCK.pack(start_pos, chunk_size))
+
+                if data is not None:
+                    wait = self.scheduler.reserve(session.share, wire_size)
+                    if wait:
+                        with stats.measure('wait_time'):
+                            await wait  # 超过全局或会话的速率上限，等待令牌
+                    writer.write(data)
+                    with stats.measure('net_time'):
+                        await asyncio.wait_for(writer.drain(), 10)
+                    self.report_sent(session, chunk_size, stats)
+                    return chunk_size
+
+                if session.mapping is not None:
+                    return await self.send_mapped_range(session, writer, stats, start_pos, chunk_size)
+
+                total_sent = 0
+                if session.zero_copy:
+                    total_sent = await self.sendfile_range(session, writer, stats, f, file_offset, chunk_size)
+                if total_sent < chunk_size:
+                    # 内核路径不可用或未启用，回退到有界缓冲区循环
+                    total_sent += await self.send_buffered_range(
+                        session, writer, stats, f, file_offset + total_sent, chunk_size - total_sent
+                    )
+                return total_sent
+
+            except asyncio.TimeoutError:
+                raise Exception("网络超时")
+            except ConnectionResetError:
+                raise Exception("连接被客户端重置")
+            except ConnectionError:
+                raise Exception("网络连接错误")
+
+    async def sendfile_range(self, session, writer, stats, f, offset, count):
+        """
+        零拷贝发送文件区间：loop.sendfile在支持的平台上使用os.sendfile，
+        数据直接从页缓存进入套接字
+
+        Args:
+            session (Session): 会话
+            writer (asyncio.StreamWriter): 写入流
+            stats (ConnectionStats): 连接的统计
+            f (file): 以二进制方式打开的源文件
+            offset (int): 区间在文件中的起始位置
+            count (int): 区间长度
+
+        Returns:
+            int: 实际发送的字节数，小于count表示内核路径不可用，剩余部分需要回退发送
+        """
+        loop = asyncio.get_running_loop()
+        total_sent = 0
+        while total_sent < count:
+            # 每次最多发送progress_step字节，便于按相同粒度更新进度
+            step = min(count - total_sent, self.progress_step)
+            wait = self.scheduler.reserve(session.share, step)
+            if wait:
+                with stats.measure('wait_time'):
+                    await wait  # 超过全局或会话的速率上限，等待令牌
+            try:
+                # 内核同时完成读盘和发送，全部计入网络时间
+                with stats.measure('net_time'):
+                    sent = await asyncio.wait_for(
+                        loop.sendfile(writer.transport, f, offset + total_sent, step, fallback=False), 10
+                    )
+            except asyncio.SendfileNotAvailableError:
+                break  # 文件、套接字或平台不支持sendfile，交由回退路径
+            if sent == 0:
+                break  # 文件提前结束
+            total_sent += sent
+            self.report_sent(session, sent, stats)
+        return total_sent
+
+    async def send_mapped_range(self, session, writer, stats, offset, count):
+        """
+        内存映射发送文件区间：直接写入映射的memoryview切片，不经过中间缓冲区，
+        也不需要读文件的系统调用，缺页由内核按预读提示提前处理
+
+        Args:
+            session (Session): 会话
+            writer (asyncio.StreamWriter): 写入流
+            stats (ConnectionStats): 连接的统计
+            offset (int): 区间在文件中的起始位置
+            count (int): 区间长度
+
+        Returns:
+            int: 实际发送的字节数
+        """
+        session.will_need(offset, count)
+        total_sent = 0
+        while total_sent < count:
+            # 每次最多写入progress_step字节，写入流的缓冲区占用有上限
+            step = min(count - total_sent, self.progress_step)
+            wait = self.scheduler.reserve(session.share, step)
+            if wait:
+                with stats.measure('wait_time'):
+                    await wait  # 超过全局或会话的速率上限，等待令牌
+            writer.write(session.view[offset + total_sent:offset + total_sent + step])
+            with stats.measure('net_time'):
+                await asyncio.wait_for(writer.drain(), 10)
+            total_sent += step
+            self.report_sent(session, step, stats)
+        return total_sent
+
+    async def send_buffered_range(self, session, writer, stats, f, offset, count):
+        """
+        回退发送文件区间：每次读取不超过会话send_buffer_size的数据再发送，
+        内存占用与区间大小无关，读取在线程池中进行，不阻塞事件循环。
+        开启预读时由ReadAhead提前读入后面的缓冲区，读盘与发送重叠进行
+
+        Args:
+            session (Session): 会话
+            writer (asyncio.StreamWriter): 写入流
+            stats (ConnectionStats): 连接的统计
+            f (file): 以二进制方式打开的源文件
+            offset (int): 区间在文件中的起始位置
+            count (int): 区间长度
+
+        Raises:
+            Exception: 文件读取不完整
+
+        Returns:
+            int: 实际发送的字节数
+        """
+        loop = asyncio.get_running_loop()
+        f.seek(offset)  # 设置文件指针到开始位置
+        total_sent = 0
+        pending = 0  # 尚未计入进度的字节数
+        ring = None
+        if self.read_ahead:
+            ring = ReadAhead(f, offset, count, session.send_buffer_size, self.read_ahead)
+
+        try:
+            while total_sent < count:
+                if ring is not None:
+                    with stats.measure('disk_time'):  # 只有预读没跟上时才需要等待
+                        data = await ring.next(writer)
+                else:
+                    with stats.measure('disk_time'):
+                        data = await loop.run_in_executor(None, f.read, min(count - total_sent, session.send_buffer_size))
+                if not data:
+                    raise Exception("文件读取不完整")
+                wait = self.scheduler.reserve(session.share, len(data))
+                if wait:
+                    with stats.measure('wait_time'):
+                        await wait  # 超过全局或会话的速率上限，等待令牌
+                writer.write(data)
+                if ring is not None:
+                    ring.hand_over(data)
+                with stats.measure('net_time'):
+                    await asyncio.wait_for(writer.drain(), 10)
+                total_sent += len(data)
+                pending += len(data)
+                if pending >= self.progress_step:
+                    self.report_sent(session, pending, stats)
+                    pending = 0
+        finally:
+            if ring is not None:
+                ring.close()
+
+        if pending:
+            self.report_sent(session, pending, stats)
+        return total_sent
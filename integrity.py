@@ -0,0 +1,66 @@
+import hashlib
+import os
+
+DIGEST_SIZE = 16  # 块摘要长度，字节
+READ_SIZE = 1024 * 1024  # 计算文件区间摘要时每次读取1MB
+
+
+def block_hasher():
+    """
+    创建块摘要对象
+
+    blake2b比sha256更快，hashlib在处理较大的数据时会释放GIL，
+    因此多个线程可以真正并行地计算摘要
+
+    Returns:
+        hashlib.blake2b: 摘要对象
+    """
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def hash_segments(segments):
+    """
+    计算若干文件段拼接后的摘要，在线程池中调用
+
+    Args:
+        segments (list): [(文件路径, 段在文件中的偏移量, 段长度)]
+
+    Raises:
+        Exception: 文件读取不完整
+
+    Returns:
+        bytes: 摘要
+    """
+    hasher = block_hasher()
+    for path, offset, length in segments:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            while length > 0:
+                if hasattr(os, 'pread'):
+                    data = os.pread(fd, min(length, READ_SIZE), offset)
+                else:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    data = os.read(fd, min(length, READ_SIZE))
+                if not data:
+                    raise Exception("文件读取不完整")
+                hasher.update(data)
+                offset += len(data)
+                length -= len(data)
+        finally:
+            os.close(fd)
+    return hasher.digest()
+
+
+def hash_file_range(path, offset, length):
+    """
+    计算文件区间的摘要，在线程池中调用
+
+    Args:
+        path (str): 文件路径
+        offset (int): 区间起始位置
+        length (int): 区间长度
+
+    Returns:
+        bytes: 摘要
+    """
+    return hash_segments([(path, offset, length)])
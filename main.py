@@ -1,20 +1,25 @@
-import client
-import server
+import sys
 import threading
 # import time
 
 def run_server():
     """运行服务器"""
+    import server
     server_instance = server.FileServer()
     server_instance.run()
 
 def run_client():
     """运行客户端"""
+    import client
     client_instance = client.FileClient()
     client_instance.run()
 
-# 使用守护线程运行服务器，主线程运行客户端
+# 带参数时以命令行方式运行，不加载界面；否则使用守护线程运行服务器，主线程运行客户端
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        import cli
+        sys.exit(cli.main())
+
     server_thread = threading.Thread(target=run_server)
     server_thread.daemon = True  # # 设置为守护线程，主线程结束时自动终止
     server_thread.start()
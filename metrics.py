@@ -0,0 +1,276 @@
+import json
+import os
+import threading
+import time
+
+STALL_THRESHOLD = 1.0  # 一次发送或接收阻塞超过1秒记为一次停滞
+RATE_WINDOW = 1.0  # 瞬时吞吐量的统计窗口，秒
+MAX_FINISHED = 256  # 最多保留的已结束连接数，更早的统计被丢弃
+
+# Prometheus指标: (名称, 类型, 说明, ConnectionStats.snapshot中的字段)
+PROMETHEUS_METRICS = (
+    ('filetransfer_bytes_total', 'counter', '连接传输的字节数', 'bytes'),
+    ('filetransfer_blocks_total', 'counter', '连接传输的块数', 'blocks'),
+    ('filetransfer_throughput_bytes_per_second', 'gauge', '最近一个统计窗口的吞吐量', 'rate'),
+    ('filetransfer_average_throughput_bytes_per_second', 'gauge', '连接建立以来的平均吞吐量', 'average_rate'),
+    ('filetransfer_network_seconds_total', 'counter', '阻塞在套接字发送或接收上的时间', 'net_time'),
+    ('filetransfer_disk_seconds_total', 'counter', '磁盘读写的时间', 'disk_time'),
+    ('filetransfer_wait_seconds_total', 'counter', '等待锁或工作线程的时间', 'wait_time'),
+    ('filetransfer_stalls_total', 'counter', '阻塞超过阈值的次数', 'stalls'),
+    ('filetransfer_reconnects_total', 'counter', '连接中断后由替代连接接续的次数', 'reconnects'),
+    ('filetransfer_active', 'gauge', '连接是否仍在传输', 'active'),
+)
+
+# 服务器块缓存的Prometheus指标: (名称, 类型, 说明, BlockCache.snapshot中的字段)
+CACHE_METRICS = (
+    ('filetransfer_cache_hits_total', 'counter', '块缓存命中次数', 'hits'),
+    ('filetransfer_cache_misses_total', 'counter', '块缓存未命中次数', 'misses'),
+    ('filetransfer_cache_evictions_total', 'counter', '块缓存淘汰的块数', 'evictions'),
+    ('filetransfer_cache_bytes', 'gauge', '块缓存已用的字节数', 'bytes'),
+    ('filetransfer_cache_capacity_bytes', 'gauge', '块缓存的内存上限', 'capacity'),
+)
+
+
+class Timer:
+    """累计一段代码的耗时，用于with语句"""
+
+    __slots__ = ('stats', 'field', 'start')
+
+    def __init__(self, stats, field):
+        self.stats = stats
+        self.field = field
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        setattr(self.stats, self.field, getattr(self.stats, self.field) + elapsed)
+        if self.field == 'net_time' and elapsed > STALL_THRESHOLD:
+            self.stats.stalls += 1
+        return False
+
+
+class ConnectionStats:
+    """
+    一个连接的统计
+
+    只由该连接自己的线程或协程修改，不需要加锁；导出时读到的值可能稍旧，但不会出错。
+    """
+
+    def __init__(self, session_id, conn_id, role):
+        """
+        Args:
+            session_id (str): 会话ID
+            conn_id (int): 连接ID
+            role (str): 'send'或'receive'
+        """
+        self.session_id = session_id
+        self.conn_id = conn_id
+        self.role = role
+        self.bytes = 0
+        self.blocks = 0
+        self.net_time = 0.0
+        self.disk_time = 0.0
+        self.wait_time = 0.0
+        self.stalls = 0
+        self.reconnects = 0  # 中断后由替代连接接续的次数，替代连接沿用这个统计
+        self.active = True
+        self.started = time.monotonic()
+        self.finished = None
+        self.rate = 0.0  # 上一个统计窗口的吞吐量
+        self.window_start = self.started
+        self.window_bytes = 0
+
+    def measure(self, field):
+        """
+        统计with语句块的耗时
+
+        Args:
+            field (str): 'net_time'、'disk_time'或'wait_time'
+
+        Returns:
+            Timer: 计时器
+        """
+        return Timer(self, field)
+
+    def add(self, size, blocks=0):
+        """
+        累加传输的字节数，并在统计窗口结束时更新瞬时吞吐量
+
+        Args:
+            size (int): 字节数
+            blocks (int): 完成的块数
+        """
+        self.bytes += size
+        self.blocks += blocks
+        self.window_bytes += size
+        now = time.monotonic()
+        if now - self.window_start >= RATE_WINDOW:
+            self.rate = self.window_bytes / (now - self.window_start)
+            self.window_start = now
+            self.window_bytes = 0
+
+    def finish(self):
+        """连接结束"""
+        self.active = False
+        self.finished = time.monotonic()
+
+    def resume(self):
+        """持久会话中同一个连接开始传输下一个文件，计数继续累加"""
+        if self.active:
+            return
+        # 把空闲的时间从起点中扣除，平均吞吐量只按传输的时间计算
+        self.started += time.monotonic() - self.finished
+        self.active = True
+        self.finished = None
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+
+    def snapshot(self):
+        """
+        当前统计的快照
+
+        Returns:
+            dict: 统计值
+        """
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return {
+            'session': self.session_id,
+            'connection': self.conn_id,
+            'role': self.role,
+            'bytes': self.bytes,
+            'blocks': self.blocks,
+            'rate': self.rate if self.active else 0.0,
+            'average_rate': self.bytes / elapsed if elapsed > 0 else 0.0,
+            'elapsed': elapsed,
+            'net_time': self.net_time,
+            'disk_time': self.disk_time,
+            'wait_time': self.wait_time,
+            'stalls': self.stalls,
+            'reconnects': self.reconnects,
+            'active': int(self.active),
+        }
+
+    def summary(self):
+        """
+        用于日志的一行摘要
+
+        Returns:
+            str: 摘要
+        """
+        data = self.snapshot()
+        return (f"平均{data['average_rate'] / 1024 / 1024:.2f} MB/s, 网络{data['net_time']:.2f}s, "
+                f"磁盘{data['disk_time']:.2f}s, 等待{data['wait_time']:.2f}s, 停滞{data['stalls']}次")
+
+
+class Metrics:
+    """收集所有连接的统计，可以导出为JSON行或Prometheus文本格式，不依赖界面"""
+
+    def __init__(self):
+        self.lock = threading.Lock()  # 只保护连接列表，不影响数据通路
+        self.connections = []
+        self.index = {}  # (会话ID, 连接ID, 角色) -> 统计，同一组标签只有一个统计
+        self.cache = None  # 服务器的块缓存，设置后一起导出其统计
+
+    def connection(self, session_id, conn_id, role):
+        """
+        登记一个连接，同一个连接再次登记时（持久会话的下一个文件）继续使用原来的统计，
+        导出时每组标签只有一条序列，Prometheus的计数器也保持单调递增
+
+        Args:
+            session_id (str): 会话ID
+            conn_id (int): 连接ID
+            role (str): 'send'或'receive'
+
+        Returns:
+            ConnectionStats: 该连接的统计
+        """
+        key = (session_id, conn_id, role)
+        with self.lock:
+            stats = self.index.get(key)
+            if stats is not None:
+                stats.resume()
+                return stats
+            finished = [s for s in self.connections if not s.active]
+            if len(finished) > MAX_FINISHED:
+                stale = set(map(id, finished[:len(finished) - MAX_FINISHED]))
+                self.connections = [s for s in self.connections if id(s) not in stale]
+                self.index = {(s.session_id, s.conn_id, s.role): s for s in self.connections}
+            stats = ConnectionStats(session_id, conn_id, role)
+            self.connections.append(stats)
+            self.index[key] = stats
+        return stats
+
+    def snapshot(self):
+        """
+        所有连接的统计快照
+
+        Returns:
+            list: 每个连接一个dict
+        """
+        with self.lock:
+            connections = list(self.connections)
+        return [stats.snapshot() for stats in connections]
+
+    def to_json_lines(self):
+        """
+        导出为JSON行，每个连接一行，有块缓存时再加一行缓存的统计，都附带导出时间
+
+        Returns:
+            str: JSON行文本
+        """
+        timestamp = time.time()
+        text = ''.join(json.dumps(dict(data, time=timestamp), ensure_ascii=False) + '\n'
+                       for data in self.snapshot())
+        if self.cache is not None:
+            text += json.dumps({'cache': self.cache.snapshot(), 'time': timestamp}, ensure_ascii=False) + '\n'
+        return text
+
+    def to_prometheus(self):
+        """
+        导出为Prometheus文本格式，可由node_exporter的textfile收集器读取
+
+        Returns:
+            str: Prometheus文本
+        """
+        # 按标签合并，同一组标签的序列在文件中只能出现一次
+        series = {}
+        for data in self.snapshot():
+            labels = f'session="{data["session"]}",connection="{data["connection"]}",role="{data["role"]}"'
+            merged = series.get(labels)
+            if merged is None:
+                series[labels] = dict(data)
+                continue
+            for _, kind, _, field in PROMETHEUS_METRICS:
+                merged[field] = max(merged[field], data[field]) if field == 'active' else merged[field] + data[field]
+        lines = []
+        for name, kind, help_text, field in PROMETHEUS_METRICS:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, data in series.items():
+                lines.append(f"{name}{{{labels}}} {data[field]}")
+        if self.cache is not None:
+            cache = self.cache.snapshot()
+            for name, kind, help_text, field in CACHE_METRICS:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {cache[field]}")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """
+        导出到文件：.prom文件按Prometheus格式整体替换，其他文件追加JSON行
+
+        Args:
+            path (str): 文件路径
+        """
+        if path.endswith('.prom'):
+            # 先写临时文件再替换，收集器不会读到写了一半的文件
+            temp_path = path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(self.to_prometheus())
+            os.replace(temp_path, path)
+        else:
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(self.to_json_lines())
@@ -0,0 +1,240 @@
+import asyncio
+import collections
+import os
+import queue
+import threading
+
+RING_SLOTS = 4  # 每个连接的缓冲区个数，磁盘和网络最多相差这么多个缓冲区
+
+
+class ReadAhead:
+    """
+    发送方的预读阶段：线程池按顺序把文件区间读入环中的空闲缓冲区，发送协程依次取出已读满的缓冲区
+
+    读盘和发送重叠进行，冷缓存或网络存储上发送方不再有一半时间空等磁盘。
+    缓冲区交给传输层之后，传输层可能仍引用着它（较新的Python不再复制未发出的数据），
+    只有传输层已发出的字节越过该缓冲区的末尾时才回收复用。内存占用固定为环的大小，与区间大小无关。
+    """
+
+    def __init__(self, f, offset, count, size, slots=RING_SLOTS):
+        """
+        Args:
+            f (file): 以二进制方式打开的源文件
+            offset (int): 区间在文件中的起始位置
+            count (int): 区间长度
+            size (int): 每个缓冲区的大小
+            slots (int): 缓冲区个数
+        """
+        self.f = f
+        self.next_offset = offset  # 下一次提交读取的位置
+        self.end = offset + count
+        self.size = size
+        # 区间比整个环小时只分配需要的缓冲区
+        self.free = collections.deque(memoryview(bytearray(size)) for _ in range(min(slots, -(-count // size))))
+        self.reads = collections.deque()  # 已提交的读取，按文件顺序: (缓冲区切片, 读取任务)
+        self.handed = collections.deque()  # 已交给传输层的缓冲区: (交出后累计的字节数, 缓冲区)
+        self.written = 0  # 交给传输层的累计字节数
+        self.lock = threading.Lock()  # 没有preadv的平台上，读取需要移动共享的文件指针
+
+    def read(self, view, offset):
+        """
+        在线程池中按位置读满一个缓冲区
+
+        Args:
+            view (memoryview): 缓冲区切片
+            offset (int): 读取位置
+
+        Returns:
+            int: 读到的字节数，小于缓冲区长度表示文件提前结束
+        """
+        total = 0
+        while total < len(view):
+            if hasattr(os, 'preadv'):
+                size = os.preadv(self.f.fileno(), [view[total:]], offset + total)
+            else:
+                with self.lock:
+                    self.f.seek(offset + total)
+                    size = self.f.readinto(view[total:])
+            if not size:
+                break
+            total += size
+        return total
+
+    def reclaim(self, transport):
+        """
+        回收传输层已发送完的缓冲区
+
+        Args:
+            transport (asyncio.Transport): 数据连接的传输层
+        """
+        flushed = self.written - transport.get_write_buffer_size()
+        while self.handed and self.handed[0][0] <= flushed:
+            self.free.append(self.handed.popleft()[1])
+
+    def fill(self, transport):
+        """
+        为所有空闲缓冲区提交读取
+
+        Args:
+            transport (asyncio.Transport): 数据连接的传输层
+        """
+        self.reclaim(transport)
+        loop = asyncio.get_running_loop()
+        while self.free and self.next_offset < self.end:
+            view = self.free.popleft()[:self.end - self.next_offset]
+            self.reads.append((view, loop.run_in_executor(None, self.read, view, self.next_offset)))
+            self.next_offset += len(view)
+
+    async def wait_flushed(self, writer):
+        """
+        等待传输层发出所有已交出的数据，之后环中的缓冲区都可以复用
+
+        drain只在写缓冲超过高水位时等待，这里临时把高水位设为0，等待完成后恢复原来的水位。
+
+        Args:
+            writer (asyncio.StreamWriter): 数据连接的写入流
+        """
+        transport = writer.transport
+        low, high = transport.get_write_buffer_limits()
+        transport.set_write_buffer_limits(high=0)
+        try:
+            await asyncio.wait_for(writer.drain(), 10)
+        finally:
+            transport.set_write_buffer_limits(high=high, low=low)
+
+    async def next(self, writer):
+        """
+        取出下一个已读满的缓冲区，所有缓冲区都还被传输层引用时等待其发出，不额外分配
+
+        Args:
+            writer (asyncio.StreamWriter): 数据连接的写入流
+
+        Raises:
+            Exception: 文件读取不完整
+
+        Returns:
+            memoryview: 按文件顺序的下一段数据，区间已读完时为None
+        """
+        self.fill(writer.transport)
+        while not self.reads and self.handed and self.next_offset < self.end:
+            await self.wait_flushed(writer)
+            self.fill(writer.transport)
+        if not self.reads:
+            return None
+        view, future = self.reads.popleft()
+        if await future < len(view):
+            raise Exception("文件读取不完整")
+        return view
+
+    def hand_over(self, view):
+        """
+        记录交给传输层的缓冲区，传输层发出这些字节之前不会复用它
+
+        Args:
+            view (memoryview): 已写入传输层的数据
+        """
+        self.written += len(view)
+        self.handed.append((self.written, memoryview(view.obj)))
+
+    def close(self):
+        """放弃尚未取出的读取，缓冲区随传输层发送完毕后释放"""
+        for _, future in self.reads:
+            future.cancel()
+        self.reads.clear()
+
+
+class WriteBehind:
+    """
+    接收方的写回阶段：接收线程把填满的缓冲区交给写入线程，立即用环中的下一个空闲缓冲区继续接收
+
+    写盘和接收重叠进行，慢速磁盘上接收线程不再停下来等待写入。内存占用固定为环的大小，
+    环中没有空闲缓冲区时接收线程等待写入线程，TCP的流量控制随即让发送方放慢。
+    """
+
+    def __init__(self, write, size, slots=RING_SLOTS, stats=None):
+        """
+        Args:
+            write (callable): 写入函数，参数为数据和文件中的位置
+            size (int): 每个缓冲区的大小
+            slots (int): 缓冲区个数
+            stats (ConnectionStats): 连接的统计，写入时间计入其磁盘时间
+        """
+        self.write = write
+        self.stats = stats
+        self.free = queue.SimpleQueue()
+        for _ in range(slots):
+            self.free.put(memoryview(bytearray(size)))
+        self.filled = queue.SimpleQueue()
+        self.pending = 0  # 已提交、尚未写入的缓冲区个数
+        self.written = threading.Condition()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """写入线程：按提交的顺序写入文件，出错后丢弃之后的数据，错误由接收线程抛出"""
+        while True:
+            item = self.filled.get()
+            if item is None:
+                break
+            view, length, offset = item
+            if self.error is None:
+                try:
+                    if self.stats is not None:
+                        with self.stats.measure('disk_time'):
+                            self.write(view[:length], offset)
+                    else:
+                        self.write(view[:length], offset)
+                except OSError as e:
+                    self.error = Exception(f"写入文件错误: {str(e)}")
+                except Exception as e:
+                    self.error = e
+            self.free.put(view)
+            with self.written:
+                self.pending -= 1
+                self.written.notify_all()
+
+    def acquire(self):
+        """
+        取一个空闲缓冲区，环中的缓冲区都在等待写入时阻塞
+
+        Raises:
+            Exception: 写入文件出错
+
+        Returns:
+            memoryview: 缓冲区
+        """
+        view = self.free.get()
+        if self.error:
+            raise self.error
+        return view
+
+    def submit(self, view, length, offset):
+        """
+        把填好的缓冲区交给写入线程
+
+        Args:
+            view (memoryview): 缓冲区
+            length (int): 有效数据的长度
+            offset (int): 数据在文件中的位置
+        """
+        with self.written:
+            self.pending += 1
+        self.filled.put((view, length, offset))
+
+    def flush(self):
+        """
+        等待已提交的数据全部写入文件，之后才能确认该块已完成
+
+        Raises:
+            Exception: 写入文件出错
+        """
+        with self.written:
+            self.written.wait_for(lambda: self.pending == 0)
+        if self.error:
+            raise self.error
+
+    def close(self):
+        """结束写入线程，尚未写入的数据仍会写完"""
+        self.filled.put(None)
+        self.thread.join()
@@ -0,0 +1,112 @@
+import queue
+import threading
+from datetime import datetime
+
+POLL_INTERVAL = 100  # 界面刷新间隔，毫秒，即每秒10次
+
+
+def format_size(size):
+    """
+    格式化文件大小
+
+    Args:
+        size (int): 文件大小
+
+    Returns:
+        str: 格式化后的文件大小
+    """
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return f"{size:.2f} {unit}"
+        size /= 1024
+    return f"{size:.2f} TB"
+
+
+class ProgressChannel:
+    """
+    工作线程与界面线程之间的进度和事件通道
+
+    Tk控件不是线程安全的，重绘也很慢，工作线程直接更新进度条会让数据通路等待界面。
+    这里工作线程只累加自己的计数器（每个线程一个，不需要加锁）或向队列放入事件，
+    界面线程用after()按固定频率调用poll，一次取出期间累积的日志和事件，
+    再按计数器总和刷新一次进度。传输速度与界面重绘速度无关。
+    """
+
+    def __init__(self):
+        self.base = 0  # 传输开始前已有的字节数，例如续传时已完成的部分
+        self.counters = []  # 每个工作线程一个计数器 [字节数]
+        self.local = threading.local()
+        self.events = queue.SimpleQueue()
+
+    def reset(self, base=0):
+        """
+        开始新的传输，清空所有计数器
+
+        Args:
+            base (int): 已有的字节数
+        """
+        self.base = base
+        self.counters = []
+        self.local = threading.local()
+
+    def add(self, size):
+        """
+        累加当前线程传输的字节数，只修改本线程的计数器
+
+        Args:
+            size (int): 字节数，重传时可以为负数
+        """
+        counter = getattr(self.local, 'counter', None)
+        if counter is None:
+            counter = self.local.counter = [0]
+            self.counters.append(counter)
+        counter[0] += size
+
+    def total(self):
+        """
+        所有线程累计的字节数
+
+        Returns:
+            int: 字节数
+        """
+        return self.base + sum(counter[0] for counter in list(self.counters))
+
+    def log(self, message):
+        """
+        放入一条日志，记录的是产生日志的时间而不是显示的时间
+
+        Args:
+            message (str): 日志消息
+        """
+        current_time = datetime.now().strftime("%H:%M:%S")
+        self.events.put((None, f"[{current_time}] {message}\n", None))
+
+    def call(self, func, *args, **kwargs):
+        """
+        请界面线程执行一个操作，例如更新状态标签或弹出对话框
+
+        Args:
+            func (callable): 在界面线程中调用的函数
+            *args: 位置参数
+            **kwargs: 关键字参数
+        """
+        self.events.put((func, args, kwargs))
+
+    def poll(self):
+        """
+        在界面线程中调用：按顺序执行所有待处理的操作，并取出期间的日志
+
+        Returns:
+            str: 拼接好的日志文本，没有新日志时为空字符串
+        """
+        lines = []
+        while True:
+            try:
+                func, args, kwargs = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if func is None:
+                lines.append(args)
+            else:
+                func(*args, **kwargs)
+        return ''.join(lines)
@@ -0,0 +1,280 @@
+import collections
+import struct
+
+MAGIC = b'FTRX'  # 问候消息开头的魔数，用于识别协议
+VERSION = 2  # 协议版本，双方不一致时拒绝连接
+
+# 帧头部: 消息类型(1字节) 标志(1字节) 消息体长度(8字节)，网络字节序
+FRAME = struct.Struct('!BBQ')
+
+# 消息类型
+MSG_CTRL = 1  # 控制连接问候，客户端 -> 服务器
+MSG_DATA = 2  # 数据连接问候，消息体末尾附会话ID
+MSG_INFO = 3  # 文件信息，服务器 -> 客户端
+MSG_ERROR = 4  # 错误信息，消息体为UTF-8文本
+MSG_MANIFEST_REQUEST = 5  # 请求目录清单
+MSG_MANIFEST = 6  # 目录清单
+MSG_READY = 7  # 准备就绪，附往返时延和缺失块的位图
+MSG_DELTA = 8  # 请求增量传输，附旧文件的块签名
+MSG_TUNE = 9  # 自动调优：新建连接数和套接字缓冲区
+MSG_BLOCK = 10  # 数据块，标志为压缩算法编号，消息体为块位置和块数据
+MSG_DIGEST = 11  # 块摘要，紧跟在数据块之后
+MSG_VERDICT = 12  # 块校验结果，标志为1表示通过，客户端 -> 服务器；不校验时用于确认块已写入
+MSG_END = 13  # 没有更多的块
+MSG_COPY = 14  # 增量传输：从旧文件复制连续的块
+MSG_LITERAL = 15  # 增量传输：字面数据
+MSG_FILE_DIGEST = 16  # 增量传输：整个文件的摘要，表示指令结束
+MSG_EXTENTS = 17  # 稀疏文件的数据区间，紧跟在文件信息之后
+MSG_CHUNKS_REQUEST = 18  # 请求内容定义分块的块清单
+MSG_CHUNKS = 19  # 块清单：每块的长度和摘要
+MSG_HAVE = 20  # 客户端已从本地块仓库组装好的区间，这些区间不需要发送
+MSG_UDP = 21  # 客户端选择可靠UDP传输，附接收数据报的端口
+MSG_COMMIT = 22  # 可靠UDP：块的所有数据报都已确认，附块位置、长度和摘要（不校验时为空）
+MSG_BYE = 23  # 持久会话：发送队列已空，会话结束；P2P分发：所有节点都已完成
+MSG_SWARM = 24  # P2P分发：节点向源服务器注册的问候
+MSG_PEER = 25  # P2P分发：节点之间交换块的连接问候，消息体末尾附请求方的节点ID
+MSG_ANNOUNCE = 26  # P2P分发：节点接受其他节点连接的端口
+MSG_PIECES = 27  # P2P分发：所有块的摘要，节点据此校验从其他节点收到的块
+MSG_PEERS = 28  # P2P分发：当前所有节点的ID和地址
+MSG_BITFIELD = 29  # P2P分发：已有块的位图
+MSG_HAVE_BLOCK = 30  # P2P分发：新得到的块号
+MSG_REQUEST = 31  # P2P分发：请求一个块
+
+# 能力位，客户端在问候消息中声明支持的功能，服务器只使用双方都支持的功能
+CAP_VERIFY = 1 << 0  # 块校验
+CAP_ZLIB = 1 << 1  # zlib压缩
+CAP_LZMA = 1 << 2  # lzma压缩
+CAP_DELTA = 1 << 3  # 增量传输
+CAP_TREE = 1 << 4  # 目录传输
+CAP_TUNE = 1 << 5  # 自动调优
+CAP_SPARSE = 1 << 6  # 稀疏文件只传输数据区间
+CAP_DEDUP = 1 << 7  # 按块清单跨文件去重
+CAP_UDP = 1 << 8  # 可靠UDP传输
+CAP_PERSIST = 1 << 9  # 持久会话：一个文件传输完成后保持所有连接，继续传输下一个文件
+CAP_SWARM = 1 << 10  # P2P分发：接收方之间互相交换已有的块
+CAP_FAILOVER = 1 << 11  # 数据连接中断时把未确认的块交给其他连接，客户端确认每个块并建立替代连接
+CAPABILITIES = (CAP_VERIFY | CAP_ZLIB | CAP_LZMA | CAP_DELTA | CAP_TREE | CAP_TUNE | CAP_SPARSE | CAP_DEDUP
+                | CAP_UDP | CAP_PERSIST | CAP_SWARM | CAP_FAILOVER)
+
+# 各消息体的固定部分
+HELLO = struct.Struct('!4sHI')  # 魔数 协议版本 能力位
+INFO = struct.Struct('!QQQIHB')  # 文件大小 块大小 套接字缓冲区 能力位 连接数 是否目录
+READY = struct.Struct('!Q')  # 往返时延（微秒），后面是缺失块的位图
+DELTA = struct.Struct('!Q')  # 签名块大小，后面是块签名
+TUNE = struct.Struct('!IQ')  # 新建连接数 套接字缓冲区
+BLOCK = struct.Struct('!QQ')  # 块偏移量 块长度（解压后），后面是块数据
+DIGEST = struct.Struct('!Q')  # 块偏移量，后面是摘要
+VERDICT = struct.Struct('!Q')  # 块偏移量
+COPY = struct.Struct('!QQ')  # 起始块号 块数
+PORT = struct.Struct('!H')  # UDP端口
+STRING = struct.Struct('!H')  # 变长字符串的长度
+INDEX = struct.Struct('!I')  # 块号
+
+MAX_MESSAGE_SIZE = 1 << 30  # 控制消息体的上限，防止错误的长度字段导致分配过多内存
+
+FileInfo = collections.namedtuple(
+    'FileInfo', 'file_size chunk_size socket_buffer caps thread_count is_dir session_id file_name version'
+)
+
+
+def frame_header(msg_type, length, flags=0):
+    """
+    打包帧头部，消息体由调用方随后发送（例如直接从文件发送的块数据）
+
+    Args:
+        msg_type (int): 消息类型
+        length (int): 消息体长度
+        flags (int): 标志
+
+    Returns:
+        bytes: 帧头部
+    """
+    return FRAME.pack(msg_type, flags, length)
+
+
+def pack_frame(msg_type, body=b'', flags=0):
+    """
+    打包一个完整的帧
+
+    Args:
+        msg_type (int): 消息类型
+        body (bytes): 消息体
+        flags (int): 标志
+
+    Returns:
+        bytes: 帧
+    """
+    return FRAME.pack(msg_type, flags, len(body)) + body
+
+
+def parse_frame_header(buffer):
+    """
+    解析帧头部
+
+    Args:
+        buffer (bytes): 至少FRAME.size字节的缓冲区
+
+    Returns:
+        tuple: (消息类型, 标志, 消息体长度)
+    """
+    return FRAME.unpack_from(buffer)
+
+
+async def read_frame(reader):
+    """
+    读取一个完整的帧
+
+    Args:
+        reader (asyncio.StreamReader): 读取流
+
+    Raises:
+        ValueError: 消息体过长
+
+    Returns:
+        tuple: (消息类型, 标志, 消息体)
+    """
+    msg_type, flags, length = parse_frame_header(await reader.readexactly(FRAME.size))
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError("消息体过长")
+    return msg_type, flags, await reader.readexactly(length)
+
+
+def pack_hello(msg_type, session_id=''):
+    """
+    打包问候消息
+
+    Args:
+        msg_type (int): MSG_CTRL或MSG_DATA
+        session_id (str): 数据连接所属的会话ID
+
+    Returns:
+        bytes: 帧
+    """
+    return pack_frame(msg_type, HELLO.pack(MAGIC, VERSION, CAPABILITIES) + session_id.encode())
+
+
+def parse_hello(body):
+    """
+    解析问候消息
+
+    Args:
+        body (bytes): 消息体
+
+    Raises:
+        ValueError: 不是本协议的问候消息或协议版本不一致
+
+    Returns:
+        tuple: (能力位, 会话ID)
+    """
+    if len(body) < HELLO.size:
+        raise ValueError("问候消息不完整")
+    magic, version, caps = HELLO.unpack_from(body)
+    if magic != MAGIC:
+        raise ValueError("不是文件传输协议的连接")
+    if version != VERSION:
+        raise ValueError(f"协议版本不一致: 对方{version}，本机{VERSION}")
+    return caps, body[HELLO.size:].decode()
+
+
+def pack_strings(*values):
+    """
+    打包若干变长字符串，每个字符串前面是2字节长度
+
+    Args:
+        *values (str): 字符串
+
+    Returns:
+        bytes: 打包结果
+    """
+    parts = []
+    for value in values:
+        data = value.encode()
+        parts.append(STRING.pack(len(data)) + data)
+    return b''.join(parts)
+
+
+def unpack_strings(buffer, offset, count):
+    """
+    解析pack_strings打包的字符串
+
+    Args:
+        buffer (bytes): 缓冲区
+        offset (int): 第一个字符串的位置
+        count (int): 字符串个数
+
+    Returns:
+        list: 字符串
+    """
+    values = []
+    for _ in range(count):
+        (length,) = STRING.unpack_from(buffer, offset)
+        offset += STRING.size
+        values.append(bytes(buffer[offset:offset + length]).decode())
+        offset += length
+    return values
+
+
+def pack_info(info):
+    """
+    打包文件信息
+
+    Args:
+        info (FileInfo): 文件信息
+
+    Returns:
+        bytes: 帧
+    """
+    body = INFO.pack(info.file_size, info.chunk_size, info.socket_buffer, info.caps,
+                     info.thread_count, int(info.is_dir))
+    return pack_frame(MSG_INFO, body + pack_strings(info.session_id, info.file_name, info.version))
+
+
+def parse_info(body):
+    """
+    解析文件信息
+
+    Args:
+        body (bytes): 消息体
+
+    Returns:
+        FileInfo: 文件信息
+    """
+    file_size, chunk_size, socket_buffer, caps, thread_count, is_dir = INFO.unpack_from(body)
+    session_id, file_name, version = unpack_strings(body, INFO.size, 3)
+    return FileInfo(file_size, chunk_size, socket_buffer, caps, thread_count, bool(is_dir),
+                    session_id, file_name, version)
+
+
+def pack_peers(peers):
+    """
+    打包节点列表
+
+    Args:
+        peers (list): [(节点ID, 主机, 端口)]
+
+    Returns:
+        bytes: 帧
+    """
+    body = b''.join(pack_strings(peer_id, host) + PORT.pack(port) for peer_id, host, port in peers)
+    return pack_frame(MSG_PEERS, body)
+
+
+def parse_peers(body):
+    """
+    解析节点列表
+
+    Args:
+        body (bytes): 消息体
+
+    Returns:
+        list: [(节点ID, 主机, 端口)]
+    """
+    peers = []
+    offset = 0
+    while offset < len(body):
+        peer_id, host = unpack_strings(body, offset, 2)
+        offset += 2 * STRING.size + len(peer_id.encode()) + len(host.encode())
+        (port,) = PORT.unpack_from(body, offset)
+        offset += PORT.size
+        peers.append((peer_id, host, port))
+    return peers
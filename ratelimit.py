@@ -0,0 +1,172 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+BURST_TIME = 0.1  # 令牌桶最多积累0.1秒的令牌，空闲之后的突发不会超过这个量
+MIN_BURST = 256 * 1024  # 令牌桶容量下限，256KB，低速率时也能一次发出一个发送单位
+
+
+class TokenBucket:
+    """
+    令牌桶
+
+    发送前按字节数取走令牌，令牌不足时允许透支，透支的部分按速率换算成需要等待的时间。
+    因此一次可以取走任意大小的令牌（例如一整个块），不需要按包计数，开销与发送单位的个数成正比。
+    """
+
+    def __init__(self, rate=0):
+        """
+        Args:
+            rate (int): 速率，字节/秒，0表示不限速
+        """
+        self.rate = rate
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+
+    def refill(self):
+        """按经过的时间补充令牌，不超过桶的容量"""
+        now = time.monotonic()
+        if self.rate:
+            burst = max(self.rate * BURST_TIME, MIN_BURST)
+            self.tokens = min(self.tokens + (now - self.stamp) * self.rate, burst)
+        self.stamp = now
+
+    def set_rate(self, rate):
+        """
+        修改速率，已有的令牌和透支保持不变
+
+        Args:
+            rate (int): 速率，字节/秒，0表示不限速
+        """
+        self.refill()
+        self.rate = rate
+        if not rate:
+            self.tokens = 0.0
+
+    def available(self, size):
+        """
+        令牌是否足够，不取走令牌
+
+        Args:
+            size (int): 字节数
+
+        Returns:
+            bool: 令牌足够
+        """
+        self.refill()
+        return self.tokens >= size
+
+    def take(self, size):
+        """
+        取走令牌
+
+        Args:
+            size (int): 字节数
+
+        Returns:
+            float: 需要等待的秒数，令牌足够时为0
+        """
+        self.refill()
+        self.tokens -= size
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Share:
+    """一个会话在调度器中的份额：会话自己的速率上限和分配带宽时的权重"""
+
+    def __init__(self, rate=0, weight=1):
+        """
+        Args:
+            rate (int): 会话的速率上限，字节/秒，0表示不限速
+            weight (int): 权重，带宽不足时各会话按权重比例分配
+        """
+        self.bucket = TokenBucket(rate)
+        self.weight = max(weight, 1)
+        self.finish = 0.0  # 该会话上一个请求的虚拟完成时间
+
+
+class BandwidthScheduler:
+    """
+    所有会话共享的带宽调度器，只在事件循环线程中使用
+
+    每次发送先经过会话自己的令牌桶，再经过全局令牌桶。全局令牌桶不足时按起始时间公平排队
+    （SFQ）：请求的虚拟起始时间取系统虚拟时间和该会话上一个请求的虚拟完成时间中较大的一个，
+    虚拟完成时间再加上 字节数/权重，虚拟起始时间最小的请求先放行。
+    同一会话的多个连接共享一个虚拟时间，所以带宽按会话而不是按连接分配；某个会话用不完
+    自己的份额时，其他会话自然得到剩余的带宽。没有设置上限时不排队，也不创建任何对象。
+    """
+
+    def __init__(self, rate=0):
+        """
+        Args:
+            rate (int): 全局速率上限，字节/秒，0表示不限速
+        """
+        self.bucket = TokenBucket(rate)
+        self.waiters = []  # 等待全局令牌的请求，(虚拟起始时间, 序号, 字节数, Future)
+        self.sequence = itertools.count()
+        self.virtual = 0.0  # 系统虚拟时间，最近放行的请求的虚拟起始时间
+        self.dispatcher = None
+
+    def reserve(self, share, size):
+        """
+        为一次发送申请带宽
+
+        Args:
+            share (Share): 会话的份额
+            size (int): 字节数
+
+        Returns:
+            awaitable: 需要等待时返回可等待对象，可以立即发送时返回None
+        """
+        delay = share.bucket.take(size) if share.bucket.rate else 0.0
+        if not self.bucket.rate:
+            return asyncio.sleep(delay) if delay > 0 else None
+        if delay <= 0 and not self.waiters and self.bucket.available(size):
+            # 全局带宽充足且没有人排队，直接放行
+            self.bucket.take(size)
+            share.finish = max(share.finish, self.virtual) + size / share.weight
+            return None
+        return self.enqueue(share, size, delay)
+
+    async def enqueue(self, share, size, delay):
+        """
+        先按会话上限等待，再排队等待全局令牌
+
+        Args:
+            share (Share): 会话的份额
+            size (int): 字节数
+            delay (float): 会话令牌桶要求等待的秒数
+        """
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if not self.bucket.rate:
+            return  # 等待期间取消了全局上限
+        start = max(share.finish, self.virtual)
+        share.finish = start + size / share.weight
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (start, next(self.sequence), size, future))
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        await future
+
+    async def dispatch(self):
+        """按虚拟起始时间的顺序放行排队的请求，全局令牌不足时等待"""
+        while self.waiters:
+            start, _, size, future = heapq.heappop(self.waiters)
+            self.virtual = start
+            if self.bucket.rate:
+                wait = self.bucket.take(size)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            if not future.done():
+                future.set_result(None)
+
+    def set_rate(self, rate):
+        """
+        修改全局速率上限，正在进行的传输立即生效
+
+        Args:
+            rate (int): 全局速率上限，字节/秒，0表示不限速
+        """
+        self.bucket.set_rate(rate)
@@ -0,0 +1,1177 @@
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+
+from blockmap import BlockMap, MAP_SUFFIX, bitmap_blocks
+from compression import CODEC_RAW, decompress_block
+from dedup import ChunkStore, parse_chunks
+from delta import file_signature
+from integrity import block_hasher, hash_segments
+from metrics import Metrics
+from pipeline import RING_SLOTS, WriteBehind
+from progress import ProgressChannel, format_size
+from protocol import (BLOCK, CAP_DEDUP, CAP_DELTA, CAP_FAILOVER, CAP_PERSIST, CAP_SPARSE, CAP_UDP, CAP_VERIFY, COPY, DELTA, DIGEST,
+                      FRAME, MAX_MESSAGE_SIZE, MSG_BLOCK, MSG_BYE, MSG_CHUNKS, MSG_CHUNKS_REQUEST, MSG_COMMIT,
+                      MSG_COPY, MSG_CTRL, MSG_DATA, MSG_DELTA, MSG_DIGEST, MSG_END, MSG_ERROR, MSG_EXTENTS,
+                      MSG_FILE_DIGEST, MSG_HAVE, MSG_INFO, MSG_LITERAL, MSG_MANIFEST, MSG_MANIFEST_REQUEST, MSG_READY,
+                      MSG_TUNE, MSG_UDP, MSG_VERDICT, PORT, READY, TUNE, VERDICT, pack_frame, pack_hello,
+                      parse_frame_header, parse_info)
+from sparse import ExtentMap
+from swarm import SwarmPeer
+from tree import Tree, TreeWriter
+from tuning import apply_buffer
+from udp import UdpReceiver
+
+DELTA_SUFFIX = '.delta'  # 增量重建时使用的临时文件后缀
+
+
+class ClientEngine:
+    """
+    接收引擎：连接服务器并接收文件，不依赖界面
+
+    在调用线程中阻塞运行，多连接传输时每个数据连接一个接收线程。接收线程只累加
+    ProgressChannel中自己的计数器；日志、文件信息和保存位置通过回调交给前端，
+    Tk界面和命令行共用同一套接收逻辑。
+    """
+
+    def __init__(self, port=9999, on_log=None, on_connected=None, on_file=None, on_finish=None,
+                 choose_path=None, channel=None):
+        """
+        Args:
+            port (int): 服务器端口
+            on_log (callable): 日志回调，参数为日志消息
+            on_connected (callable): 连接到服务器后的回调
+            on_file (callable): 收到文件信息后的回调，参数为FileInfo
+            on_finish (callable): 一个文件接收结束的回调，参数为结果文字
+            choose_path (callable): 选择保存位置，参数为FileInfo，返回保存路径，返回空表示取消接收
+            channel (ProgressChannel): 进度计数器，默认新建一个
+        """
+        self.port = port
+        self.on_log = on_log
+        self.on_connected = on_connected
+        self.on_file = on_file
+        self.on_finish = on_finish
+        self.choose_path = choose_path
+        self.channel = channel or ProgressChannel()  # 接收线程只累加计数器，前端定时读取总和
+
+        # 接收选项，每次连接前由前端设置
+        self.resume = True  # 断点续传：在目标文件旁记录已完成的块，中断后重新连接只接收缺失的部分
+        self.delta = True  # 增量传输：保存位置已有旧版本文件时，只接收变化的部分
+        self.use_mmap = False  # 内存映射写入：映射预分配的文件，数据直接接收到映射中对应的位置
+        self.preallocate_enabled = False  # 预分配空间：为有数据的区间预先分配磁盘空间，空洞仍不占空间
+        self.dedup = False  # 去重缓存：接收过的内容按块保存在本地仓库，其他文件中相同的块直接从仓库取出
+        self.use_udp = False  # 可靠UDP：长时延、有丢包的链路上代替TCP数据连接
+        self.listen_port = 0  # P2P分发时为其他节点上传的监听端口，0表示自动选择
+        self.upload_limit = 0  # P2P分发时的上传速率上限，字节/秒，0表示不限速
+
+        self.receiving = False  # 是否正在接收，接收期间前端才按计数器刷新进度
+        self.file_size = 0
+        self.block_size = 0
+        self.recv_buffer_size = 256 * 1024  # 每个连接的接收缓冲区大小，256KB
+        self.write_behind = RING_SLOTS  # 每个连接写回的缓冲区个数，0表示接收线程直接写入
+        self.block_map = None  # 断点续传模式下的已完成块位图
+        self.verify = False  # 服务器是否为每个块附加摘要
+        self.acknowledge = False  # 不校验时是否也确认每个块，服务器据此在连接中断后只重发未确认的块
+        self.max_failovers = 3  # 每个文件最多为中断的数据连接建立替代连接的次数
+        self.tree = None  # 目录传输时的目录树
+        self.extents = None  # 需要接收的数据区间，稀疏文件的空洞和本地块仓库已有的部分不会被发送
+        # 本地的内容寻址块仓库，与具体文件无关
+        self.chunk_store = ChunkStore(os.path.join(os.path.expanduser('~'), '.filetransfer', 'chunks'))
+        self.mapping = None  # 内存映射模式下目标文件的映射
+        self.mapping_view = None  # 映射的memoryview，接收时直接切片
+        self.delta_block_size = 64 * 1024  # 增量传输的签名块大小，64KB
+        self.socket_buffer = 0  # 数据连接的套接字接收缓冲区，0表示系统默认值，由服务器指定
+        self.rtt = 0.0  # 连接服务器时测得的往返时延，秒
+        self.session_id = ''  # 服务器分配的会话ID
+        self.udp_buffer = 8 * 1024 * 1024  # UDP套接字的接收缓冲区，8MB，吸收发送方的突发
+        self.metrics = Metrics()  # 每个连接的传输统计
+
+    def log(self, message):
+        """
+        记录日志
+
+        Args:
+            message (str): 日志消息
+        """
+        if self.on_log:
+            self.on_log(message)
+
+    def start_progress(self, base=0):
+        """
+        开始累计进度
+
+        Args:
+            base (int): 已有的字节数，续传时为已完成的部分
+        """
+        self.channel.reset(base)
+        self.receiving = True
+
+    def finish_progress(self, text):
+        """
+        停止累计进度，把结果告诉前端
+
+        Args:
+            text (str): 结果文字，例如"接收完成！"
+        """
+        self.receiving = False
+        if self.on_finish:
+            self.on_finish(text)
+
+    def report_received(self, size, stats=None):
+        """
+        累加已接收字节数，只修改当前线程的计数器，不加锁
+
+        Args:
+            size (int): 本次新写入文件的字节数
+            stats (ConnectionStats): 接收该数据的连接的统计
+        """
+        self.channel.add(size)
+        if stats is not None:
+            stats.add(size)
+
+    def write_at(self, fd, data, offset):
+        """
+        按位置写入文件，不移动共享的文件指针，因此多个连接可以并发写入
+
+        Args:
+            fd (int): 文件描述符
+            data (memoryview): 要写入的数据
+            offset (int): 写入位置
+        """
+        if isinstance(fd, TreeWriter):
+            fd.write_at(data, offset)  # 目录传输：偏移量是虚拟文件中的位置，拆分写入各个文件
+            return
+        if isinstance(fd, mmap.mmap):
+            fd[offset:offset + len(data)] = data  # 内存映射模式：复制到映射中，不需要系统调用
+            return
+        while data:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(fd, data, offset)
+            else:
+                # 没有pwrite的平台（如Windows）：每个连接使用独立的描述符，文件指针互不影响
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, data)
+            data = data[written:]
+            offset += written
+
+    def recv_into_exact(self, client_socket, view):
+        """
+        接收数据直到填满缓冲区
+
+        Args:
+            client_socket (socket.socket): 客户端套接字
+            view (memoryview): 缓冲区
+
+        Raises:
+            Exception: 连接中断
+        """
+        received = 0
+        while received < len(view):
+            count = client_socket.recv_into(view[received:])
+            if not count:
+                raise Exception("连接中断")
+            received += count
+
+    def recv_exact(self, client_socket, size):
+        """
+        接收指定长度的数据
+
+        Args:
+            client_socket (socket.socket): 客户端套接字
+            size (int): 数据长度
+
+        Raises:
+            Exception: 连接中断
+
+        Returns:
+            bytes: 接收到的数据
+        """
+        data = bytearray(size)
+        self.recv_into_exact(client_socket, memoryview(data))
+        return bytes(data)
+
+    def recv_frame(self, client_socket):
+        """
+        接收一个完整的控制消息帧
+
+        Args:
+            client_socket (socket.socket): 客户端套接字
+
+        Raises:
+            Exception: 服务器返回错误信息
+            Exception: 消息体过长
+
+        Returns:
+            tuple: (消息类型, 标志, 消息体)
+        """
+        msg_type, flags, length = parse_frame_header(self.recv_exact(client_socket, FRAME.size))
+        if length > MAX_MESSAGE_SIZE:
+            raise Exception("消息体过长")
+        body = self.recv_exact(client_socket, length)
+        if msg_type == MSG_ERROR:
+            raise Exception(f"服务器拒绝: {body.decode(errors='replace')}")
+        return msg_type, flags, body
+
+    def check_digest(self, client_socket, hasher, offset):
+        """
+        接收服务器发来的块摘要并与本地计算的结果比较，把校验结果告诉服务器
+
+        校验结果只管发出，不等待服务器回应，接收循环紧接着处理下一个块
+
+        Args:
+            client_socket (socket.socket): 客户端套接字
+            hasher (hashlib.blake2b): 接收数据时同步更新的摘要对象
+            offset (int): 数据块在文件中的偏移量
+
+        Raises:
+            Exception: 接收块摘要超时
+            Exception: 块摘要格式错误
+
+        Returns:
+            bool: 校验通过
+        """
+        try:
+            msg_type, _, body = self.recv_frame(client_socket)
+            if msg_type != MSG_DIGEST or DIGEST.unpack_from(body)[0] != offset:
+                raise ValueError
+        except socket.timeout:
+            raise Exception("接收块摘要超时")
+        except (ValueError, struct.error):
+            raise Exception("块摘要格式错误")
+
+        ok = hasher.digest() == body[DIGEST.size:]
+        # 校验失败时服务器会重传该块
+        client_socket.sendall(pack_frame(MSG_VERDICT, VERDICT.pack(offset), flags=int(ok)))
+        if not ok:
+            self.log(f"偏移量{offset}处的块校验失败，请求重传")
+        return ok
+
+    def receive_chunk(self, client_socket, fd, offset, chunk_size, view, stats, hasher=None, ring=None):
+        """
+        接收一个文件数据块
+
+        数据通过recv_into直接写入预先分配的缓冲区，缓冲区满后按偏移量写入文件，
+        每个连接的内存占用固定为缓冲区大小，与数据块大小无关。开启写回时缓冲区来自ring，
+        填满后交给写入线程，接收线程接着填下一个缓冲区，块的数据全部写入后才返回
+
+        Args:
+            client_socket (socket.socket): 客户端套接字
+            fd (int): 该连接独立打开的文件描述符
+            offset (int): 数据块在文件中的偏移量
+            chunk_size (int): 数据块大小
+            view (memoryview): 该连接可复用的接收缓冲区，使用ring时为None
+            stats (ConnectionStats): 连接的统计
+            hasher (hashlib.blake2b): 块摘要对象，为None时不校验
+            ring (WriteBehind): 该连接的写回缓冲区环，为None时在接收线程中直接写入
+
+        Returns:
+            int: 接收的字节数
+        """
+        # 接收数据块
+        write_pos = offset  # 下一次写入文件的位置
+        filled = 0  # 缓冲区中尚未写入文件的字节数
+        received = 0
+        last_progress_time = time.time()
+        if ring is not None:
+            with stats.measure('wait_time'):
+                view = ring.acquire()
+
+        while received < chunk_size:
+            try:
+                with stats.measure('net_time'):
+                    size = client_socket.recv_into(view[filled:], min(chunk_size - received, len(view) - filled))
+                if not size:
+                    raise Exception("连接中断")
+                filled += size
+                received += size
+
+                # 检查传输是否停滞
+                current_time = time.time()
+                if current_time - last_progress_time > 30:  # 30秒无进展
+                    raise Exception("传输停滞")
+                last_progress_time = current_time
+
+            except socket.timeout:
+                raise Exception("接收数据超时")
+
+            if filled == len(view) or received == chunk_size:
+                if hasher is not None:
+                    hasher.update(view[:filled])  # 写入文件前顺便计算摘要，不需要再读一遍
+                if ring is not None:
+                    ring.submit(view, filled, write_pos)
+                    if received < chunk_size:
+                        with stats.measure('wait_time'):  # 环中的缓冲区都在等待写入时，等待的是磁盘
+                            view = ring.acquire()
+                else:
+                    try:
+                        with stats.measure('disk_time'):
+                            self.write_at(fd, view[:filled], write_pos)
+                    except OSError as e:
+                        raise Exception(f"写入文件错误: {str(e)}")
+                write_pos += filled
+                self.report_received(filled, stats)
+                filled = 0
+
+        if received != chunk_size:
+            raise Exception(f"数据不完整: 预期{chunk_size}字节，实际接收{received}字节")
+        if ring is not None:
+            with stats.measure('wait_time'):
+                ring.flush()  # 块的数据全部写入文件后才能校验和记录完成
+
+        return received
+
+    def receive_mapped_chunk(self, client_socket, offset, chunk_size, stats, hasher=None):
+        """
+        内存映射模式下接收一个文件数据块：recv_into直接写入映射中该块的位置，
+        没有中间缓冲区，也没有写文件的系统调用，多个连接各自填充互不重叠的区域
+
+        Args:
+            client_socket (socket.socket): 客户端套接字
+            offset (int): 数据块在文件中的偏移量
+            chunk_size (int): 数据块大小
+            stats (ConnectionStats): 连接的统计
+            hasher (hashlib.blake2b): 块摘要对象，为None时不校验
+
+        Returns:
+            int: 接收的字节数
+        """
+        with self.mapping_view[offset:offset + chunk_size] as target:
+            received = 0
+            while received < chunk_size:
+                try:
+                    # 数据直接落入映射的页面，缺页和写入都计入网络时间
+                    with stats.measure('net_time'):
+                        size = client_socket.recv_into(target[received:], min(chunk_size - received, self.recv_buffer_size))
+                except socket.timeout:
+                    raise Exception("接收数据超时")
+                if not size:
+                    raise Exception("连接中断")
+                received += size
+                self.report_received(size, stats)
+            if hasher is not None:
+                hasher.update(target)
+        return received
+
+    def open_mapping(self, save_path):
+        """
+        映射已预分配的目标文件，无法映射时保持普通写入
+
+        Args:
+            save_path (str): 保存路径
+        """
+        try:
+            with open(save_path, 'r+b') as f:
+                self.mapping = mmap.mmap(f.fileno(), self.file_size)
+        except (OSError, ValueError) as e:
+            self.log(f"无法映射文件，改为普通写入: {str(e)}")
+            return
+        self.mapping_view = memoryview(self.mapping)
+
+    def close_mapping(self):
+        """把映射中的数据写回文件并释放映射"""
+        if self.mapping is None:
+            return
+        self.mapping_view.release()
+        self.mapping.flush()
+        self.mapping.close()
+        self.mapping = self.mapping_view = None
+
+    def receive_compressed_chunk(self, client_socket, fd, offset, chunk_size, codec, wire_size, stats, hasher=None):
+        """
+        接收一个压缩的文件数据块，解压后按偏移量写入文件
+
+        解压在各连接自己的线程中进行，zlib和lzma解压时释放GIL，多个连接可以并行解压。
+        内存占用不超过一个块的压缩数据加解压结果。
+
+        Args:
+            client_socket (socket.socket): 客户端套接字
+            fd (int): 该连接独立打开的文件描述符
+            offset (int): 数据块在文件中的偏移量
+            chunk_size (int): 数据块解压后的大小
+            codec (int): 压缩算法编号
+            wire_size (int): 压缩后的大小
+            stats (ConnectionStats): 连接的统计
+            hasher (hashlib.blake2b): 块摘要对象，为None时不校验
+
+        Raises:
+            Exception: 解压失败
+
+        Returns:
+            int: 接收的字节数（解压后）
+        """
+        data = bytearray(wire_size)
+        view = memoryview(data)
+        received = 0
+        while received < wire_size:
+            try:
+                with stats.measure('net_time'):
+                    size = client_socket.recv_into(view[received:])
+            except socket.timeout:
+                raise Exception("接收数据超时")
+            if not size:
+                raise Exception("连接中断")
+            received += size
+
+        try:
+            block = decompress_block(codec, data)
+            if len(block) != chunk_size:
+                raise ValueError
+        except Exception:
+            if hasher is None:
+                raise Exception("解压失败")
+            # 开启校验时按校验失败处理：摘要必然不匹配，服务器会重传该块
+            hasher.update(b'corrupt')
+            self.report_received(chunk_size, stats)
+            return chunk_size
+
+        if hasher is not None:
+            hasher.update(block)
+        try:
+            with stats.measure('disk_time'):
+                self.write_at(fd, memoryview(block), offset)
+        except OSError as e:
+            raise Exception(f"写入文件错误: {str(e)}")
+        self.report_received(chunk_size, stats)
+        return chunk_size
+
+    def receive_blocks(self, client_socket, thread_id, save_path, replacement=False):
+        """
+        数据连接的接收循环：逐个接收带偏移量的块，直到收到结束标记
+
+        Args:
+            client_socket (socket.socket): 客户端套接字
+            thread_id (int): 线程ID
+            save_path (str): 保存路径
+            replacement (bool): 是中断的连接的替代连接，沿用原连接的统计，导出时仍是同一条序列
+        """
+        fd = None
+        ring = None
+        blocks = 0
+        total_received = 0
+        block_start = None  # 正在接收的块开始时连接已计入进度的字节数
+        stats = self.metrics.connection(self.session_id, thread_id, 'receive')
+        if replacement:
+            stats.reconnects += 1
+        try:
+            client_socket.settimeout(10)  # 10秒超时
+
+            # 每个连接独立打开文件，写入时不需要共享的文件指针和锁
+            if self.tree:
+                fd = TreeWriter(self.tree, self.write_at)
+            elif self.mapping is not None:
+                fd = self.mapping  # 内存映射模式：所有连接共享映射，各自写入不同的区域
+            else:
+                fd = os.open(save_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+            view = None
+            if self.write_behind and self.mapping is None:
+                # 写回：接收和写盘重叠进行，内存映射模式直接接收到映射中，不需要
+                ring = WriteBehind(lambda data, position: self.write_at(fd, data, position),
+                                   self.recv_buffer_size, self.write_behind, stats)
+            else:
+                view = memoryview(bytearray(self.recv_buffer_size))  # 可复用的接收缓冲区
+            header = memoryview(bytearray(FRAME.size + BLOCK.size))  # 可复用的头部缓冲区
+
+            while True:
+                # 接收帧头部，标志是压缩算法编号，直接在缓冲区上解析，不做字符串解码
+                try:
+                    self.recv_into_exact(client_socket, header[:FRAME.size])
+                    msg_type, codec, length = parse_frame_header(header)
+                    if msg_type == MSG_END:
+                        break  # 服务器没有更多的块
+                    if msg_type != MSG_BLOCK or length < BLOCK.size:
+                        raise Exception("头部信息格式错误")
+                    self.recv_into_exact(client_socket, header[FRAME.size:])
+                    offset, chunk_size = BLOCK.unpack_from(header, FRAME.size)
+                except socket.timeout:
+                    raise Exception("接收头部信息超时")
+
+                wire_size = length - BLOCK.size
+                if chunk_size == 0 or offset + chunk_size > self.file_size:
+                    raise ValueError("无效的数据块大小")
+                if codec == CODEC_RAW and wire_size != chunk_size:
+                    raise ValueError("无效的数据块大小")
+
+                hasher = block_hasher() if self.verify else None
+                block_start = stats.bytes
+                if codec == CODEC_RAW and self.mapping is not None:
+                    total_received += self.receive_mapped_chunk(client_socket, offset, chunk_size, stats, hasher)
+                elif codec == CODEC_RAW:
+                    total_received += self.receive_chunk(client_socket, fd, offset, chunk_size, view, stats, hasher,
+                                                         ring)
+                else:
+                    total_received += self.receive_compressed_chunk(
+                        client_socket, fd, offset, chunk_size, codec, wire_size, stats, hasher
+                    )
+                if hasher is not None and not self.check_digest(client_socket, hasher, offset):
+                    # 校验失败：不记录该块，服务器会在这个连接上重传
+                    total_received -= chunk_size
+                    self.report_received(-chunk_size, stats)
+                    continue
+                blocks += 1
+                stats.blocks += 1
+                if self.block_map:
+                    with stats.measure('wait_time'):  # 位图由所有连接共享，等待的是它的锁
+                        self.block_map.mark(offset)  # 数据已写入文件，记录该块已完成
+                if self.acknowledge and hasher is None:
+                    # 确认块已写入，连接中断时服务器只把未确认的块交给其他连接
+                    client_socket.sendall(pack_frame(MSG_VERDICT, VERDICT.pack(offset), flags=1))
+                block_start = None
+
+            self.log(f"线程{thread_id}接收完成: {blocks}块, {format_size(total_received)}, "
+                     f"{stats.summary()}")
+
+        except Exception as e:
+            if block_start is not None and stats.bytes > block_start:
+                self.report_received(block_start - stats.bytes, stats)  # 未完成的块会重新接收，不计入进度
+            self.log(f"线程{thread_id}接收错误: {str(e)}，已完成{blocks}块, {format_size(total_received)}")
+            raise
+        finally:
+            if ring is not None:
+                ring.close()
+            stats.finish()
+            if isinstance(fd, TreeWriter):
+                fd.close()
+            elif isinstance(fd, int):
+                os.close(fd)
+            client_socket.settimeout(None)
+
+    def hash_range(self, save_path, offset, length):
+        """
+        读回已写入的区间并计算摘要，用于校验乱序到达、无法边收边算摘要的UDP数据
+
+        Args:
+            save_path (str): 保存路径
+            offset (int): 区间起始位置
+            length (int): 区间长度
+
+        Returns:
+            bytes: 摘要
+        """
+        if self.mapping is not None:
+            hasher = block_hasher()
+            hasher.update(self.mapping_view[offset:offset + length])
+            return hasher.digest()
+        if self.tree:
+            return hash_segments(self.tree.segments(offset, length))
+        return hash_segments([(save_path, offset, length)])
+
+    def receive_udp(self, main_socket, udp_socket, save_path):
+        """
+        可靠UDP接收：数据报由接收线程按偏移量直接写入文件并回复确认，
+        本线程在控制连接上接收服务器的块提交消息，校验后记录已完成的块
+
+        Args:
+            main_socket (socket.socket): 控制连接
+            udp_socket (socket.socket): 已绑定的UDP套接字
+            save_path (str): 保存路径
+
+        Raises:
+            Exception: 块提交消息格式错误
+            Exception: 接收块提交消息超时
+            Exception: 接收数据报出错
+        """
+        stats = self.metrics.connection(self.session_id, 0, 'receive')
+        if self.tree:
+            fd = TreeWriter(self.tree, self.write_at)
+        elif self.mapping is not None:
+            fd = self.mapping
+        else:
+            fd = os.open(save_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        receiver = UdpReceiver(udp_socket, lambda data, offset: self.write_at(fd, data, offset),
+                               lambda size: self.report_received(size, stats), self.file_size,
+                               main_socket.getpeername()[0])
+        thread = threading.Thread(target=receiver.run)
+        thread.start()
+        blocks = 0
+        total_received = 0
+        try:
+            main_socket.settimeout(60)
+            while True:
+                try:
+                    msg_type, _, body = self.recv_frame(main_socket)
+                    if receiver.error:
+                        raise Exception(f"接收数据报出错: {str(receiver.error)}")
+                    if msg_type == MSG_END:
+                        break
+                    if msg_type != MSG_COMMIT:
+                        raise ValueError
+                    offset, chunk_size = BLOCK.unpack_from(body)
+                except socket.timeout:
+                    raise Exception("接收块提交消息超时")
+                except (ValueError, struct.error):
+                    raise Exception("块提交消息格式错误")
+
+                digest = body[BLOCK.size:]
+                if digest:
+                    # 块的数据报都已写入文件（接收线程先写入再确认），读回计算摘要
+                    with stats.measure('disk_time'):
+                        ok = self.hash_range(save_path, offset, chunk_size) == digest
+                    main_socket.sendall(pack_frame(MSG_VERDICT, VERDICT.pack(offset), flags=int(ok)))
+                    if not ok:
+                        # 校验失败：服务器会用新的数据报重传该块
+                        self.log(f"偏移量{offset}处的块校验失败，请求重传")
+                        self.report_received(-chunk_size, stats)
+                        continue
+                blocks += 1
+                stats.blocks += 1
+                total_received += chunk_size
+                if self.block_map:
+                    self.block_map.mark(offset)
+
+            self.log(f"UDP接收完成: {blocks}块, {format_size(total_received)}, {stats.summary()}")
+            if receiver.dropped:
+                self.log(f"丢弃了{receiver.dropped}个来源或范围无效的数据报")
+        except Exception as e:
+            self.log(f"UDP接收错误: {str(e)}")
+            raise
+        finally:
+            receiver.stop()
+            thread.join()
+            stats.finish()
+            if isinstance(fd, TreeWriter):
+                fd.close()
+            elif isinstance(fd, int):
+                os.close(fd)
+            main_socket.settimeout(None)
+
+    def open_data_connection(self, server_ip, session_id):
+        """
+        建立一个数据连接并发送问候消息
+
+        Args:
+            server_ip (str): 服务器地址
+            session_id (str): 会话ID
+
+        Returns:
+            socket.socket: 数据连接
+        """
+        # 创建数据连接，使用IPv4协议，TCP协议
+        data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.socket_buffer:
+            # 接收缓冲区要在连接之前设置，TCP窗口缩放因子在握手时确定
+            apply_buffer(data_socket, socket.SO_RCVBUF, self.socket_buffer)
+        data_socket.connect((server_ip, self.port))
+        # 携带会话ID，服务器据此把数据连接归入本次会话
+        data_socket.sendall(pack_hello(MSG_DATA, session_id))
+        return data_socket
+
+    def follow_control(self, main_socket, sockets, add_connections):
+        """
+        多连接传输期间在控制连接上接收服务器的调优消息，直到服务器关闭控制连接，
+        持久会话中服务器不关闭控制连接，而是在文件传输完成时发送结束标记
+
+        Args:
+            main_socket (socket.socket): 控制连接
+            sockets (list): 已建立的数据连接
+            add_connections (callable): 新建数据连接的函数，参数为连接数
+        """
+        while True:
+            try:
+                msg_type, _, body = self.recv_frame(main_socket)
+            except Exception:
+                return  # 所有数据连接结束后服务器关闭控制连接
+            if msg_type == MSG_END:
+                return
+            if msg_type != MSG_TUNE:
+                continue
+            count, buffer = TUNE.unpack(body)
+            if buffer and buffer != self.socket_buffer:
+                self.socket_buffer = buffer
+                self.recv_buffer_size = max(self.recv_buffer_size, min(buffer, self.block_size))
+                for sock in sockets:
+                    apply_buffer(sock, socket.SO_RCVBUF, buffer)
+                self.log(f"服务器调整套接字缓冲区为{format_size(buffer)}")
+            if count:
+                self.log(f"服务器请求新建{count}个数据连接")
+                add_connections(count)
+
+    def preallocate(self, save_path):
+        """
+        为文件中有数据的区间预分配磁盘空间，空洞保持不分配
+
+        Args:
+            save_path (str): 保存路径
+        """
+        if not hasattr(os, 'posix_fallocate'):
+            return
+        extents = self.extents.extents if self.extents else [(0, self.file_size)]
+        fd = os.open(save_path, os.O_WRONLY)
+        try:
+            for offset, length in extents:
+                os.posix_fallocate(fd, offset, length)
+        except OSError as e:
+            self.log(f"无法预分配空间: {str(e)}")  # 例如文件系统不支持，不影响接收
+        finally:
+            os.close(fd)
+
+    def skip_holes(self):
+        """
+        稀疏文件：整块都是空洞的块不会被发送，直接标记为已完成，
+        其余块只会收到数据部分，据此计算进度的起点
+
+        Returns:
+            int: 不需要接收的字节数，包括已完成的块和空洞
+        """
+        block_count = (self.file_size + self.block_size - 1) // self.block_size
+        if self.block_map:
+            indexes = bitmap_blocks(self.block_map.missing_bitmap(), block_count)
+        else:
+            indexes = range(block_count)
+        holes = []
+        expected = 0
+        for index in indexes:
+            offset = index * self.block_size
+            span = self.extents.span(offset, min(self.block_size, self.file_size - offset))
+            if span is None:
+                holes.append(index)
+            else:
+                expected += span[1]
+        if self.block_map and holes:
+            self.block_map.mark_blocks(holes)
+        return self.file_size - expected
+
+    def assemble_chunks(self, save_path, chunks):
+        """
+        把本地块仓库中已有的块写入目标文件
+
+        Args:
+            save_path (str): 保存路径
+            chunks (list): 块清单 [(偏移量, 长度, 摘要)]
+
+        Returns:
+            list: 已写入的区间 [(偏移量, 长度)]，相邻的区间已合并
+        """
+        have = []
+        fd = os.open(save_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            for offset, length, digest in chunks:
+                data = self.chunk_store.get(digest)
+                if data is None or len(data) != length:
+                    continue
+                self.write_at(fd, memoryview(data), offset)
+                if have and sum(have[-1]) == offset:
+                    have[-1] = (have[-1][0], have[-1][1] + length)
+                else:
+                    have.append((offset, length))
+        finally:
+            os.close(fd)
+        return have
+
+    def store_chunks(self, save_path, chunks):
+        """
+        把新接收的块存入本地块仓库，存入前按块清单校验
+
+        Args:
+            save_path (str): 保存路径
+            chunks (list): 块清单 [(偏移量, 长度, 摘要)]
+
+        Raises:
+            Exception: 文件内容与块清单不一致
+        """
+        stored = 0
+        with open(save_path, 'rb') as f:
+            for offset, length, digest in chunks:
+                if digest in self.chunk_store:
+                    continue  # 从仓库组装的块，或文件内重复的块
+                f.seek(offset)
+                data = f.read(length)
+                hasher = block_hasher()
+                hasher.update(data)
+                if hasher.digest() != digest:
+                    raise Exception(f"偏移量{offset}处的数据与块清单不一致")
+                try:
+                    self.chunk_store.put(digest, data)
+                except OSError as e:
+                    self.log(f"无法写入块仓库: {str(e)}")  # 例如磁盘已满，不影响已接收的文件
+                    return
+                stored += 1
+        self.log(f"块仓库新增{stored}块，共{format_size(self.chunk_store.total_size)}")
+
+    def receive_delta(self, main_socket, save_path):
+        """
+        增量接收：发送旧文件的块签名，按服务器的指令从旧文件复制块或写入字面数据，
+        在临时文件中重建新文件，整体校验通过后替换旧文件
+
+        Args:
+            main_socket (socket.socket): 控制连接
+            save_path (str): 保存路径，已有旧版本文件
+
+        Raises:
+            Exception: 增量指令格式错误
+            Exception: 增量重建后的文件校验失败
+        """
+        self.log("发现已有文件，计算签名进行增量传输...")
+        signature = file_signature(save_path, self.delta_block_size)
+        main_socket.sendall(pack_frame(MSG_DELTA, DELTA.pack(self.delta_block_size) + signature))
+
+        temp_path = save_path + DELTA_SUFFIX
+        hasher = block_hasher()
+        view = memoryview(bytearray(self.recv_buffer_size))
+        stats = self.metrics.connection(self.session_id, 0, 'receive')
+        try:
+            # 服务器需要先扫描整个源文件，第一条指令可能要等较长时间
+            main_socket.settimeout(600)
+            with open(save_path, 'rb') as old_file, open(temp_path, 'wb') as new_file:
+                while True:
+                    try:
+                        msg_type, _, length = parse_frame_header(self.recv_exact(main_socket, FRAME.size))
+                        main_socket.settimeout(10)
+                        if msg_type == MSG_FILE_DIGEST:
+                            expected = self.recv_exact(main_socket, length)
+                            break
+                        if msg_type == MSG_COPY:
+                            # 从旧文件复制连续的块
+                            block, count = COPY.unpack(self.recv_exact(main_socket, length))
+                            old_file.seek(block * self.delta_block_size)
+                            remaining = count * self.delta_block_size
+                            source = old_file.readinto
+                        elif msg_type == MSG_LITERAL:
+                            # 从连接接收字面数据，消息体就是数据
+                            remaining = length
+                            source = main_socket.recv_into
+                        else:
+                            raise ValueError
+                    except (ValueError, struct.error):
+                        raise Exception("增量指令格式错误")
+                    except socket.timeout:
+                        raise Exception("接收增量指令超时")
+
+                    while remaining > 0:
+                        try:
+                            with stats.measure('net_time' if msg_type == MSG_LITERAL else 'disk_time'):
+                                size = source(view[:min(remaining, len(view))])
+                        except socket.timeout:
+                            raise Exception("接收数据超时")
+                        if not size:
+                            raise Exception("连接中断" if msg_type == MSG_LITERAL else "旧文件读取不完整")
+                        with stats.measure('disk_time'):
+                            new_file.write(view[:size])
+                        hasher.update(view[:size])
+                        remaining -= size
+                        self.report_received(size, stats if msg_type == MSG_LITERAL else None)
+
+            if hasher.digest() != expected:
+                raise Exception("增量重建后的文件校验失败")
+            os.replace(temp_path, save_path)  # 校验通过后才替换旧文件
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            stats.finish()
+            main_socket.settimeout(None)
+
+    def receive_file(self, main_socket, body, server_ip, sockets, save_dir=None):
+        """
+        接收一个文件或目录：处理文件信息之后的握手，再按协商的方式接收数据
+
+        Args:
+            main_socket (socket.socket): 控制连接
+            body (bytes): 文件信息的消息体
+            server_ip (str): 服务器地址
+            sockets (list): 已建立的数据连接，持久会话中由之后的文件继续使用
+            save_dir (str): 保存目录，为None时由choose_path选择
+
+        Raises:
+            Exception: 握手消息格式错误
+            Exception: 文件未接收完整
+
+        Returns:
+            str: 保存路径，取消接收时为None
+        """
+        # 文件信息，能力位是与服务器协商后使用的功能
+        info = parse_info(body)
+        file_name = info.file_name
+        session_id = self.session_id = info.session_id
+        version = info.version
+        self.verify = bool(info.caps & CAP_VERIFY)
+        self.acknowledge = bool(info.caps & CAP_FAILOVER)
+        self.file_size = info.file_size
+        self.block_size = info.chunk_size
+        self.socket_buffer = info.socket_buffer
+        thread_count = info.thread_count
+        persistent = bool(info.caps & CAP_PERSIST)
+
+        self.extents = None
+        if info.caps & CAP_SPARSE:
+            # 稀疏文件：服务器紧接着发来数据区间，空洞不会被发送
+            msg_type, _, body = self.recv_frame(main_socket)
+            if msg_type != MSG_EXTENTS:
+                raise Exception("空洞信息格式错误")
+            self.extents = ExtentMap.parse(body)
+            self.log(f"稀疏文件: 数据{format_size(self.extents.data_size)}，其余为空洞")
+
+        if self.on_file:
+            self.on_file(info)
+        self.log(f"准备接收{'文件夹' if info.is_dir else '文件'}: {file_name}")
+
+        self.tree = None
+        if info.is_dir:
+            # 目录传输：先取得目录清单，再选择存放目录
+            main_socket.sendall(pack_frame(MSG_MANIFEST_REQUEST))
+            msg_type, _, manifest = self.recv_frame(main_socket)
+            if msg_type != MSG_MANIFEST:
+                raise Exception("目录清单格式错误")
+        if save_dir is not None:
+            # 持久会话的后续文件保存在第一个文件所在的目录，不再询问
+            save_path = os.path.join(save_dir, file_name)
+        else:
+            save_path = self.choose_path(info) if self.choose_path else None
+
+        if not save_path:
+            self.log("用户取消接收")
+            return None
+
+        if info.is_dir:
+            self.tree = Tree.parse(manifest, save_path)
+            self.log(f"目录包含{len(self.tree.files)}个文件")
+
+        # 已有旧版本文件且没有未完成的续传记录时，使用增量传输
+        if (self.delta and info.caps & CAP_DELTA and not self.tree and os.path.isfile(save_path)
+                and not os.path.exists(save_path + MAP_SUFFIX)):
+            self.start_progress()
+            self.receive_delta(main_socket, save_path)
+            self.finish_progress("接收完成！")
+            self.log(f"文件保存至: {save_path}")
+            return save_path
+
+        chunks = None
+        if self.dedup and info.caps & CAP_DEDUP and not self.tree:
+            # 先取得块清单，服务器需要先对文件分块，可能要等一段时间
+            main_socket.sendall(pack_frame(MSG_CHUNKS_REQUEST))
+            msg_type, _, body = self.recv_frame(main_socket)
+            if msg_type != MSG_CHUNKS:
+                raise Exception("块清单格式错误")
+            chunks = parse_chunks(body)
+
+        resumed = False
+        if self.resume:
+            self.block_map, resumed = BlockMap.open(save_path, self.file_size, self.block_size, version)
+
+        completed = 0
+        if resumed:
+            completed = self.block_map.completed_bytes()
+            needed = self.block_map.missing_bitmap()  # 只请求缺失的块
+            self.log(f"继续未完成的传输，已接收{format_size(completed)}")
+        elif not self.tree:
+            # 创建空文件，只设置文件大小，不写入数据，整个文件先是一个空洞
+            with open(save_path, 'wb') as f:
+                f.truncate(self.file_size)
+            if self.preallocate_enabled:
+                self.preallocate(save_path)
+            if chunks:
+                # 本地块仓库中已有的块直接写入文件，告诉服务器不用再发送这些区间
+                have = self.assemble_chunks(save_path, chunks)
+                if have:
+                    main_socket.sendall(pack_frame(MSG_HAVE, ExtentMap(have).pack()))
+                    self.extents = ExtentMap([(0, self.file_size)]).without(have)
+                    self.log(f"本地块仓库中已有"
+                             f"{format_size(self.file_size - self.extents.data_size)}")
+        if self.extents:
+            completed = self.skip_holes()
+        if not resumed:
+            needed = b""  # 空位图表示需要所有块，服务器自己会跳过空洞
+        if self.tree:
+            # 创建目录结构，续传时补齐缺失的文件
+            self.tree.create()
+        elif self.use_mmap and self.file_size:
+            self.open_mapping(save_path)
+
+        udp_socket = None
+        if self.use_udp and info.caps & CAP_UDP:
+            # 可靠UDP：告诉服务器接收数据报的端口，服务器不再等待数据连接。
+            # 每个文件使用新的端口，上一个文件迟到的数据报不会被当作这个文件的数据
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            apply_buffer(udp_socket, socket.SO_RCVBUF, self.udp_buffer)
+            udp_socket.bind(('', 0))
+            main_socket.sendall(pack_frame(MSG_UDP, PORT.pack(udp_socket.getsockname()[1])))
+            self.log("使用可靠UDP传输")
+
+        # 通知服务器准备就绪，附上往返时延（微秒，用于计算带宽时延积）和缺失块的位图
+        main_socket.sendall(pack_frame(MSG_READY, READY.pack(int(self.rtt * 1000000)) + needed))
+
+        self.start_progress(completed)
+
+        # 开始接收文件
+        errors = []  # 多连接接收时没能由替代连接接续的接收错误
+        if udp_socket:
+            try:
+                self.receive_udp(main_socket, udp_socket, save_path)
+            finally:
+                udp_socket.close()
+        elif thread_count == 1:
+            # 单线程接收
+            self.receive_blocks(main_socket, 0, save_path)
+        else:
+            # 多线程接收：每个数据连接一个接收线程
+            threads = []
+            failovers = []  # 已建立的替代连接
+            lock = threading.Lock()
+
+            def run_receiver(i, replacement=False):
+                """第i个数据连接的接收线程，连接中断时建立替代连接，未确认的块由服务器交给其他连接"""
+                try:
+                    self.receive_blocks(sockets[i], i, save_path, replacement)
+                    return
+                except Exception as e:
+                    error = e
+                with lock:
+                    replace = self.acknowledge and len(failovers) < self.max_failovers
+                    if replace:
+                        failovers.append(i)
+                sockets[i].close()  # 立即关闭，服务器随即把这个连接未确认的块交给其他连接
+                if replace:
+                    try:
+                        sockets[i] = self.open_data_connection(server_ip, session_id)
+                    except OSError as e:
+                        error = Exception(f"无法建立替代连接: {str(e)}")
+                    else:
+                        self.log(f"数据连接 {i} 已重新建立")
+                        start_receiver(i, True)
+                        return
+                with lock:
+                    errors.append(error)
+
+            def start_receiver(i, replacement=False):
+                """在第i个数据连接上启动接收线程"""
+                thread = threading.Thread(target=run_receiver, args=(i, replacement))
+                with lock:
+                    threads.append(thread)
+                thread.start()
+
+            def add_connections(count):
+                """创建数据连接，每个连接一个接收线程"""
+                for _ in range(count):
+                    i = len(sockets)
+                    sockets.append(self.open_data_connection(server_ip, session_id))
+                    self.log(f"数据连接 {i} 已建立")
+                    start_receiver(i)
+
+            if sockets:
+                # 持久会话：沿用已建立的数据连接，拥塞窗口不必重新增长
+                for i in range(len(sockets)):
+                    start_receiver(i)
+            else:
+                add_connections(thread_count)
+            # 自动调优时服务器会在传输中途要求增加连接
+            self.follow_control(main_socket, sockets, add_connections)
+
+            # 等待所有线程完成，替代连接的线程在原线程结束之前加入列表
+            for thread in threads:
+                thread.join()
+
+            if not persistent:
+                # 关闭所有数据连接
+                for sock in sockets:
+                    sock.close()
+                sockets.clear()
+
+        self.close_mapping()
+        if errors and not (self.block_map and self.block_map.is_complete()):
+            raise Exception(f"文件未接收完整: {str(errors[0])}")
+        if self.block_map:
+            if not self.block_map.is_complete():
+                raise Exception("文件未接收完整，重新连接可继续接收")
+            self.block_map.close(remove=True)  # 传输完成，删除位图文件
+            self.block_map = None
+        if chunks:
+            self.store_chunks(save_path, chunks)
+
+        self.finish_progress("接收完成！")
+        self.log(f"文件保存至: {save_path}")
+        return save_path
+
+
+    def connect(self, server_ip):
+        """
+        连接服务器并接收文件，持久会话中依次接收服务器发送的所有文件
+
+        Args:
+            server_ip (str): 服务器地址
+
+        Raises:
+            Exception: 文件信息格式错误或接收出错
+
+        Returns:
+            list: 已接收的文件的保存路径
+        """
+        sockets = []  # 数据连接，持久会话中在多个文件之间复用
+        main_socket = None
+        saved = []
+        try:
+            # 主连接用于交换控制信息
+            main_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.log(f"正在连接服务器 {server_ip}...")
+            start = time.perf_counter()
+            main_socket.connect((server_ip, self.port))
+            self.rtt = time.perf_counter() - start  # TCP握手恰好需要一个往返
+            # 问候消息：告诉服务器这是控制连接，服务器为其创建会话
+            main_socket.sendall(pack_hello(MSG_CTRL))
+            if self.on_connected:
+                self.on_connected()
+            self.log("已连接到服务器")
+
+            save_dir = None
+            while True:
+                msg_type, _, body = self.recv_frame(main_socket)
+                if msg_type == MSG_BYE:
+                    self.log("服务器的发送队列已空，会话结束")
+                    break
+                if msg_type != MSG_INFO:
+                    raise Exception("文件信息格式错误")
+                save_path = self.receive_file(main_socket, body, server_ip, sockets, save_dir)
+                if save_path is None:
+                    break
+                saved.append(save_path)
+                if not parse_info(body).caps & CAP_PERSIST:
+                    break
+                # 持久会话：控制连接和数据连接保持打开，等待服务器发送下一个文件
+                save_dir = os.path.dirname(save_path)
+            return saved
+        except Exception:
+            self.close_mapping()
+            if self.block_map:
+                self.block_map.close()  # 保留位图文件，用于下次续传
+                self.block_map = None
+            self.finish_progress("接收出错")
+            raise
+        finally:
+            for sock in sockets:
+                sock.close()
+            if main_socket:
+                main_socket.close()
+
+    def join_swarm(self, server_ip, save_dir):
+        """
+        作为P2P分发的节点下载，完成后继续为其他节点上传，直到所有节点都已完成
+
+        Args:
+            server_ip (str): 源服务器地址
+            save_dir (str): 保存目录
+
+        Raises:
+            Exception: 源服务器拒绝或下载出错
+
+        Returns:
+            str: 保存路径
+        """
+        def on_start(info, completed):
+            self.file_size = info.file_size
+            if self.on_file:
+                self.on_file(info)
+            self.start_progress(completed)
+
+        peer = SwarmPeer(server_ip, self.port, save_dir, listen_port=self.listen_port,
+                         upload_limit=self.upload_limit, on_log=self.log, on_start=on_start,
+                         on_progress=self.report_received)
+        peer.metrics = self.metrics
+        try:
+            save_path = peer.run()
+        except Exception:
+            self.finish_progress("接收出错")
+            raise
+        self.finish_progress("接收完成！")
+        return save_path
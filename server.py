@@ -3,14 +3,17 @@ from tkinter import filedialog, messagebox, ttk
 import socket
 import os
 import threading
-from datetime import datetime
+
+from engine import ServerEngine
+from progress import POLL_INTERVAL, ProgressChannel, format_size
+from tuning import AUTO_STREAMS
 
 class FileServer:
     def __init__(self):
         # 初始化GUI窗口
         self.window = tk.Tk()
         self.window.title("文件传输服务器")
-        self.window.geometry("600x500")
+        self.window.geometry("600x790")
         self.window.configure(bg='#f0f0f0')
         
         # 创建主框架
@@ -34,17 +37,105 @@ class FileServer:
         
         self.select_button = ttk.Button(file_frame, text="选择文件", command=self.select_file)
         self.select_button.pack(side=tk.LEFT, padx=5)
+        
+        self.select_folder_button = ttk.Button(file_frame, text="选择文件夹", command=self.select_folder)
+        self.select_folder_button.pack(side=tk.LEFT, padx=5)
+
+        # 发送队列：持久会话发送完选择的文件后，在同一组连接上依次发送队列中的文件
+        self.queue_button = ttk.Button(file_frame, text="加入队列", command=self.queue_file)
+        self.queue_button.pack(side=tk.LEFT, padx=5)
 
         self.file_label = ttk.Label(file_frame, text="未选择文件")
         self.file_label.pack(side=tk.LEFT, padx=5)
         
-        # 传输模式框架 - 移到这里
+        # 连接数框架：自动调优先用少量连接，按实测吞吐量增减，结果写入日志，可在这里固定
+        streams_frame = ttk.LabelFrame(main_frame, text="连接数", padding="5")
+        streams_frame.pack(fill=tk.X, pady=5)
+        
+        self.thread_var = tk.IntVar(value=1)
+        for text, value in (("单线程传输", 1), ("2线程", 2), ("4线程", 4), ("8线程", 8), ("16线程", 16),
+                            ("自动调优", AUTO_STREAMS)):
+            ttk.Radiobutton(streams_frame, text=text, variable=self.thread_var, value=value,
+                            command=self.update_engine_options).pack(side=tk.LEFT, padx=5)
+        
+        # 套接字缓冲区框架：系统默认时自动调优按带宽时延积调整
+        buffer_frame = ttk.LabelFrame(main_frame, text="套接字缓冲区", padding="5")
+        buffer_frame.pack(fill=tk.X, pady=5)
+        
+        self.socket_buffer_var = tk.IntVar(value=0)
+        for text, value in (("系统默认", 0), ("256KB", 256 * 1024), ("1MB", 1024 * 1024),
+                            ("4MB", 4 * 1024 * 1024), ("16MB", 16 * 1024 * 1024)):
+            ttk.Radiobutton(buffer_frame, text=text, variable=self.socket_buffer_var, value=value,
+                            command=self.update_engine_options).pack(side=tk.LEFT, padx=5)
+        
+        # 块缓存框架：同一文件被多个客户端下载时，热门的块直接从内存发送，运行中也可以修改
+        cache_frame = ttk.LabelFrame(main_frame, text="块缓存", padding="5")
+        cache_frame.pack(fill=tk.X, pady=5)
+        
+        self.cache_size_var = tk.IntVar(value=0)
+        for text, value in (("不缓存", 0), ("256MB", 256 * 1024 * 1024), ("1GB", 1024 * 1024 * 1024),
+                            ("4GB", 4 * 1024 * 1024 * 1024)):
+            ttk.Radiobutton(cache_frame, text=text, variable=self.cache_size_var, value=value,
+                            command=self.update_engine_options).pack(side=tk.LEFT, padx=5)
+        
+        # 传输模式框架
         thread_frame = ttk.LabelFrame(main_frame, text="传输模式", padding="5")
         thread_frame.pack(fill=tk.X, pady=5)
         
-        self.thread_var = tk.IntVar(value=1)
-        ttk.Radiobutton(thread_frame, text="单线程传输", variable=self.thread_var, value=1).pack(side=tk.LEFT, padx=5)
-        ttk.Radiobutton(thread_frame, text="多线程传输(4线程)", variable=self.thread_var, value=4).pack(side=tk.LEFT, padx=5)
+        # 零拷贝发送：由内核直接把页缓存中的数据送入套接字
+        self.zero_copy_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(thread_frame, text="零拷贝发送(sendfile)", variable=self.zero_copy_var,
+                        command=self.update_engine_options).pack(side=tk.LEFT, padx=5)
+        
+        # 内存映射：映射源文件，直接发送映射的切片，不经过中间缓冲区
+        self.mmap_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(thread_frame, text="内存映射(mmap)", variable=self.mmap_var,
+                        command=self.update_engine_options).pack(side=tk.LEFT, padx=5)
+        
+        # 块校验：每个块附加摘要，客户端校验失败的块单独重传
+        self.verify_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(thread_frame, text="块校验", variable=self.verify_var,
+                        command=self.update_engine_options).pack(side=tk.LEFT, padx=5)
+        
+        # 可靠UDP：由客户端选择，长时延、有丢包的链路上代替TCP数据连接
+        self.udp_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(thread_frame, text="允许UDP", variable=self.udp_var,
+                        command=self.update_engine_options).pack(side=tk.LEFT, padx=5)
+        
+        # 保持连接：客户端支持时一个文件传输完成后不断开，继续发送队列中的文件
+        self.keep_alive_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(thread_frame, text="保持连接", variable=self.keep_alive_var,
+                        command=self.update_engine_options).pack(side=tk.LEFT, padx=5)
+        
+        # P2P分发：同一个文件发给很多接收方时，接收方之间互相交换块，服务器只作为种子
+        self.swarm_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(thread_frame, text="P2P分发", variable=self.swarm_var,
+                        command=self.update_engine_options).pack(side=tk.LEFT, padx=5)
+        
+        # 压缩框架：按块压缩，不可压缩的块仍按原始数据发送
+        compress_frame = ttk.LabelFrame(main_frame, text="压缩", padding="5")
+        compress_frame.pack(fill=tk.X, pady=5)
+        
+        self.compression_var = tk.StringVar(value="")
+        for text, value in (("不压缩", ""), ("zlib", "zlib"), ("lzma", "lzma")):
+            ttk.Radiobutton(compress_frame, text=text, variable=self.compression_var, value=value,
+                            command=self.update_engine_options).pack(side=tk.LEFT, padx=5)
+        
+        # 限速框架：所有会话合计的上限和每个会话的上限，带宽不足时各会话公平分配，传输中也可以修改
+        limit_frame = ttk.LabelFrame(main_frame, text="限速(MB/s，0表示不限)", padding="5")
+        limit_frame.pack(fill=tk.X, pady=5)
+        
+        ttk.Label(limit_frame, text="总计:").pack(side=tk.LEFT, padx=5)
+        self.rate_limit_entry = ttk.Entry(limit_frame, width=8)
+        self.rate_limit_entry.insert(0, "0")
+        self.rate_limit_entry.pack(side=tk.LEFT, padx=5)
+        
+        ttk.Label(limit_frame, text="每个会话:").pack(side=tk.LEFT, padx=5)
+        self.session_rate_limit_entry = ttk.Entry(limit_frame, width=8)
+        self.session_rate_limit_entry.insert(0, "0")
+        self.session_rate_limit_entry.pack(side=tk.LEFT, padx=5)
+        
+        ttk.Button(limit_frame, text="应用", command=self.apply_rate_limits).pack(side=tk.LEFT, padx=5)
         
         # 控制框架
         control_frame = ttk.LabelFrame(main_frame, text="控制", padding="5")
@@ -53,6 +144,12 @@ class FileServer:
         self.start_button = ttk.Button(control_frame, text="启动服务器", command=self.start_server)
         self.start_button.pack(side=tk.LEFT, padx=5)
         
+        self.stop_button = ttk.Button(control_frame, text="停止服务器", command=self.stop_server, state=tk.DISABLED)
+        self.stop_button.pack(side=tk.LEFT, padx=5)
+        
+        self.export_button = ttk.Button(control_frame, text="导出统计", command=self.export_metrics)
+        self.export_button.pack(side=tk.LEFT, padx=5)
+        
         # 进度框架
         progress_frame = ttk.LabelFrame(main_frame, text="传输进度", padding="5")
         progress_frame.pack(fill=tk.X, pady=5)
@@ -81,10 +178,10 @@ class FileServer:
         
         # 初始化变量
         self.selected_file = None
-        self.server_socket = None
-        self.chunk_size = 1024 * 1024  # 每个块1MB
-        self.total_sent = 0
-        self.lock = threading.Lock()  # 线程锁
+        self.jobs = []  # 发送队列，启动服务器时交给引擎
+        self.engine = None  # 传输引擎，启动服务器时创建
+        self.channel = ProgressChannel()  # 引擎线程只向通道放入事件，界面线程定时取出
+        self.window.after(POLL_INTERVAL, self.poll_channel)
     
     def get_local_ip(self):
         """
@@ -117,14 +214,23 @@ class FileServer:
 
     def log_message(self, message):
         """
-        记录日志
+        记录日志，可以在任意线程中调用，由界面线程统一显示
 
         Args:
             message (str): 日志消息
         """
-        current_time = datetime.now().strftime("%H:%M:%S")
-        self.log_text.insert(tk.END, f"[{current_time}] {message}\n")
-        self.log_text.see(tk.END) # 滚动到最新日志
+        self.channel.log(message)
+    
+
+    def poll_channel(self):
+        """界面线程定时执行：显示期间累积的日志和事件，并刷新一次进度"""
+        text = self.channel.poll()
+        if text:
+            self.log_text.insert(tk.END, text)
+            self.log_text.see(tk.END) # 滚动到最新日志
+        if self.engine and self.engine.sessions:
+            self.update_progress()
+        self.window.after(POLL_INTERVAL, self.poll_channel)
     
 
     def select_file(self):
@@ -133,114 +239,97 @@ class FileServer:
         if self.selected_file:
             file_name = os.path.basename(self.selected_file)  # 获取文件名
             file_size = os.path.getsize(self.selected_file)  # 获取文件大小
-            size_str = self.format_size(file_size)  # 格式化文件大小
+            size_str = format_size(file_size)  # 格式化文件大小
             self.file_label.config(text=f"已选择: {file_name} ({size_str})")  # 更新文件标签
             self.log_message(f"已选择文件: {file_name}")  # 记录日志
+            self.update_engine_options()  # 服务器运行中也可以更换文件，之后的会话发送新文件
     
 
-    def format_size(self, size):
-        """
-        格式化文件大小
+    def select_folder(self):
+        """选择文件夹，整个目录树作为一次传输"""
+        folder = filedialog.askdirectory()  # 选择文件夹
+        if folder:
+            self.selected_file = folder
+            folder_name = os.path.basename(os.path.normpath(folder))
+            self.file_label.config(text=f"已选择文件夹: {folder_name}")
+            self.log_message(f"已选择文件夹: {folder_name}")
+            self.update_engine_options()
+    
 
-        Args:
-            size (int): 文件大小
+    def queue_file(self):
+        """选择文件加入发送队列，服务器运行中加入时正在等待的持久会话随即发送"""
+        file_path = filedialog.askopenfilename()
+        if file_path:
+            self.jobs.append(file_path)
+            if self.engine:
+                self.engine.add_job(file_path)
+            self.log_message(f"已加入队列: {os.path.basename(file_path)}（队列中共{len(self.jobs)}个文件）")
+            if not self.keep_alive_var.get():
+                self.log_message("提示: 勾选“保持连接”后才会发送队列中的文件")
+    
 
-        Returns:
-            str: 格式化后的文件大小
-        """
-        for unit in ['B', 'KB', 'MB', 'GB']:
-            if size < 1024:
-                return f"{size:.2f} {unit}"
-            size /= 1024
-        return f"{size:.2f} TB"
+    def update_engine_options(self):
+        """把界面上的传输设置同步给引擎，除块缓存外只影响之后建立的会话"""
+        if self.engine:
+            self.engine.file_path = self.selected_file
+            self.engine.thread_count = self.thread_var.get()
+            self.engine.socket_buffer_size = self.socket_buffer_var.get()
+            self.engine.zero_copy = self.zero_copy_var.get()
+            self.engine.use_mmap = self.mmap_var.get()
+            self.engine.verify = self.verify_var.get()
+            self.engine.allow_udp = self.udp_var.get()
+            self.engine.keep_alive = self.keep_alive_var.get()
+            self.engine.swarm = self.swarm_var.get()
+            self.engine.compression = self.compression_var.get() or None
+            self.engine.set_cache_size(self.cache_size_var.get())
     
 
-    def send_file_chunk(self, client_socket, start_pos, chunk_size, thread_id):
+    def apply_rate_limits(self):
         """
-        发送文件块
-
-        Args:
-            client_socket (socket.socket): 客户端套接字
-            start_pos (int): 开始位置
-            chunk_size (int): 块大小
-            thread_id (int): 线程ID
+        把界面上的限速设置交给引擎，正在进行的传输立即生效
 
-        Raises:
-            FileNotFoundError: 文件不存在或已被移动
-            PermissionError: 没有文件读取权限
-            Exception: 文件读取不完整
-            Exception: 网络超时
-            Exception: 网络连接错误
-            Exception: 发送数据超时
-            Exception: 连接被客户端重置
+        Returns:
+            bool: 设置有效
         """
         try:
-            if not os.path.exists(self.selected_file):
-                raise FileNotFoundError("文件不存在或已被移动")
-            
-            if not os.access(self.selected_file, os.R_OK):
-                raise PermissionError("没有文件读取权限")
-            
-            with open(self.selected_file, 'rb') as f:
-                # 这里是每个线程独立读取文件
-                f.seek(start_pos)  # 设置文件指针到开始位置
-                data = f.read(chunk_size)  # 读取指定大小的数据
-                
-                if len(data) != chunk_size and thread_id != self.thread_var.get() - 1:
-                    raise Exception("文件读取不完整")
-                    
-                # 使用固定长度的头部信息
-                # 线程ID: 4位整数  数据长度: 10位整数
-                header = f"{thread_id:04d}|{len(data):010d}".encode()
+            rate_limit = float(self.rate_limit_entry.get() or 0)
+            session_rate_limit = float(self.session_rate_limit_entry.get() or 0)
+            if rate_limit < 0 or session_rate_limit < 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("错误", "限速必须是不小于0的数字！")
+            return False
+        if self.engine:
+            self.engine.set_rate_limits(int(rate_limit * 1024 * 1024), int(session_rate_limit * 1024 * 1024))
+        return True
+    
+
+    def update_progress(self):
+        """刷新所有活动会话的总进度，由poll_channel定时调用"""
+        sessions = list(self.engine.sessions.values())
+        total_size = sum(s.file_size for s in sessions) or 1
+        total_sent = sum(s.total_sent for s in sessions)
+        progress = (total_sent / total_size) * 100
+        self.progress_bar['maximum'] = total_size
+        self.progress_bar['value'] = total_sent
+        self.progress_label.config(
+            text=f"活动会话: {len(sessions)}  传输进度: {progress:.2f}% ({format_size(total_sent)}/{format_size(total_size)})"
+        )
+    
 
-                # 将字节串左对齐，填充到20字节
-                header = header.ljust(20, b' ')
-                
-                try:
-                    # 设置超时
-                    client_socket.settimeout(10)  # 10秒超时
-                    
-                    # 先发送头部，再发送数据
-                    client_socket.sendall(header)
-                    
-                    # 等待确认，带超时
-                    if not client_socket.recv(1):
-                        raise Exception("客户端未确认接收")
-                    
-                    # 分块发送数据
-                    total_sent = 0
-                    buffer_size = 8192  # 缓冲区大小，8192B = 8KB
-                    while total_sent < len(data):
-                        try:
-                            end = min(total_sent + buffer_size, len(data))
-                            client_socket.sendall(data[total_sent:end])
-                            total_sent = end
-                        except socket.timeout:
-                            raise Exception("发送数据超时")
-                        except ConnectionResetError:
-                            raise Exception("连接被客户端重置")
-                    
-                    # 使用锁：保护共享资源
-                    with self.lock:
-                        self.total_sent += len(data)
-                        progress = (self.total_sent / self.file_size) * 100
-                        self.progress_bar['value'] = self.total_sent
-                        self.progress_label.config(
-                            text=f"传输进度: {progress:.2f}% ({self.format_size(self.total_sent)}/{self.format_size(self.file_size)})"
-                        )
+    def on_session_end(self, session):
+        """
+        会话结束：没有其他活动会话时显示最终状态
 
-                    self.log_message(f"线程{thread_id}完成传输: {self.format_size(len(data))}")
-                    
-                except socket.timeout:
-                    raise Exception("网络超时")
-                except ConnectionError:
-                    raise Exception("网络连接错误")
-                finally:
-                    client_socket.settimeout(None)  # 恢复默认超时设置
-                    
-        except Exception as e:
-            self.log_message(f"线程{thread_id}传输错误: {str(e)}")
-            raise  # 重新抛出异常，确保主线程知道传输失败
+        Args:
+            session (Session): 结束的会话
+        """
+        if self.engine.sessions:
+            self.update_progress()
+        elif session.error is None:
+            self.progress_label.config(text="传输完成！")
+        else:
+            self.progress_label.config(text="传输出错")
     
 
     def start_server(self):
@@ -253,122 +342,72 @@ class FileServer:
             messagebox.showerror("错误", "文件不存在或已被移动！")
             return
         
-        if os.path.getsize(self.selected_file) == 0:
+        if os.path.isfile(self.selected_file) and os.path.getsize(self.selected_file) == 0:
             messagebox.showerror("错误", "不能传输空文件！")
             return
         
+        if self.thread_var.get() < 0:
+            messagebox.showerror("错误", "线程数不能小于0")
+            return
+        
+        if not self.apply_rate_limits():
+            return
+        
+        # 一个事件循环线程服务所有客户端，服务器持续监听直到点击停止
+        self.engine = ServerEngine(
+            on_log=self.log_message,
+            on_session_end=lambda session: self.channel.call(self.on_session_end, session),
+            on_started=lambda: self.channel.call(self.status_label.config, text="运行中", foreground="green"),
+        )
+        self.update_engine_options()
+        self.apply_rate_limits()
+        for file_path in self.jobs:
+            self.engine.add_job(file_path)
+        self.start_button.config(state=tk.DISABLED)
+        self.stop_button.config(state=tk.NORMAL)
+        
         def server_thread():
-            """
-            服务器线程
-
-            Raises:
-                ValueError: 线程数必须大于0
-                Exception: 等待客户端连接超时
-                Exception: 等待客户端连接超时
-            """
+            """服务器线程，运行引擎的事件循环"""
             try:
-                thread_count = self.thread_var.get()  # 获取线程数
-                if thread_count <= 0:
-                    raise ValueError("线程数必须大于0")
-                
-                # 创建套接字，使用IPv4协议，TCP协议
-                self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                # 设置套接字选项，允许重用地址
-                # 允许重用：当服务器程序关闭时，OS会将端口保持在TIME_WAIT状态，
-                # 此时如果重启服务器，新创建的套接字可能会因为端口被占用而失败
-                # 设置SO_REUSEADDR选项，可以让OS在TIME_WAIT状态下立即重用该端口
-                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                
-                try:
-                    # 0.0.0.0: 表示监听所有网卡上的所有IP地址
-                    # 9999: 监听的端口号
-                    self.server_socket.bind(('0.0.0.0', 9999))  # 绑定到0.0.0.0:9999
-                except OSError as e:
-                    if e.errno == 98:  # 地址已被使用
-                        raise Exception("端口9999已被占用，请关闭其他服务器实例")
-                    raise
-                
-                # 监听连接，最多允许thread_count个连接
-                self.server_socket.listen(thread_count)
-                self.status_label.config(text="等待连接...", foreground="orange")
-                self.log_message("服务器已启动，等待客户端连接...")
-                
-                # 设置accept超时
-                self.server_socket.settimeout(60)  # 60秒超时
-                try:
-                    # 从连接队列中取出一个客户端连接请求
-                    # 创建一个新套接字，用于与客户端通信
-                    # 返回一个新套接字和客户端地址
-                    main_socket, addr = self.server_socket.accept()
-                except socket.timeout:
-                    raise Exception("等待客户端连接超时")
-                
-                # 发送文件信息
-                file_name = os.path.basename(self.selected_file)
-                self.file_size = os.path.getsize(self.selected_file)
-                file_info = f"{file_name}|{self.file_size}|{thread_count}".encode()
-                main_socket.send(file_info)
-                main_socket.recv(1024)  # 等待客户端确认，1024为缓冲区大小
-                
-                self.total_sent = 0
-                self.progress_bar['maximum'] = self.file_size
-                
-                if thread_count == 1:
-                    # 单线程传输
-                    self.send_file_chunk(main_socket, 0, self.file_size, 0)
-                    main_socket.close()
-                else:
-                    # 多线程传输
-                    chunk_size = self.file_size // thread_count
-                    threads = []
-                    sockets = []
-
-                    # 等待所有数据连接建立
-                    for i in range(thread_count):
-                        data_socket, _ = self.server_socket.accept()
-                        sockets.append(data_socket)
-                        self.log_message(f"数据连接 {i} 已建立")
-
-                    for i in range(thread_count):
-                        start_pos = i * chunk_size
-                        # 最后一个线程处理剩余所有数据
-                        if i == thread_count - 1:
-                            chunk_size = self.file_size - start_pos
-                        
-                        # 创建线程，每个线程独立读取文件
-                        thread = threading.Thread(
-                            target=self.send_file_chunk,
-                            args=(sockets[i], start_pos, chunk_size, i)
-                        )
-                        threads.append(thread)
-                        thread.start()
-
-                    # 等待所有线程完成
-                    for thread in threads:
-                        thread.join()
-
-                    # 关闭所有数据连接
-                    for sock in sockets:
-                        sock.close()
-                    main_socket.close()
-                
-                self.progress_label.config(text="传输完成！")
-                self.log_message("文件传输完成")
-                self.server_socket.close()
-                
+                self.engine.run()
+                self.channel.call(self.status_label.config, text="已停止", foreground="red")
             except Exception as e:
-                messagebox.showerror("错误", f"传输出错：{str(e)}")
-                self.status_label.config(text="出错", foreground="red")
+                self.channel.call(messagebox.showerror, "错误", f"服务器出错：{str(e)}")
+                self.channel.call(self.status_label.config, text="出错", foreground="red")
                 self.log_message(f"错误: {str(e)}")
             finally:
-                try:
-                    if hasattr(self, 'server_socket'):
-                        self.server_socket.close()
-                except:
-                    pass
+                self.channel.call(self.start_button.config, state=tk.NORMAL)
+                self.channel.call(self.stop_button.config, state=tk.DISABLED)
         
-        threading.Thread(target=server_thread).start()
+        threading.Thread(target=server_thread, daemon=True).start()
+    
+
+    def stop_server(self):
+        """停止服务器"""
+        if self.engine:
+            self.engine.stop()
     
+
+    def export_metrics(self):
+        """把各连接的传输统计导出到文件"""
+        if not self.engine:
+            messagebox.showerror("错误", "服务器尚未启动，没有统计数据！")
+            return
+        path = filedialog.asksaveasfilename(
+            defaultextension='.jsonl',
+            filetypes=[("JSON行", "*.jsonl"), ("Prometheus文本", "*.prom")],
+            title="导出统计"
+        )
+        if not path:
+            return
+        try:
+            self.engine.metrics.export(path)
+        except OSError as e:
+            self.log_message(f"导出统计失败: {str(e)}")
+            return
+        self.log_message(f"统计已导出至: {path}")
+    
+
     def run(self):
         self.window.mainloop()
 
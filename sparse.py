@@ -0,0 +1,139 @@
+import bisect
+import errno
+import os
+import struct
+
+EXTENT = struct.Struct('!QQ')  # 数据区间: 偏移量 长度
+
+
+def data_extents(path, file_size):
+    """
+    用SEEK_DATA/SEEK_HOLE列出文件中实际存有数据的区间
+
+    文件系统或平台不支持时，整个文件被看作一个数据区间
+
+    Args:
+        path (str): 文件路径
+        file_size (int): 文件大小
+
+    Returns:
+        list: [(偏移量, 长度)]，按偏移量排列
+    """
+    if not hasattr(os, 'SEEK_DATA') or not file_size:
+        return [(0, file_size)] if file_size else []
+    extents = []
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        offset = 0
+        while offset < file_size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break  # 之后全是空洞
+                return [(0, file_size)]
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), file_size)
+            if end <= start:
+                break
+            extents.append((start, end - start))
+            offset = end
+    finally:
+        os.close(fd)
+    return extents
+
+
+class ExtentMap:
+    """
+    稀疏文件的数据区间
+
+    块仍按固定大小划分，块内开头和结尾的空洞不发送，整块都是空洞的块直接跳过。
+    块内数据区间之间的小空洞随块一起发送，这样每个块最多对应一个发送区间，
+    块队列、断点续传位图和块校验都不需要改变。
+    """
+
+    def __init__(self, extents):
+        """
+        Args:
+            extents (list): [(偏移量, 长度)]，按偏移量排列且互不重叠
+        """
+        self.extents = extents
+        self.starts = [offset for offset, _ in extents]
+        self.ends = [offset + length for offset, length in extents]
+        self.data_size = sum(length for _, length in extents)
+
+    @classmethod
+    def parse(cls, body):
+        """
+        解析对方发来的区间列表
+
+        Args:
+            body (bytes): 消息体
+
+        Raises:
+            ValueError: 区间列表格式错误
+
+        Returns:
+            ExtentMap: 数据区间
+        """
+        if len(body) % EXTENT.size:
+            raise ValueError("区间列表格式错误")
+        return cls(list(EXTENT.iter_unpack(body)))
+
+    def pack(self):
+        """
+        打包数据区间，在握手时发送给客户端
+
+        Returns:
+            bytes: 依次排列的(偏移量, 长度)
+        """
+        return b''.join(EXTENT.pack(offset, length) for offset, length in self.extents)
+
+    def without(self, ranges):
+        """
+        去掉接收方已有的区间，剩下的才需要发送
+
+        Args:
+            ranges (list): [(偏移量, 长度)]
+
+        Returns:
+            ExtentMap: 剩余的数据区间
+        """
+        ranges = sorted(ranges)
+        remaining = []
+        first = 0
+        for start, length in self.extents:
+            end = start + length
+            pos = start
+            while first < len(ranges) and sum(ranges[first]) <= pos:
+                first += 1  # 已有区间在当前数据区间之前结束
+            index = first
+            while index < len(ranges) and ranges[index][0] < end:
+                have_start, have_end = ranges[index][0], sum(ranges[index])
+                if have_start > pos:
+                    remaining.append((pos, have_start - pos))
+                pos = max(pos, have_end)
+                if have_end > end:
+                    break  # 已有区间跨到下一个数据区间
+                index += 1
+            if pos < end:
+                remaining.append((pos, end - pos))
+        return ExtentMap(remaining)
+
+    def span(self, offset, length):
+        """
+        块中需要发送的区间：从块内第一个数据字节到最后一个数据字节
+
+        Args:
+            offset (int): 块的开始位置
+            length (int): 块大小
+
+        Returns:
+            tuple: (偏移量, 长度)，整块都是空洞时为None
+        """
+        end = offset + length
+        first = bisect.bisect_right(self.ends, offset)  # 第一个在块开始之后结束的区间
+        last = bisect.bisect_left(self.starts, end) - 1  # 最后一个在块结束之前开始的区间
+        if first > last:
+            return None
+        start = max(offset, self.starts[first])
+        return start, min(end, self.ends[last]) - start
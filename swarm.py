@@ -0,0 +1,762 @@
+import asyncio
+import os
+import random
+
+from blockmap import BlockMap, bitmap_blocks
+from integrity import DIGEST_SIZE, block_hasher
+from metrics import Metrics
+from protocol import (BLOCK, INDEX, MSG_ANNOUNCE, MSG_BITFIELD, MSG_BLOCK, MSG_BYE, MSG_END, MSG_ERROR,
+                      MSG_HAVE_BLOCK, MSG_INFO, MSG_PEER, MSG_PEERS, MSG_PIECES, MSG_REQUEST, MSG_SWARM, PORT,
+                      pack_frame, pack_hello, parse_hello, parse_info, parse_peers, read_frame)
+from ratelimit import BandwidthScheduler, Share
+
+ORIGIN = 'origin'  # 源服务器在节点列表之外，用这个ID表示
+PIPELINE = 4  # 每个下载连接同时请求的块数，隐藏请求的往返时延
+MAX_LINKS = 12  # 每个节点最多同时从几个其他节点下载，不含源服务器
+ENDGAME_COPIES = 2  # 最后阶段同一个块最多同时向几个节点请求，避免被最慢的节点拖住
+CONNECT_TIMEOUT = 10  # 连接其他节点的超时时间，秒
+
+
+def has_block(bitmap, index):
+    """
+    位图中是否有某个块
+
+    Args:
+        bitmap (bytes): 位图，第i位对应第i个块
+        index (int): 块号
+
+    Returns:
+        bool: 已有该块
+    """
+    return bool(bitmap[index >> 3] & (1 << (index & 7)))
+
+
+class BlockSource:
+    """
+    一个节点对外提供的块：文件和已有块的位图
+
+    源服务器的位图全部置位；接收方的位图与BlockMap共用同一个bytearray，
+    块校验通过并写入文件之后才置位，所以对外提供的块一定是完整的。
+    """
+
+    def __init__(self, path, file_size, block_size, bitmap):
+        """
+        Args:
+            path (str): 文件路径
+            file_size (int): 文件大小
+            block_size (int): 块大小
+            bitmap (bytearray): 已有块的位图
+        """
+        self.path = path
+        self.file_size = file_size
+        self.block_size = block_size
+        self.block_count = (file_size + block_size - 1) // block_size
+        self.bitmap = bitmap
+        self.served = [0] * self.block_count  # 每个块已上传的次数
+        self.listeners = set()  # 每个上传连接一个队列，得到新块时放入块号
+
+    @classmethod
+    def complete(cls, path, file_size, block_size):
+        """
+        拥有全部块的来源，源服务器使用
+
+        Args:
+            path (str): 文件路径
+            file_size (int): 文件大小
+            block_size (int): 块大小
+
+        Returns:
+            BlockSource: 来源
+        """
+        block_count = (file_size + block_size - 1) // block_size
+        bitmap = bytearray(b'\xff' * ((block_count + 7) // 8))
+        return cls(path, file_size, block_size, bitmap)
+
+    def block_length(self, index):
+        """
+        块的实际长度，最后一个块可能不足block_size
+
+        Args:
+            index (int): 块号
+
+        Returns:
+            int: 块长度
+        """
+        return min(self.block_size, self.file_size - index * self.block_size)
+
+    def choose(self, wanted, sent):
+        """
+        替下载方选择一个块：对方想要的块中上传次数最少的，相同时随机
+
+        源服务器用这种方式让各节点先拿到不同的块，每个块尽量只从源服务器发出一次，
+        其余的副本在节点之间交换。
+
+        Args:
+            wanted (bytes): 下载方想要的块的位图
+            sent (set): 已经发给这个下载方的块号
+
+        Returns:
+            int: 块号，没有可选的块时为None
+        """
+        best = None
+        best_key = None
+        for index in bitmap_blocks(wanted, self.block_count):
+            if index in sent or not has_block(self.bitmap, index):
+                continue
+            key = (self.served[index], random.random())
+            if best_key is None or key < best_key:
+                best, best_key = index, key
+        return best
+
+    def add(self, index):
+        """
+        得到了新块，通知所有上传连接转告对方
+
+        Args:
+            index (int): 块号
+        """
+        for queue in self.listeners:
+            queue.put_nowait(index)
+
+    def read(self, index):
+        """
+        读取一个块，在线程池中调用
+
+        Args:
+            index (int): 块号
+
+        Raises:
+            Exception: 文件读取不完整
+
+        Returns:
+            bytes: 块数据
+        """
+        offset = index * self.block_size
+        length = self.block_length(index)
+        fd = os.open(self.path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            if hasattr(os, 'pread'):
+                data = os.pread(fd, length, offset)
+            else:
+                os.lseek(fd, offset, os.SEEK_SET)
+                data = os.read(fd, length)
+        finally:
+            os.close(fd)
+        if len(data) != length:
+            raise Exception("文件读取不完整")
+        return data
+
+
+async def announce_blocks(writer, queue):
+    """
+    把新得到的块号转告下载方
+
+    Args:
+        writer (asyncio.StreamWriter): 上传连接的写入流
+        queue (asyncio.Queue): 新块号的队列
+    """
+    while True:
+        index = await queue.get()
+        writer.write(pack_frame(MSG_HAVE_BLOCK, INDEX.pack(index)))
+
+
+async def serve_blocks(reader, writer, source, scheduler, share, stats):
+    """
+    上传方：先发送已有块的位图，之后得到新块时通知对方，按对方的请求逐个发送块
+
+    请求的消息体是块号时发送该块；是位图时由本节点从中选择上传次数最少的块，
+    没有可选的块时回复MSG_END。源服务器和接收方都用这个函数向其他节点上传，
+    上传前经过带宽调度器，源服务器的上行带宽因此在所有下载方之间公平分配。
+
+    Args:
+        reader (asyncio.StreamReader): 读取流
+        writer (asyncio.StreamWriter): 写入流
+        source (BlockSource): 本节点的块
+        scheduler (BandwidthScheduler): 本节点的带宽调度器
+        share (Share): 这个连接在调度器中的份额
+        stats (ConnectionStats): 这个连接的统计
+
+    Raises:
+        Exception: 请求格式错误或请求的块本节点没有
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    source.listeners.add(queue)
+    writer.write(pack_frame(MSG_BITFIELD, bytes(source.bitmap)))
+    announcer = asyncio.create_task(announce_blocks(writer, queue))
+    sent = set()  # 已发给对方的块，按位图请求时不再重复选择
+    try:
+        while True:
+            msg_type, _, body = await read_frame(reader)
+            if msg_type != MSG_REQUEST or len(body) not in (INDEX.size, len(source.bitmap)):
+                raise Exception("块请求格式错误")
+            if len(body) == INDEX.size:
+                (index,) = INDEX.unpack(body)
+                if index >= source.block_count or not has_block(source.bitmap, index):
+                    raise Exception(f"请求的块{index}不存在")
+            else:
+                index = source.choose(body, sent)
+                if index is None:
+                    writer.write(pack_frame(MSG_END))
+                    continue
+            sent.add(index)
+            source.served[index] += 1
+            with stats.measure('disk_time'):
+                data = await loop.run_in_executor(None, source.read, index)
+            wait = scheduler.reserve(share, len(data))
+            if wait is not None:
+                with stats.measure('wait_time'):
+                    await wait
+            writer.write(pack_frame(MSG_BLOCK, BLOCK.pack(index * source.block_size, len(data)) + data))
+            with stats.measure('net_time'):
+                await writer.drain()
+            stats.add(len(data), 1)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass  # 对方已下载完成或离开
+    finally:
+        source.listeners.discard(queue)
+        announcer.cancel()
+        stats.finish()
+
+
+class Member:
+    """在源服务器上登记的一个节点"""
+
+    def __init__(self, host, port, writer):
+        """
+        Args:
+            host (str): 节点地址
+            port (int): 节点接受其他节点连接的端口
+            writer (asyncio.StreamWriter): 节点与源服务器之间连接的写入流
+        """
+        self.host = host
+        self.port = port
+        self.writer = writer
+        self.done = False  # 节点已收到全部块，之后只做上传
+
+
+class Tracker:
+    """
+    源服务器上一个文件的P2P分发：所有块的摘要和登记的节点
+
+    源服务器既是种子也是tracker。节点注册后得到块摘要和节点列表，节点加入或离开时
+    列表推送给所有节点；所有节点都完成后通知它们结束，最后完成的节点之前一直在为其他节点上传。
+    """
+
+    def __init__(self, source, file_name, version, digests):
+        """
+        Args:
+            source (BlockSource): 源文件的块
+            file_name (str): 文件名
+            version (str): 文件版本
+            digests (list): 每个块的摘要
+        """
+        self.source = source
+        self.file_name = file_name
+        self.version = version
+        self.digests = digests
+        self.members = {}  # 节点ID -> Member
+
+    def peers(self):
+        """
+        当前的节点列表
+
+        Returns:
+            list: [(节点ID, 主机, 端口)]
+        """
+        return [(peer_id, member.host, member.port) for peer_id, member in self.members.items()]
+
+    def broadcast(self, frame):
+        """
+        向所有节点发送一帧
+
+        Args:
+            frame (bytes): 帧
+        """
+        for member in self.members.values():
+            member.writer.write(frame)
+
+    def finished(self):
+        """
+        已完成的节点数
+
+        Returns:
+            int: 节点数
+        """
+        return sum(member.done for member in self.members.values())
+
+
+class Link:
+    """从一个上传方下载的连接"""
+
+    def __init__(self, peer_id):
+        """
+        Args:
+            peer_id (str): 上传方的节点ID
+        """
+        self.peer_id = peer_id
+        self.writer = None
+        self.have = None  # 上传方已有块的位图，收到MSG_BITFIELD之前为None
+        self.requested = set()  # 已请求、尚未收到的块号
+        self.pending = 0  # 由上传方选块、尚未收到的请求数
+
+
+class SwarmPeer:
+    """
+    P2P分发的接收方：从源服务器取得块摘要和节点列表，同时从源服务器和其他节点下载块，
+    并把已经得到的块上传给其他节点
+
+    选块时优先选择已连接的上传方中拥有者最少的块（rarest first），相同时随机选择，
+    所以各节点从源服务器取得的多是不同的块，之后在节点之间交换，源服务器的上行带宽
+    不再随接收方的数量线性增长。每个块按源服务器给出的摘要校验后才写入文件并对外提供，
+    不可信的节点发来错误的数据只会被丢弃。不依赖界面，可以在多个进程中同时运行。
+    """
+
+    def __init__(self, server_ip, port, save_dir, listen_port=0, upload_limit=0,
+                 on_log=None, on_start=None, on_progress=None):
+        """
+        Args:
+            server_ip (str): 源服务器地址
+            port (int): 源服务器端口
+            save_dir (str): 保存目录
+            listen_port (int): 接受其他节点连接的端口，0表示由系统分配
+            upload_limit (int): 上传速率上限，字节/秒，0表示不限速
+            on_log (callable): 日志回调，参数为日志消息
+            on_start (callable): 开始下载的回调，参数为文件信息和已有的字节数
+            on_progress (callable): 进度回调，参数为本次新写入的字节数
+        """
+        self.server_ip = server_ip
+        self.port = port
+        self.save_dir = save_dir
+        self.listen_port = listen_port
+        self.scheduler = BandwidthScheduler(upload_limit)
+        self.on_log = on_log
+        self.on_start = on_start
+        self.on_progress = on_progress
+        self.metrics = Metrics()
+        self.peer_id = ''  # 源服务器分配的节点ID
+        self.save_path = None
+        self.source = None
+        self.digests = []
+        self.block_map = None
+        self.fd = None
+        self.missing = set()  # 还没有的块号
+        self.writing = set()  # 正在校验和写入的块号
+        self.availability = []  # 每个块在已连接的上传方中的拥有者数
+        self.requested = []  # 每个块正在向几个上传方请求
+        self.known = {}  # 节点ID -> (主机, 端口)，不含自己
+        self.gone = set()  # 已断开的节点，不再重新连接
+        self.links = {}  # 节点ID -> Link
+        self.uploads = {}  # 上传连接的任务 -> 写入流，退出前关闭
+        self.ready = None  # 收到块摘要、可以对外上传时设置
+        self.completed = None  # 收到全部块或出错时设置
+        self.tracker_closed = None
+        self.error = None
+
+    def log(self, message):
+        """
+        记录日志
+
+        Args:
+            message (str): 日志消息
+        """
+        if self.on_log:
+            self.on_log(message)
+
+    def run(self):
+        """
+        在当前线程中运行事件循环，直到下载完成且所有节点都已完成
+
+        Returns:
+            str: 保存路径
+        """
+        return asyncio.run(self.main())
+
+    async def main(self):
+        """
+        注册到源服务器，下载全部块，完成后继续上传，直到源服务器通知所有节点都已完成
+
+        Raises:
+            Exception: 源服务器拒绝或下载出错
+
+        Returns:
+            str: 保存路径
+        """
+        self.ready = asyncio.Event()
+        self.completed = asyncio.Event()
+        self.tracker_closed = asyncio.Event()
+        server = await asyncio.start_server(self.handle_upload, '0.0.0.0', self.listen_port)
+        listen_port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.server_ip, self.port), CONNECT_TIMEOUT)
+        tasks = []
+        try:
+            writer.write(pack_hello(MSG_SWARM))
+            writer.write(pack_frame(MSG_ANNOUNCE, PORT.pack(listen_port)))
+            msg_type, _, body = await read_frame(reader)
+            if msg_type == MSG_ERROR:
+                raise Exception(body.decode())
+            if msg_type != MSG_INFO:
+                raise Exception("文件信息格式错误")
+            info = parse_info(body)
+            msg_type, _, body = await read_frame(reader)
+            if msg_type != MSG_PIECES:
+                raise Exception("块摘要格式错误")
+            self.open_file(info, body)
+            self.log(f"节点{self.peer_id}: 加入P2P分发，端口{listen_port}，还需要{len(self.missing)}个块")
+
+            tasks.append(asyncio.create_task(self.follow_tracker(reader)))
+            self.start_link(ORIGIN, self.server_ip, self.port)
+            if self.missing:
+                await self.completed.wait()
+            if self.error:
+                raise self.error
+            self.finish_file()
+
+            # 下载完成后继续上传，直到所有节点都已完成
+            for link in list(self.links.values()):
+                if link.writer:
+                    link.writer.close()
+            writer.write(pack_frame(MSG_END))
+            await self.tracker_closed.wait()
+            return self.save_path
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            server.close()
+            for upload in self.uploads.values():
+                upload.close()
+            if self.uploads:
+                await asyncio.wait(list(self.uploads), timeout=CONNECT_TIMEOUT)
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            if self.block_map:
+                self.block_map.close()  # 保留位图文件，用于下次续传
+                self.block_map = None
+
+    def open_file(self, info, pieces):
+        """
+        打开目标文件和位图，已有的位图说明之前下载过一部分，只下载缺失的块
+
+        Args:
+            info (FileInfo): 文件信息
+            pieces (bytes): 所有块的摘要
+
+        Raises:
+            Exception: 块摘要数量与文件大小不符
+        """
+        self.peer_id = info.session_id
+        block_count = (info.file_size + info.chunk_size - 1) // info.chunk_size
+        if len(pieces) != block_count * DIGEST_SIZE:
+            raise Exception("块摘要数量与文件大小不符")
+        self.digests = [pieces[i:i + DIGEST_SIZE] for i in range(0, len(pieces), DIGEST_SIZE)]
+        self.save_path = os.path.join(self.save_dir, info.file_name)
+        self.block_map, resumed = BlockMap.open(self.save_path, info.file_size, info.chunk_size, info.version)
+        if not resumed:
+            with open(self.save_path, 'wb') as f:
+                f.truncate(info.file_size)
+        self.fd = os.open(self.save_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        self.source = BlockSource(self.save_path, info.file_size, info.chunk_size, self.block_map.bitmap)
+        self.missing = set(bitmap_blocks(self.block_map.missing_bitmap(), block_count))
+        self.availability = [0] * block_count
+        self.requested = [0] * block_count
+        completed = info.file_size - sum(self.source.block_length(i) for i in self.missing)
+        if self.on_start:
+            self.on_start(info, completed)
+        self.ready.set()
+
+    def finish_file(self):
+        """所有块都已收到：关闭文件，删除位图文件"""
+        os.close(self.fd)
+        self.fd = None
+        self.block_map.close(remove=True)
+        self.block_map = None
+        self.log(f"文件保存至: {self.save_path}")
+
+    async def follow_tracker(self, reader):
+        """
+        接收源服务器推送的节点列表，直到源服务器通知所有节点都已完成
+
+        Args:
+            reader (asyncio.StreamReader): 与源服务器之间连接的读取流
+        """
+        try:
+            while True:
+                msg_type, _, body = await read_frame(reader)
+                if msg_type == MSG_PEERS:
+                    self.known = {peer_id: (host, port) for peer_id, host, port in parse_peers(body)
+                                  if peer_id != self.peer_id}
+                    self.connect_peers()
+                elif msg_type == MSG_BYE:
+                    self.log(f"节点{self.peer_id}: 所有节点都已完成")
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if self.missing:
+                self.log(f"节点{self.peer_id}: 与源服务器的连接中断，继续从已知的节点下载")
+        finally:
+            self.tracker_closed.set()
+            self.check_stalled()
+
+    def connect_peers(self):
+        """补足下载连接，从还没有连接过的节点中随机选择"""
+        if not self.missing:
+            return
+        candidates = [peer_id for peer_id in self.known if peer_id not in self.links and peer_id not in self.gone]
+        random.shuffle(candidates)
+        count = sum(peer_id != ORIGIN for peer_id in self.links)
+        for peer_id in candidates[:max(MAX_LINKS - count, 0)]:
+            host, port = self.known[peer_id]
+            self.start_link(peer_id, host, port)
+
+    def start_link(self, peer_id, host, port):
+        """
+        开始从一个上传方下载
+
+        Args:
+            peer_id (str): 上传方的节点ID
+            host (str): 地址
+            port (int): 端口
+        """
+        link = self.links[peer_id] = Link(peer_id)
+        asyncio.create_task(self.download_from(link, host, port))
+
+    async def download_from(self, link, host, port):
+        """
+        下载连接：记录上传方拥有的块，按选块策略保持PIPELINE个请求，收到的块校验后写入文件
+
+        Args:
+            link (Link): 下载连接
+            host (str): 上传方地址
+            port (int): 上传方端口
+        """
+        stats = self.metrics.connection(self.peer_id, link.peer_id, 'receive')
+        try:
+            reader, link.writer = await asyncio.wait_for(asyncio.open_connection(host, port), CONNECT_TIMEOUT)
+            link.writer.write(pack_hello(MSG_PEER, self.peer_id))
+            while self.missing:
+                with stats.measure('net_time'):
+                    msg_type, _, body = await read_frame(reader)
+                if msg_type == MSG_BITFIELD:
+                    if len(body) != len(self.source.bitmap):
+                        raise Exception("位图长度不符")
+                    link.have = bytearray(body)
+                    for index in bitmap_blocks(link.have, self.source.block_count):
+                        self.availability[index] += 1
+                elif msg_type == MSG_HAVE_BLOCK:
+                    (index,) = INDEX.unpack(body)
+                    if index < self.source.block_count and not has_block(link.have, index):
+                        link.have[index >> 3] |= 1 << (index & 7)
+                        self.availability[index] += 1
+                elif msg_type == MSG_BLOCK:
+                    offset, length = BLOCK.unpack_from(body)
+                    with stats.measure('disk_time'):
+                        await self.store_block(link, offset, body[BLOCK.size:])
+                    stats.add(length, 1)
+                elif msg_type == MSG_END and link.pending:
+                    link.pending -= 1  # 上传方没有可选的块
+                elif msg_type == MSG_ERROR:
+                    raise Exception(body.decode())
+                else:
+                    raise Exception("未知的消息类型")
+                self.request_blocks(link)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass  # 对方离开，未完成的请求交给其他连接
+        except Exception as e:
+            self.log(f"节点{self.peer_id}: 断开与节点{link.peer_id}的连接: {str(e)}")
+        finally:
+            stats.finish()
+            self.close_link(link)
+
+    def close_link(self, link):
+        """
+        关闭下载连接，未完成的请求和对方的块计数归还，再补足连接
+
+        Args:
+            link (Link): 下载连接
+        """
+        del self.links[link.peer_id]
+        self.gone.add(link.peer_id)
+        if link.writer:
+            link.writer.close()
+        for index in link.requested:
+            self.requested[index] -= 1
+        if link.have is not None:
+            for index in bitmap_blocks(link.have, self.source.block_count):
+                self.availability[index] -= 1
+        if not self.missing:
+            return
+        self.connect_peers()
+        for other in self.links.values():
+            self.request_blocks(other)
+        self.check_stalled()
+
+    def check_stalled(self):
+        """与源服务器的连接已断开、又没有任何下载连接时，无法再下载，报告错误"""
+        if self.missing and not self.links and self.tracker_closed.is_set():
+            self.error = Exception("没有可用的节点，下载未完成")
+            self.completed.set()
+
+    def pick_block(self, link):
+        """
+        为一个下载连接选择下一个要请求的块：对方拥有的块中拥有者最少的，相同时随机
+
+        所有块都已请求之后进入最后阶段，同一个块可以再向其他节点请求，先到的被使用。
+
+        Args:
+            link (Link): 下载连接
+
+        Returns:
+            int: 块号，没有可请求的块时为None
+        """
+        endgame = len(self.missing) <= PIPELINE * len(self.links)
+        limit = ENDGAME_COPIES if endgame else 1
+        best = None
+        best_key = None
+        for index in self.missing:
+            if (self.requested[index] >= limit or index in link.requested or index in self.writing
+                    or not has_block(link.have, index)):
+                continue
+            key = (self.requested[index], self.availability[index], random.random())
+            if best_key is None or key < best_key:
+                best, best_key = index, key
+        return best
+
+    def request_blocks(self, link):
+        """
+        补足一个下载连接上的请求
+
+        Args:
+            link (Link): 下载连接
+        """
+        if link.have is None:
+            return
+        if link.peer_id == ORIGIN:
+            self.request_from_origin(link)
+            return
+        while len(link.requested) < PIPELINE:
+            index = self.pick_block(link)
+            if index is None:
+                break
+            link.requested.add(index)
+            self.requested[index] += 1
+            link.writer.write(pack_frame(MSG_REQUEST, INDEX.pack(index)))
+
+    def request_from_origin(self, link):
+        """
+        向源服务器请求块：只附上已连接的节点都没有、也没有在请求中的块的位图，由源服务器
+        从中选择上传次数最少的，其他节点已有的块从节点那里下载
+
+        Args:
+            link (Link): 到源服务器的下载连接
+        """
+        endgame = len(self.missing) <= PIPELINE * len(self.links)
+        wanted = bytearray(len(self.source.bitmap))
+        count = 0
+        for index in self.missing:
+            if index in self.writing or index in link.requested:
+                continue
+            if endgame and self.requested[index] < ENDGAME_COPIES or \
+                    not self.requested[index] and self.availability[index] <= 1:
+                wanted[index >> 3] |= 1 << (index & 7)
+                count += 1
+        while link.pending < min(PIPELINE, count):
+            link.pending += 1
+            link.writer.write(pack_frame(MSG_REQUEST, bytes(wanted)))
+
+    async def store_block(self, link, offset, data):
+        """
+        校验收到的块，写入文件并对外提供
+
+        Args:
+            link (Link): 收到块的下载连接
+            offset (int): 块偏移量
+            data (bytes): 块数据
+
+        Raises:
+            Exception: 不是请求的块或校验失败
+        """
+        index = offset // self.source.block_size
+        if offset % self.source.block_size or index >= self.source.block_count:
+            raise Exception("块位置错误")
+        if index in link.requested:
+            link.requested.discard(index)
+            self.requested[index] -= 1
+        elif link.pending:
+            link.pending -= 1  # 上传方替我们选择的块
+        else:
+            raise Exception("收到未请求的块")
+        if index not in self.missing or index in self.writing:
+            return  # 最后阶段重复请求的块已从其他节点收到
+        self.writing.add(index)
+        try:
+            valid = await asyncio.get_running_loop().run_in_executor(None, self.write_block, index, data)
+        finally:
+            self.writing.discard(index)
+        if not valid:
+            raise Exception(f"块{index}校验失败")
+        self.missing.discard(index)
+        self.source.add(index)
+        if self.on_progress:
+            self.on_progress(len(data))
+        if not self.missing:
+            self.completed.set()
+        else:
+            # 其他连接可能因为没有可请求的块而空闲
+            for other in self.links.values():
+                if other is not link:
+                    self.request_blocks(other)
+
+    def write_block(self, index, data):
+        """
+        按源服务器给出的摘要校验块，通过后写入文件并标记，在线程池中调用
+
+        Args:
+            index (int): 块号
+            data (bytes): 块数据
+
+        Returns:
+            bool: 校验通过
+        """
+        if len(data) != self.source.block_length(index):
+            return False
+        hasher = block_hasher()
+        hasher.update(data)
+        if hasher.digest() != self.digests[index]:
+            return False
+        offset = index * self.source.block_size
+        if hasattr(os, 'pwrite'):
+            os.pwrite(self.fd, data, offset)
+        else:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            os.write(self.fd, data)
+        self.block_map.mark(offset)
+        return True
+
+    async def handle_upload(self, reader, writer):
+        """
+        处理其他节点的下载连接
+
+        Args:
+            reader (asyncio.StreamReader): 读取流
+            writer (asyncio.StreamWriter): 写入流
+        """
+        task = asyncio.current_task()
+        self.uploads[task] = writer
+        try:
+            msg_type, _, body = await asyncio.wait_for(read_frame(reader), CONNECT_TIMEOUT)
+            _, peer_id = parse_hello(body)
+            if msg_type != MSG_PEER:
+                raise ValueError("不是节点之间的连接")
+            await self.ready.wait()
+            stats = self.metrics.connection(self.peer_id, peer_id, 'send')
+            await serve_blocks(reader, writer, self.source, self.scheduler, Share(), stats)
+            if stats.blocks:
+                self.log(f"节点{self.peer_id}: 向节点{peer_id}上传{stats.blocks}块, {stats.summary()}")
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+            self.log(f"节点{self.peer_id}: 拒绝连接: {str(e) or '问候消息不完整'}")
+        except Exception as e:
+            self.log(f"节点{self.peer_id}: 上传出错: {str(e)}")
+        finally:
+            del self.uploads[task]
+            writer.close()
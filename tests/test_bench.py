@@ -0,0 +1,44 @@
+"""基准测试工具的回环测试"""
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import LinkShim  # noqa: E402
+
+
+def test_link_shim_round_trip():
+    """经过链路模拟的TCP往返数据完整，并且至少附加了两个方向的时延"""
+    payload = os.urandom(1024 * 1024)
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def serve():
+        conn, _ = listener.accept()
+        with conn:
+            request = conn.recv(16)
+            conn.sendall(request + payload)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    shim = LinkShim(listener.getsockname()[1], delay=0.05, loss=0.01, bandwidth=20 * 1024 * 1024)
+    shim.start()
+    try:
+        start = time.monotonic()
+        with socket.create_connection(('127.0.0.1', shim.port), timeout=10) as client:
+            client.sendall(b'ping')
+            received = bytearray()
+            while len(received) < len(payload) + 4:
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                received.extend(chunk)
+        elapsed = time.monotonic() - start
+    finally:
+        shim.stop()
+        listener.close()
+        thread.join(5)
+    assert bytes(received) == b'ping' + payload
+    assert elapsed >= 2 * 0.05 + len(payload) / (20 * 1024 * 1024)
@@ -0,0 +1,58 @@
+"""增量传输的块匹配"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import delta  # noqa: E402
+from delta import delta_ops, file_signature, parse_signature  # noqa: E402
+
+BLOCK = 64 * 1024
+
+
+def rebuild(ops, old, new):
+    """按指令用旧文件的块和新文件的字面数据重建文件"""
+    parts = []
+    for op, start, count in ops:
+        if op == 'C':
+            parts.append(old[start * BLOCK:(start + count) * BLOCK])
+        else:
+            parts.append(new[start:start + count])
+    return b''.join(parts)
+
+
+def scan(tmp_path, old, new):
+    """计算旧文件的签名，在新文件中查找相同的块"""
+    (tmp_path / 'old.bin').write_bytes(old)
+    (tmp_path / 'new.bin').write_bytes(new)
+    index = parse_signature(file_signature(str(tmp_path / 'old.bin'), BLOCK))
+    return delta_ops(str(tmp_path / 'new.bin'), index, BLOCK)
+
+
+def test_delta_saves_most_bytes_on_similar_file(tmp_path):
+    """95%相同的文件（有改写，也有让后面的块错位的插入和删除）只发送很少的字面数据"""
+    rnd = random.Random(7)
+    old = rnd.randbytes(8 * 1024 * 1024)
+    new = bytearray(old)
+    for _ in range(4):
+        pos = rnd.randrange(len(new) - 100 * 1024)
+        new[pos:pos + 100 * 1024] = rnd.randbytes(100 * 1024)
+    new[3000000:3000000] = rnd.randbytes(1000)
+    del new[6000000:6000500]
+    new = bytes(new)
+
+    ops = scan(tmp_path, old, new)
+    literal = sum(count for op, _, count in ops if op == 'L')
+    assert rebuild(ops, old, new) == new
+    assert 1 - literal / len(new) >= 0.85
+
+
+def test_delta_gives_up_when_nothing_matches(tmp_path, monkeypatch):
+    """开头的PROBE_SIZE内几乎没有相同的块时放弃匹配，剩余部分整体作为字面数据"""
+    monkeypatch.setattr(delta, 'PROBE_SIZE', 1024 * 1024)
+    rnd = random.Random(8)
+    old = rnd.randbytes(1024 * 1024)
+    new = rnd.randbytes(2 * 1024 * 1024) + old  # 后面的块相同，但已经放弃了匹配
+    ops = scan(tmp_path, old, new)
+    assert ops == [('L', 0, len(new))]
@@ -0,0 +1,115 @@
+"""数据连接中断后的接续：回环地址上的发送引擎和接收引擎"""
+import asyncio
+import os
+import re
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine import ServerEngine  # noqa: E402
+from receiver import ClientEngine  # noqa: E402
+
+FILE_SIZE = 16 * 1024 * 1024 + 12345
+FAIL_AT = 6  # 第几个块时让连接中断
+
+
+def free_port():
+    """
+    取一个当前空闲的本地端口
+
+    Returns:
+        int: 端口
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def break_client(engine):
+    """接收方在第FAIL_AT个块开始时关闭一个数据连接"""
+    original = engine.receive_chunk
+    lock = threading.Lock()
+    count = [0]
+
+    def receive_chunk(client_socket, *args, **kwargs):
+        with lock:
+            count[0] += 1
+            fail = count[0] == FAIL_AT
+        if fail:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        return original(client_socket, *args, **kwargs)
+
+    engine.receive_chunk = receive_chunk
+
+
+def break_server(engine):
+    """
+    发送方在第FAIL_AT个块发送完、客户端已确认之后，send_file_chunk返回之前断开连接，
+    即正在发送的块已经不在等待确认的块中
+    """
+    original = engine.send_file_chunk
+    count = [0]
+
+    async def send_file_chunk(session, writer, *args, **kwargs):
+        sent = await original(session, writer, *args, **kwargs)
+        count[0] += 1
+        if count[0] == FAIL_AT:
+            await asyncio.sleep(0.3)  # 等客户端的确认到达
+            writer.transport.abort()
+            raise ConnectionResetError("模拟的连接重置")
+        return sent
+
+    engine.send_file_chunk = send_file_chunk
+
+
+@pytest.mark.parametrize('side', ['client', 'server'])
+@pytest.mark.parametrize('verify', [False, True])
+@pytest.mark.parametrize('resume', [False, True])
+def test_failover_resends_only_unconfirmed_blocks(tmp_path, side, verify, resume):
+    """四个数据连接中的一个中断后文件完整，只重发了中断的连接上未确认的块"""
+    source = tmp_path / 'source.bin'
+    data = os.urandom(FILE_SIZE)
+    source.write_bytes(data)
+    output = tmp_path / 'output.bin'
+
+    server_logs = []
+    started = threading.Event()
+    server = ServerEngine(host='127.0.0.1', port=free_port(), on_log=server_logs.append, on_started=started.set)
+    server.file_path = str(source)
+    server.thread_count = 4
+    server.verify = verify
+    server.rate_limit = 32 * 1024 * 1024  # 让传输持续一段时间，中断时其他连接仍在发送
+    server.on_session_end = lambda session: server.stop()
+    if side == 'server':
+        break_server(server)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    assert started.wait(10)
+
+    client = ClientEngine(port=server.port, on_log=lambda message: None, choose_path=lambda info: str(output))
+    client.resume = resume
+    client.delta = False
+    if side == 'client':
+        break_client(client)
+    try:
+        saved = client.connect('127.0.0.1')
+    except Exception:
+        server.stop()  # 正常结束时由on_session_end停止
+        raise
+    finally:
+        thread.join(10)
+
+    assert saved == [str(output)]
+    assert output.read_bytes() == data
+
+    failovers = [int(n) for n in re.findall(r"未确认的(\d+)块", '\n'.join(server_logs))]
+    assert len(failovers) == 1, server_logs
+    blocks = -(-FILE_SIZE // server.chunk_size)
+    sent = sum(item['blocks'] for item in server.metrics.snapshot() if item['role'] == 'send')
+    # 中断的连接上已发完但未确认的块计入了sent，正在发送的块没有计入
+    assert blocks <= sent <= blocks + failovers[0]
+    assert failovers[0] <= 4
@@ -0,0 +1,125 @@
+"""回环地址上的往返测试"""
+import asyncio
+import os
+import socket
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from udp import PACKET, PKT_DATA, Injector, UdpReceiver, UdpSender  # noqa: E402
+
+BLOCK = 256 * 1024
+
+
+def start_receiver(size, server_host='127.0.0.1'):
+    """
+    在后台线程中启动UDP接收方，数据写入内存
+
+    Args:
+        size (int): 文件大小
+        server_host (str): 服务器地址
+
+    Returns:
+        tuple: (接收方, 接收线程, 接收缓冲区)
+    """
+    out = bytearray(size)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(('127.0.0.1', 0))
+
+    def write(data, offset):
+        out[offset:offset + len(data)] = data
+
+    receiver = UdpReceiver(sock, write, lambda n: None, size, server_host)
+    thread = threading.Thread(target=receiver.run, daemon=True)
+    thread.start()
+    return receiver, thread, out
+
+
+def stop_receiver(receiver, thread):
+    """停止接收线程并关闭套接字"""
+    receiver.stop()
+    thread.join(5)
+    receiver.sock.close()
+
+
+async def send_all(address, data, injector):
+    """
+    按块发送全部数据，直到所有数据报都被确认
+
+    Args:
+        address (tuple): 接收方地址
+        data (bytes): 数据
+        injector (Injector): 丢包和时延注入器
+
+    Returns:
+        UdpSender: 发送方，用于检查重传次数
+    """
+    loop = asyncio.get_running_loop()
+    _, sender = await loop.create_datagram_endpoint(lambda: UdpSender(0.0, injector), remote_addr=address)
+    pump = asyncio.create_task(sender.run())
+    blocks = [(offset, data[offset:offset + BLOCK]) for offset in range(0, len(data), BLOCK)]
+    try:
+        while blocks or not sender.idle():
+            sender.changed.clear()
+            if blocks and sender.has_room():
+                sender.add_block(*blocks.pop(0))
+                continue
+            await asyncio.wait_for(sender.changed.wait(), 10)
+            assert not pump.done()
+    finally:
+        sender.close()
+        await pump
+    return sender
+
+
+def test_udp_round_trip_with_loss():
+    """5%丢包时重传补齐所有数据报，接收的数据与发送的一致"""
+    data = os.urandom(2 * 1024 * 1024 + 1000)
+    receiver, thread, out = start_receiver(len(data))
+    try:
+        sender = asyncio.run(send_all(receiver.sock.getsockname(), data, Injector(0.05, 0.0, seed=1)))
+    finally:
+        stop_receiver(receiver, thread)
+    assert receiver.error is None
+    assert sender.retransmits > 0
+    assert receiver.dropped == 0
+    assert bytes(out) == data
+
+
+def test_udp_rejects_invalid_datagrams():
+    """超出文件范围、来自其他主机或其他端口的数据报被丢弃，不写入文件"""
+    size = 4096
+    receiver, thread, out = start_receiver(size)
+    address = receiver.sock.getsockname()
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    other_port = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    other_port.bind(('127.0.0.1', 0))
+    other_host = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    other_host.bind(('127.0.0.2', 0))
+    try:
+        server.settimeout(5)
+        server.sendto(PACKET.pack(PKT_DATA, 0, size) + b'x' * 10, address)  # 起点在文件末尾
+        server.sendto(PACKET.pack(PKT_DATA, 1, size - 5) + b'x' * 10, address)  # 跨过文件末尾
+        server.sendto(PACKET.pack(PKT_DATA, 2, 2 ** 63) + b'x' * 10, address)  # 极大的偏移量
+        server.sendto(PACKET.pack(PKT_DATA, 3, 0), address)  # 没有数据
+        other_host.sendto(PACKET.pack(PKT_DATA, 0, 0) + b'h' * 10, address)
+        server.sendto(PACKET.pack(PKT_DATA, 0, 100) + b'a' * 10, address)  # 有效，确定服务器的端口
+        server.recvfrom(1024)  # 序号跳跃前立即确认，等确认到达说明之前的数据报都已处理
+        other_port.sendto(PACKET.pack(PKT_DATA, 1, 200) + b'p' * 10, address)
+        server.sendto(PACKET.pack(PKT_DATA, 5000, 300) + b'w' * 10, address)  # 超出发送窗口
+        server.sendto(PACKET.pack(PKT_DATA, 2, 400) + b'b' * 10, address)
+        server.recvfrom(1024)
+    finally:
+        stop_receiver(receiver, thread)
+        for sock in (server, other_port, other_host):
+            sock.close()
+    assert receiver.error is None
+    assert receiver.dropped == 7
+    expected = bytearray(size)
+    expected[100:110] = b'a' * 10
+    expected[400:410] = b'b' * 10
+    assert out == expected
+
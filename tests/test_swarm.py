@@ -0,0 +1,103 @@
+"""P2P分发的回环测试：一个种子和多个接收进程"""
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = os.path.join(ROOT, 'cli.py')
+PEERS = 6
+FILE_SIZE = 24 * 1024 * 1024
+
+
+def free_port():
+    """
+    取一个当前空闲的本地端口
+
+    Returns:
+        int: 端口
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_listening(port, process, timeout=10):
+    """
+    等待服务器开始监听
+
+    Args:
+        port (int): 端口
+        process (subprocess.Popen): 服务器进程，提前退出时失败
+        timeout (float): 超时，秒
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        assert process.poll() is None, "种子进程提前退出"
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise AssertionError("种子进程没有开始监听")
+
+
+def uploaded_bytes(prom_path):
+    """
+    从Prometheus文件中取发送方向的字节数合计
+
+    Args:
+        prom_path (str): 种子导出的统计文件
+
+    Returns:
+        int: 字节数
+    """
+    with open(prom_path, encoding='utf-8') as f:
+        text = f.read()
+    return sum(int(float(value)) for value in
+               re.findall(r'^filetransfer_bytes_total\{[^}]*role="send"[^}]*\} (\S+)$', text, re.M))
+
+
+def test_swarm_fan_out(tmp_path):
+    """多个节点的文件逐字节一致，种子上传的数据少于节点数乘以文件大小"""
+    source = tmp_path / 'artifact.bin'
+    data = os.urandom(FILE_SIZE)
+    source.write_bytes(data)
+    prom_path = str(tmp_path / 'seed.prom')
+    port = free_port()
+    # 限制种子的上行带宽，节点之间互相交换块才能更快完成
+    seed = subprocess.Popen(
+        [sys.executable, CLI, 'daemon', str(source), '--host', '127.0.0.1', '--port', str(port),
+         '--swarm', '--rate-limit', '12', '--metrics', prom_path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    peers = []
+    try:
+        wait_listening(port, seed)
+        for i in range(PEERS):
+            out_dir = tmp_path / f'peer{i}'
+            out_dir.mkdir()
+            log = open(tmp_path / f'peer{i}.log', 'w')
+            peers.append((out_dir, log, subprocess.Popen(
+                [sys.executable, CLI, 'receive', '127.0.0.1', str(out_dir), '--port', str(port),
+                 '--swarm', '--quiet'],
+                stdout=log, stderr=subprocess.STDOUT,
+            )))
+        for out_dir, log, process in peers:
+            assert process.wait(120) == 0, (tmp_path / f'{out_dir.name}.log').read_text(encoding='utf-8')
+    finally:
+        for _, log, process in peers:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            log.close()
+        seed.send_signal(signal.SIGTERM)
+        seed.wait(30)
+
+    for out_dir, _, _ in peers:
+        assert (out_dir / 'artifact.bin').read_bytes() == data
+    uploaded = uploaded_bytes(prom_path)
+    assert FILE_SIZE <= uploaded < PEERS * FILE_SIZE  # 每个块至少从种子发出一次
@@ -0,0 +1,40 @@
+"""目录清单的路径检查"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tree import Tree  # noqa: E402
+
+
+@pytest.mark.parametrize('relative', [
+    '/etc/passwd', '../x', 'a/../../x', 'a//b', 'c:x', '..\\..\\x', '\\\\host\\share\\x', 'a\\b', 'a\0b',
+])
+def test_parse_rejects_unsafe_paths(tmp_path, relative):
+    """绝对路径、..、盘符和反斜杠都会被拒绝"""
+    with pytest.raises(Exception, match="不安全的路径"):
+        Tree.parse(f"1\t{relative}".encode(), str(tmp_path))
+
+
+def test_parse_rejects_symlink_escape(tmp_path):
+    """保存目录中已有的符号链接指向外面时，经过它的路径也被拒绝"""
+    root = tmp_path / 'root'
+    root.mkdir()
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    try:
+        os.symlink(outside, root / 'link', target_is_directory=True)
+    except (OSError, NotImplementedError):
+        pytest.skip("不能创建符号链接")
+    with pytest.raises(Exception, match="不安全的路径"):
+        Tree.parse(b"1\tlink/x", str(root))
+
+
+def test_parse_accepts_nested_paths(tmp_path):
+    """正常的相对路径按原样保留"""
+    tree = Tree.parse(b"d\ta\nd\ta/b\n3\ta/b/c.txt\n5\td.bin", str(tmp_path))
+    assert tree.dirs == ['a', 'a/b']
+    assert tree.files == [('a/b/c.txt', 3), ('d.bin', 5)]
+    assert tree.total_size == 8
@@ -0,0 +1,242 @@
+import bisect
+import os
+
+from integrity import block_hasher
+
+
+def read_segments(segments):
+    """
+    读取若干文件段并拼接在一起
+
+    Args:
+        segments (list): [(文件路径, 段在文件中的偏移量, 段长度)]
+
+    Raises:
+        Exception: 文件读取不完整
+
+    Returns:
+        bytes: 拼接后的数据
+    """
+    parts = []
+    for path, offset, length in segments:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) != length:
+            raise Exception("文件读取不完整")
+        parts.append(data)
+    return b''.join(parts)
+
+
+class Tree:
+    """
+    目录树的虚拟文件视图
+
+    目录中的所有文件按固定顺序首尾相接，看作一个大文件。这样块调度、断点续传、
+    块校验和压缩都不需要区分单个文件和目录：大文件照样被切成多个块分给不同连接，
+    许多小文件则被打包进同一个块，一帧发送，避免每个文件一次握手。
+    """
+
+    def __init__(self, root, dirs, files):
+        """
+        Args:
+            root (str): 目录树在本机的根路径
+            dirs (list): 相对路径列表，以/分隔
+            files (list): [(相对路径, 文件大小)]
+        """
+        self.root = root
+        self.dirs = dirs
+        self.files = files
+        self.starts = []  # 每个文件在虚拟文件中的起始位置
+        self.total_size = 0
+        for _, size in files:
+            self.starts.append(self.total_size)
+            self.total_size += size
+
+    @classmethod
+    def scan(cls, root):
+        """
+        遍历目录，生成发送方的目录树，不跟随符号链接
+
+        Args:
+            root (str): 目录路径
+
+        Returns:
+            Tree: 目录树
+        """
+        dirs = []
+        files = []
+        for current, dir_names, file_names in os.walk(root):
+            dir_names.sort()  # 固定遍历顺序，使同一目录每次得到相同的布局
+            relative = os.path.relpath(current, root).replace(os.sep, '/')
+            prefix = '' if relative == '.' else relative + '/'
+            if prefix:
+                dirs.append(relative)
+            for name in sorted(file_names):
+                path = os.path.join(current, name)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    files.append((prefix + name, os.path.getsize(path)))
+        return cls(root, dirs, files)
+
+    @classmethod
+    def parse(cls, manifest, root):
+        """
+        解析发送方的清单，生成接收方的目录树
+
+        Args:
+            manifest (bytes): 清单，每行为"d\\t目录"或"文件大小\\t文件"
+            root (str): 在本机保存的根路径
+
+        Raises:
+            Exception: 清单格式错误或包含不安全的路径
+
+        Returns:
+            Tree: 目录树
+        """
+        dirs = []
+        files = []
+        base = os.path.realpath(root)
+        try:
+            for line in manifest.decode().splitlines():
+                kind, relative = line.split('\t', 1)
+                parts = relative.split('/')
+                # 拒绝绝对路径、..、盘符和Windows的路径分隔符，防止写到保存目录之外
+                if (not relative or relative.startswith('/') or '..' in parts or '' in parts
+                        or ':' in relative or '\\' in relative or '\0' in relative):
+                    raise Exception(f"清单中包含不安全的路径: {relative}")
+                # 再按本机的路径规则确认拼接后仍在根目录之内，保存目录中已有的符号链接也不能指向外面
+                target = os.path.realpath(os.path.join(base, *parts))
+                if os.path.commonpath([base, target]) != base:
+                    raise Exception(f"清单中包含不安全的路径: {relative}")
+                if kind == 'd':
+                    dirs.append(relative)
+                else:
+                    files.append((relative, int(kind)))
+        except (UnicodeDecodeError, ValueError):
+            raise Exception("目录清单格式错误")
+        return cls(root, dirs, files)
+
+    def manifest(self):
+        """
+        生成清单，发送给接收方
+
+        Returns:
+            bytes: 清单
+        """
+        lines = [f"d\t{relative}" for relative in self.dirs]
+        lines += [f"{size}\t{relative}" for relative, size in self.files]
+        return '\n'.join(lines).encode()
+
+    def version(self):
+        """
+        目录版本，任何文件的大小或修改时间变化都会改变版本，旧的续传位图随之作废
+
+        Returns:
+            str: 版本摘要
+        """
+        hasher = block_hasher()
+        for relative, size in self.files:
+            stat = os.stat(self.path(relative))
+            hasher.update(f"{relative}|{size}|{stat.st_mtime_ns}\n".encode())
+        return hasher.hexdigest()
+
+    def path(self, relative):
+        """
+        相对路径对应的本机路径
+
+        Args:
+            relative (str): 以/分隔的相对路径
+
+        Returns:
+            str: 本机路径
+        """
+        return os.path.join(self.root, *relative.split('/'))
+
+    def segments(self, offset, length):
+        """
+        把虚拟文件中的区间拆成各个文件中的段
+
+        Args:
+            offset (int): 虚拟文件中的偏移量
+            length (int): 区间长度
+
+        Returns:
+            list: [(文件路径, 段在文件中的偏移量, 段长度)]
+        """
+        result = []
+        index = bisect.bisect_right(self.starts, offset) - 1
+        while length > 0 and index < len(self.files):
+            relative, size = self.files[index]
+            inner = offset - self.starts[index]
+            count = min(size - inner, length)
+            if count > 0:  # 跳过空文件
+                result.append((self.path(relative), inner, count))
+                offset += count
+                length -= count
+            index += 1
+        return result
+
+    def create(self):
+        """创建所有目录，并把每个文件创建或截断为清单中的大小（稀疏文件，不写入数据）"""
+        os.makedirs(self.root, exist_ok=True)
+        for relative in self.dirs:
+            os.makedirs(self.path(relative), exist_ok=True)
+        for relative, size in self.files:
+            path = self.path(relative)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                with open(path, 'ab') as f:
+                    f.truncate(size)
+
+
+class TreeWriter:
+    """按虚拟偏移量写入目录树中的文件，缓存最近使用的文件描述符，避免每个块都重新打开文件"""
+
+    def __init__(self, tree, write_at, max_open=64):
+        """
+        Args:
+            tree (Tree): 接收方的目录树
+            write_at (callable): 按位置写入单个文件的函数，参数为(文件描述符, 数据, 偏移量)
+            max_open (int): 最多同时打开的文件数
+        """
+        self.tree = tree
+        self.write = write_at
+        self.max_open = max_open
+        self.fds = {}  # 路径 -> 文件描述符，按最近使用排序
+
+    def open(self, path):
+        """
+        取得文件描述符，超过上限时关闭最久未使用的文件
+
+        Args:
+            path (str): 文件路径
+
+        Returns:
+            int: 文件描述符
+        """
+        fd = self.fds.pop(path, None)
+        if fd is None:
+            if len(self.fds) >= self.max_open:
+                os.close(self.fds.pop(next(iter(self.fds))))
+            fd = os.open(path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        self.fds[path] = fd
+        return fd
+
+    def write_at(self, data, offset):
+        """
+        把虚拟文件中的一段数据写入对应的各个文件
+
+        Args:
+            data (memoryview): 数据
+            offset (int): 虚拟文件中的偏移量
+        """
+        position = 0
+        for path, inner, count in self.tree.segments(offset, len(data)):
+            self.write(self.open(path), data[position:position + count], inner)
+            position += count
+
+    def close(self):
+        """关闭所有缓存的文件描述符"""
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds.clear()
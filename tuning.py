@@ -0,0 +1,121 @@
+import socket
+
+AUTO_STREAMS = 0  # 连接数设置为0表示自动调优
+START_STREAMS = 2  # 自动调优时初始的数据连接数
+MAX_STREAMS = 16  # 自动调优时最多的数据连接数
+TUNE_INTERVAL = 1.0  # 测量吞吐量的间隔，秒
+MIN_GAIN = 0.1  # 增加连接后吞吐量至少提高10%才保留
+MIN_BUFFER = 64 * 1024  # 按带宽时延积计算的缓冲区下限，64KB
+MAX_BUFFER = 16 * 1024 * 1024  # 缓冲区上限，16MB
+
+
+def buffer_for(rate, rtt):
+    """
+    按带宽时延积计算每个连接的缓冲区大小
+
+    缓冲区小于带宽时延积时，发送方在收到确认之前就会停下来等待，链路无法跑满。
+    取带宽时延积的2倍并向上取2的幂，给吞吐量波动留出余量。
+
+    Args:
+        rate (float): 单个连接的吞吐量，字节/秒
+        rtt (float): 往返时延，秒
+
+    Returns:
+        int: 缓冲区大小，字节
+    """
+    size = MIN_BUFFER
+    while size < rate * rtt * 2 and size < MAX_BUFFER:
+        size *= 2
+    return size
+
+
+def current_buffer(sock, option):
+    """
+    套接字当前的内核缓冲区大小
+
+    Args:
+        sock (socket.socket): 套接字
+        option (int): socket.SO_SNDBUF或socket.SO_RCVBUF
+
+    Returns:
+        int: 缓冲区大小，无法获取时为0
+    """
+    try:
+        return sock.getsockopt(socket.SOL_SOCKET, option)
+    except OSError:
+        return 0
+
+
+def apply_buffer(sock, option, size):
+    """
+    调大套接字的内核缓冲区
+
+    只会调大不会调小：显式设置缓冲区会关闭内核的自动调整，
+    在低时延链路上算出的值可能比内核自动调整的结果还小。
+
+    Args:
+        sock (socket.socket): 套接字
+        option (int): socket.SO_SNDBUF或socket.SO_RCVBUF
+        size (int): 缓冲区大小，0表示使用系统默认值
+
+    Returns:
+        int: 设置后的缓冲区大小
+    """
+    try:
+        if size > current_buffer(sock, option):
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+    except OSError:
+        pass  # 平台不允许修改时保持系统默认值
+    return current_buffer(sock, option)
+
+
+class StreamTuner:
+    """
+    按实测吞吐量调整数据连接数（爬山法）
+
+    每次把连接数加倍，吞吐量提高不到MIN_GAIN时说明瓶颈已不在连接数上，
+    退回到吞吐量最高的连接数并停止调整。连接数变化后的第一次测量包含新连接的
+    慢启动，不作为判断依据。
+    """
+
+    def __init__(self, streams=START_STREAMS, max_streams=MAX_STREAMS):
+        """
+        Args:
+            streams (int): 初始连接数
+            max_streams (int): 最多连接数
+        """
+        self.streams = streams
+        self.max_streams = max_streams
+        self.best_rate = 0.0
+        self.best_streams = streams
+        self.settled = False  # 是否已停止调整
+        self.warming = True  # 刚调整过连接数，跳过下一次测量
+
+    def update(self, rate):
+        """
+        根据一次测量结果决定新的连接数
+
+        Args:
+            rate (float): 本次测量的总吞吐量，字节/秒
+
+        Returns:
+            int: 新的连接数
+        """
+        if self.settled:
+            return self.streams
+        if self.warming:
+            self.warming = False
+            return self.streams
+
+        if rate > self.best_rate * (1 + MIN_GAIN):
+            self.best_rate = rate
+            self.best_streams = self.streams
+            if self.streams < self.max_streams:
+                self.streams = min(self.streams * 2, self.max_streams)
+                self.warming = True
+            else:
+                self.settled = True
+        else:
+            self.streams = self.best_streams
+            self.settled = True
+        return self.streams
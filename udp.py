@@ -0,0 +1,455 @@
+import asyncio
+import collections
+import random
+import socket
+import struct
+import time
+
+# 数据报头部，网络字节序
+PACKET = struct.Struct('!BIQ')  # 类型 序号 数据在文件中的偏移量，后面是数据
+ACK = struct.Struct('!BII')  # 类型 累计确认序号（之前的都已收到） 已收到的最高序号+1，后面是选择确认位图
+PKT_DATA = 1
+PKT_ACK = 2
+
+PAYLOAD_SIZE = 1400  # 每个数据报携带的数据，头部加上IP/UDP头部不超过以太网的1500字节
+WINDOW = 4096  # 最多未被累计确认的数据报数，选择确认位图最长512字节
+REORDER = 3  # 比已收到的最高序号小3以上仍未收到，才认为丢失，允许少量乱序
+ACK_EVERY = 32  # 接收方每收到32个数据报确认一次
+ACK_INTERVAL = 0.005  # 或者距上次确认超过5毫秒
+MIN_RATE = 256 * 1024  # 发送速率下限，256KB/s
+MAX_RATE = 1024 * 1024 * 1024  # 发送速率上限，1GB/s
+START_RATE = 4 * 1024 * 1024  # 初始发送速率，4MB/s
+LOSS_THRESHOLD = 0.1  # 一个测量周期内丢包率超过10%才认为拥塞，链路上的随机丢包不降速
+MIN_RTO = 0.2  # 超时重传的下限，秒
+INITIAL_RTO = 1.0  # 还没有往返时延采样时的超时，秒，与TCP相同
+
+
+class Injector:
+    """
+    丢包和时延注入器，在回环地址上模拟有损的长距离链路
+
+    发送方的数据报和收到的确认都经过注入器：按概率丢弃，或者延迟一段时间再交付，
+    两个方向各延迟delay秒，往返时延增加2*delay。
+    """
+
+    def __init__(self, loss=0.0, delay=0.0, seed=None):
+        """
+        Args:
+            loss (float): 丢包率，0到1
+            delay (float): 单向附加时延，秒
+            seed (int): 随机数种子，用于复现
+        """
+        self.loss = loss
+        self.delay = delay
+        self.random = random.Random(seed)
+
+    def __bool__(self):
+        return bool(self.loss or self.delay)
+
+    def deliver(self, loop, func, *args):
+        """
+        经过注入器交付一个数据报
+
+        Args:
+            loop (asyncio.AbstractEventLoop): 事件循环
+            func (callable): 交付时调用的函数
+            *args: 参数
+        """
+        if self.loss and self.random.random() < self.loss:
+            return
+        if self.delay:
+            loop.call_later(self.delay, func, *args)
+        else:
+            func(*args)
+
+
+class UdpSender(asyncio.DatagramProtocol):
+    """
+    可靠UDP的发送方，只在事件循环线程中使用
+
+    每个数据报有递增的序号，接收方定期回复累计确认和选择确认位图。位图中的空位如果比更晚
+    发出的数据报还晚到达，即为丢失（相当于否定确认），只重传这些数据报，序号不变；长时间没有
+    累计确认的进展时按超时重传。发送速率由定时的配额控制（按速率发送，不按窗口），每个测量周期根据
+    实际送达速率和丢包率调整：丢包率低时加速，高时降到略低于送达速率。随机丢包不会像
+    TCP那样让速率成倍下降，因此适合长时延、有丢包的链路。
+    """
+
+    def __init__(self, rtt=0.0, injector=None):
+        """
+        Args:
+            rtt (float): 预估的往返时延，秒
+            injector (Injector): 丢包和时延注入器，为None或丢包率和时延都为0时不注入
+        """
+        self.transport = None
+        self.injector = injector
+        self.loop = None
+        self.next_seq = 0
+        self.cum = 0  # 对方已累计确认的序号
+        self.packets = {}  # 尚未累计确认的数据报，序号 -> [偏移量, 数据, 所属块, 发送时间, 是否重传过]
+        self.fresh = collections.deque()  # 尚未发送过的数据报序号
+        self.lost = collections.deque()  # 等待重传的数据报序号
+        self.queued = set()  # 已在重传队列中、尚未重新发出的序号
+        self.highest = 0  # 对方已收到的最高序号+1
+        self.sacked = 0  # 最近一个确认的选择确认位图，第0位对应累计确认序号
+        self.remaining = {}  # 块的开始位置 -> 尚未累计确认的数据报数
+        self.lengths = {}  # 块的开始位置 -> 块大小
+        self.completed = []  # 所有数据报都已确认的块 [(开始位置, 大小)]
+        self.acked_bytes = 0  # 已累计确认的字节数
+        self.retransmits = 0  # 重传的数据报数
+        self.srtt = rtt or 0.1
+        self.sampled = False  # 是否已有往返时延采样，之前的预估值可能偏小（例如不含附加时延）
+        self.rate = START_RATE
+        self.slow_start = True
+        self.changed = asyncio.Event()  # 有确认到达时设置，唤醒等待的调用方
+        self.wakeup = asyncio.Event()  # 有数据需要发送时设置，唤醒发送循环
+        self.last_progress = time.monotonic()
+        # 当前测量周期的统计
+        self.period_start = time.monotonic()
+        self.period_delivered = 0
+        self.period_sent = 0
+        self.period_lost = 0
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+
+    def datagram_received(self, data, addr):
+        if self.injector:
+            self.injector.deliver(self.loop, self.handle_ack, data)
+        else:
+            self.handle_ack(data)
+
+    def error_received(self, exc):
+        pass  # 例如对方端口暂时不可达，靠超时重传恢复
+
+    def has_room(self):
+        """
+        是否可以加入新的块：未确认的数据报不超过一个窗口
+
+        Returns:
+            bool: 可以加入
+        """
+        return len(self.packets) < WINDOW
+
+    def idle(self):
+        """
+        所有数据报都已确认
+
+        Returns:
+            bool: 没有未确认的数据报
+        """
+        return not self.packets
+
+    def add_block(self, offset, data):
+        """
+        把一个块切成数据报排入发送队列
+
+        Args:
+            offset (int): 块的开始位置
+            data (bytes): 块数据
+        """
+        view = memoryview(data)
+        count = 0
+        for start in range(0, len(view), PAYLOAD_SIZE):
+            seq = self.next_seq
+            self.next_seq += 1
+            self.packets[seq] = [offset + start, view[start:start + PAYLOAD_SIZE], offset, 0.0, False]
+            self.fresh.append(seq)
+            count += 1
+        self.remaining[offset] = count
+        self.lengths[offset] = len(view)
+        self.wakeup.set()
+
+    def take_completed(self):
+        """
+        取出所有数据报都已确认的块
+
+        Returns:
+            list: [(开始位置, 大小)]
+        """
+        completed, self.completed = self.completed, []
+        return completed
+
+    def handle_ack(self, data):
+        """
+        处理一个确认：推进累计确认，按位图找出丢失的数据报，并采样往返时延
+
+        Args:
+            data (bytes): 确认数据报
+        """
+        if len(data) < ACK.size:
+            return
+        kind, cum, highest = ACK.unpack_from(data)
+        if kind != PKT_ACK or cum > self.next_seq or highest > self.next_seq:
+            return
+        now = time.monotonic()
+
+        newest = self.packets.get(highest - 1)
+        if highest > self.highest:
+            # 往返时延采样：只用新送达的最高序号，且没有重传过时才可信（Karn算法）
+            if newest is not None and not newest[4] and newest[3]:
+                sample = now - newest[3]
+                self.srtt = 0.875 * self.srtt + 0.125 * sample if self.sampled else sample
+                self.sampled = True
+            self.period_delivered += (highest - self.highest) * PAYLOAD_SIZE
+            self.highest = highest
+        # 比已送达的数据报早发出一段时间仍未送达的，才判定丢失
+        deadline = (newest[3] if newest is not None else now) - self.srtt / 4
+
+        # 累计确认之前的数据报都已收到
+        if cum > self.cum:
+            for seq in range(self.cum, cum):
+                packet = self.packets.pop(seq, None)
+                if packet is None:
+                    continue
+                self.queued.discard(seq)
+                self.acked_bytes += len(packet[1])
+                block = packet[2]
+                self.remaining[block] -= 1
+                if not self.remaining[block]:
+                    del self.remaining[block]
+                    self.completed.append((block, self.lengths.pop(block)))
+            self.cum = cum
+            self.last_progress = now
+
+        # 位图中的空位就是对方缺少的数据报，比最高序号小REORDER以上，
+        # 并且比已送达的数据报早发出（重传的数据报按重传的时间比较）时判定丢失
+        bits = self.sacked = int.from_bytes(data[ACK.size:], 'little')
+        if highest > cum + REORDER:
+            missing = ~bits & ((1 << (highest - REORDER - cum)) - 1)
+            while missing:
+                low = missing & -missing
+                seq = cum + low.bit_length() - 1
+                missing ^= low
+                packet = self.packets.get(seq)
+                if packet is None or not packet[3] or packet[3] > deadline or seq in self.queued:
+                    continue
+                self.queued.add(seq)
+                self.lost.append(seq)
+                self.period_lost += 1
+            if self.lost:
+                self.wakeup.set()
+        self.changed.set()
+
+    def check_timeout(self, now):
+        """
+        长时间没有累计确认的进展时，重传所有对方没有选择确认、发出超过一个往返的数据报，并降低速率。
+        传输末尾没有更晚发出的数据报可以比较，丢失的数据报只能这样发现。
+
+        Args:
+            now (float): 当前时间
+        """
+        rto = max(self.srtt * 4, MIN_RTO) if self.sampled else INITIAL_RTO
+        if not self.packets or now - self.last_progress < rto:
+            return
+        self.last_progress = now
+        for seq in range(self.cum, min(self.cum + WINDOW, self.next_seq)):
+            packet = self.packets.get(seq)
+            if (packet is None or not packet[3] or now - packet[3] < self.srtt or seq in self.queued
+                    or self.sacked >> (seq - self.cum) & 1):
+                continue
+            self.queued.add(seq)
+            self.lost.append(seq)
+        self.rate = max(self.rate / 2, MIN_RATE)
+        self.slow_start = False
+
+    def adjust_rate(self, now):
+        """
+        每个测量周期（至少一个往返）按送达速率和丢包率调整发送速率
+
+        Args:
+            now (float): 当前时间
+        """
+        elapsed = now - self.period_start
+        if elapsed < max(self.srtt, 0.01):
+            return
+        if not self.fresh:
+            # 没有新数据可发（例如传输末尾只剩重传），丢包率和送达速率都不可信
+            self.period_start = now
+            self.period_delivered = self.period_sent = self.period_lost = 0
+            return
+        delivered = self.period_delivered / elapsed
+        loss = self.period_lost / max(self.period_sent, 1)
+        if loss > LOSS_THRESHOLD and self.period_sent >= 64:  # 样本太少时丢包率不可信
+            # 拥塞：降到略低于实际送达的速率，让队列排空，每个周期最多减半
+            self.rate = max(delivered * 0.95, self.rate / 2)
+            self.slow_start = False
+        elif self.slow_start:
+            # 每个周期翻倍；送达速率反映的是上一个周期的发送速率，通常是当前的一半，
+            # 远低于这个比例时说明受窗口或接收方限制，不再继续翻倍
+            self.rate = min(self.rate * 2, max(delivered, START_RATE) * 4)
+        else:
+            self.rate = min(self.rate * 1.1, max(delivered, MIN_RATE) * 2)  # 逐步试探，不超过送达速率太多
+        self.rate = min(max(self.rate, MIN_RATE), MAX_RATE)
+        self.period_start = now
+        self.period_delivered = self.period_sent = self.period_lost = 0
+
+    def send_packet(self, seq, now, resend):
+        """
+        发送一个数据报
+
+        Args:
+            seq (int): 序号
+            now (float): 当前时间
+            resend (bool): 是否为重传
+
+        Returns:
+            int: 发送的字节数，数据报已被确认时为0
+        """
+        packet = self.packets.get(seq)
+        if packet is None:
+            return 0
+        packet[3] = now
+        self.queued.discard(seq)
+        if resend:
+            packet[4] = True
+            self.retransmits += 1
+        datagram = PACKET.pack(PKT_DATA, seq, packet[0]) + packet[1]
+        if self.injector:
+            self.injector.deliver(self.loop, self.transport.sendto, datagram)
+        else:
+            self.transport.sendto(datagram)
+        self.period_sent += 1
+        return len(datagram)
+
+    async def run(self):
+        """发送循环：按速率发放配额，先重传丢失的数据报，再发送新的数据报，直到close"""
+        budget = 0.0
+        last = time.monotonic()
+        while not self.closed:
+            now = time.monotonic()
+            budget = min(budget + (now - last) * self.rate, self.rate * 0.005 + PAYLOAD_SIZE)  # 最多积累5毫秒的配额
+            last = now
+            self.check_timeout(now)
+            self.adjust_rate(now)
+            while budget > 0:
+                if self.lost:
+                    budget -= self.send_packet(self.lost.popleft(), now, True)
+                elif self.fresh and self.fresh[0] < self.cum + WINDOW:
+                    budget -= self.send_packet(self.fresh.popleft(), now, False)
+                else:
+                    break
+            if self.lost or (self.fresh and self.fresh[0] < self.cum + WINDOW):
+                await asyncio.sleep(0.001)  # 配额用完，等下一个时间片
+            else:
+                self.wakeup.clear()
+                try:
+                    # 没有可发送的数据：等待新的块或确认，定期醒来检查超时
+                    await asyncio.wait_for(self.wakeup.wait(), MIN_RTO / 2)
+                except asyncio.TimeoutError:
+                    pass
+
+    def close(self):
+        """停止发送循环并关闭套接字"""
+        self.closed = True
+        self.wakeup.set()
+        if self.transport:
+            self.transport.close()
+
+
+class UdpReceiver:
+    """
+    可靠UDP的接收方，在独立的线程中运行
+
+    收到的数据直接按偏移量写入文件，数据报的序号用于去重和生成确认：
+    累计确认序号之前的都已收到，之后收到的记在位图中，位图中的空位告诉发送方哪些需要重传。
+    发现序号不连续（可能丢包）时立即确认，让发送方尽快重传。
+    只接受来自服务器地址的数据报，第一个数据报确定服务器的UDP端口；数据超出文件范围、
+    序号超出发送窗口的数据报直接丢弃，其他主机不能借此写入文件之外的位置或接管确认。
+    """
+
+    def __init__(self, sock, write, on_data, file_size, server_host):
+        """
+        Args:
+            sock (socket.socket): 已绑定的UDP套接字
+            write (callable): 写入函数，参数为(数据, 偏移量)
+            on_data (callable): 收到新数据后的回调，参数为字节数
+            file_size (int): 文件大小，数据必须落在[0, file_size)之内
+            server_host (str): 控制连接对端的服务器地址
+        """
+        self.sock = sock
+        self.write = write
+        self.on_data = on_data
+        self.file_size = file_size
+        self.server_host = server_host
+        self.dropped = 0  # 丢弃的无效数据报数
+        self.cum = 0
+        self.received = set()  # 累计确认序号之后已收到的序号
+        self.highest = 0
+        self.peer = None
+        self.stopped = False
+        self.error = None
+
+    def send_ack(self):
+        """发送累计确认和选择确认位图"""
+        bits = 0
+        for seq in self.received:
+            bits |= 1 << (seq - self.cum)
+        bitmap = bits.to_bytes((self.highest - self.cum + 7) // 8, 'little')
+        try:
+            self.sock.sendto(ACK.pack(PKT_ACK, self.cum, self.highest) + bitmap, self.peer)
+        except OSError:
+            pass  # 确认丢失由发送方的超时重传处理
+
+    def accept(self, peer, seq, offset, length):
+        """
+        检查数据报是否可以接受
+
+        Args:
+            peer (tuple): 数据报的来源地址
+            seq (int): 序号
+            offset (int): 数据在文件中的偏移量
+            length (int): 数据长度
+
+        Returns:
+            bool: 来源是服务器，序号在窗口之内，数据在文件范围之内
+        """
+        if peer[0] != self.server_host or (self.peer is not None and peer != self.peer):
+            return False
+        if seq >= self.cum + WINDOW:
+            return False
+        return 0 < length and offset + length <= self.file_size
+
+    def run(self):
+        """接收循环，直到调用stop"""
+        buffer = bytearray(PACKET.size + PAYLOAD_SIZE)
+        view = memoryview(buffer)
+        unacked = 0
+        last_ack = time.monotonic()
+        self.sock.settimeout(ACK_INTERVAL)
+        try:
+            while not self.stopped:
+                try:
+                    size, peer = self.sock.recvfrom_into(buffer)
+                except socket.timeout:
+                    size = 0
+                if size >= PACKET.size:
+                    kind, seq, offset = PACKET.unpack_from(buffer)
+                    if kind == PKT_DATA and not self.accept(peer, seq, offset, size - PACKET.size):
+                        self.dropped += 1
+                    elif kind == PKT_DATA:
+                        self.peer = peer
+                        gap = seq > self.highest
+                        if seq >= self.cum and seq not in self.received:
+                            self.write(view[PACKET.size:size], offset)
+                            self.on_data(size - PACKET.size)
+                            self.received.add(seq)
+                            while self.cum in self.received:
+                                self.received.discard(self.cum)
+                                self.cum += 1
+                        self.highest = max(self.highest, seq + 1, self.cum)
+                        unacked += 1
+                        if gap:
+                            unacked = ACK_EVERY  # 序号跳跃，中间可能丢包，立即确认
+                now = time.monotonic()
+                if self.peer and unacked and (unacked >= ACK_EVERY or now - last_ack >= ACK_INTERVAL):
+                    self.send_ack()
+                    unacked = 0
+                    last_ack = now
+        except Exception as e:
+            self.error = e
+
+    def stop(self):
+        """停止接收循环"""
+        self.stopped = True